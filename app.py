@@ -2,12 +2,29 @@ import os
 from dotenv import load_dotenv
 import logging
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, session
+import time
+from flask import Flask, render_template, request, jsonify, flash, redirect, url_for, session, Response, stream_with_context, g, send_file
 from werkzeug.utils import secure_filename
 import uuid
-from models import db, Document
-from utils.pdf_processor import extract_text_from_pdf
-from utils.gemini_direct import process_document, query_document
+import hashlib
+import json
+import base64
+import threading
+import click
+from models import db, Document, IngestionJob, UploadSession, upgrade_schema, index_ref_count, version_chain, configure_sqlite
+from utils.pdf_processor import extract_pages_from_pdf, extract_outline, join_pages
+from utils.backends import BACKENDS, get_backend, loaded_cache
+from utils.model_clients import Overloaded, set_client_key, limiter_collector
+from utils.answer_cache import answer_cache
+from utils.local_embedding import embedding_cache
+from utils.metrics import metrics, span, cache_collector, begin_request_timing, request_timings, server_timing_header
+from utils.job_queue import IngestionQueue
+from utils.uploads import UploadError, part_path, receive_chunk, commit_upload, store_content_addressed
+from utils.corpus_index import corpus_index, resolve_hits, CORPUS_INDEX_ENABLED
+from utils.bulk_ingest import iter_sources, bulk_ingest
+from utils.storage import StorageCompactor, STORAGE_DIR, remove_index, remove_upload
+from utils.profiler import RequestProfiler
+from utils.versioning import load_changed_pages
 
 # Load environment variables from .env file
 load_dotenv()
@@ -30,35 +47,337 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # 1 hour
 app.config['SESSION_PERMANENT'] = True
 
-# Configure SQLite database
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///pdf_qa.db"
+# Configure database; SQLite in the instance folder unless DATABASE_URL
+# points at PostgreSQL
+database_url = os.environ.get("DATABASE_URL", "sqlite:///pdf_qa.db")
+if database_url.startswith("postgres://"):
+    database_url = "postgresql://" + database_url[len("postgres://"):]
+app.config["SQLALCHEMY_DATABASE_URI"] = database_url
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config['DB_BUSY_TIMEOUT'] = float(os.environ.get(
+    'DB_BUSY_TIMEOUT', 30))  # seconds a SQLite writer waits for the lock
+# Connections kept open per process, plus extra ones opened under load;
+# request threads, ingestion workers and asgi.py threads all share them
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 40)),
+    'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+}
+if database_url.startswith("sqlite"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"]['connect_args'] = {
+        'timeout': app.config['DB_BUSY_TIMEOUT']
+    }
+else:
+    # Server-side connections can be dropped while idle in the pool
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update(pool_pre_ping=True,
+                                                   pool_recycle=1800)
 db.init_app(app)
+with app.app_context():
+    configure_sqlite(db.engine, app.config['DB_BUSY_TIMEOUT'])
+
+# Documents per page of /api/documents
+app.config['DOCUMENTS_PAGE_SIZE'] = int(
+    os.environ.get('DOCUMENTS_PAGE_SIZE', 100))
+app.config['DOCUMENTS_MAX_PAGE_SIZE'] = 1000
+
+# Question-answering backend for new documents; its SDKs are imported on
+# first use. Indexes are backend-specific, so each document records the
+# backend that ingested it and is queried with that one.
+app.config['QA_BACKEND'] = os.environ.get('QA_BACKEND', 'gemini_direct')
+if app.config['QA_BACKEND'] not in BACKENDS:
+    raise Exception(
+        f"Unknown QA_BACKEND '{app.config['QA_BACKEND']}'; expected one of: {', '.join(sorted(BACKENDS))}"
+    )
 
 # Configure upload folder
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                              'uploads')
 ALLOWED_EXTENSIONS = {'pdf'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max request size
+# Larger files are sent in chunks that each stay under MAX_CONTENT_LENGTH
+app.config['UPLOAD_CHUNK_SIZE'] = int(
+    os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+app.config['MAX_UPLOAD_SIZE'] = int(
+    os.environ.get('MAX_UPLOAD_SIZE', 2 * 1024 * 1024 * 1024))
 
-# Create upload directory if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Configure background ingestion
+app.config['INGEST_WORKERS'] = int(os.environ.get('INGEST_WORKERS', 2))
+app.config['INGEST_POLL_INTERVAL'] = float(
+    os.environ.get('INGEST_POLL_INTERVAL', 2.0))
+app.config['INGEST_JOB_TIMEOUT'] = int(
+    os.environ.get('INGEST_JOB_TIMEOUT',
+                   120))  # seconds without a heartbeat before a running job is requeued
+app.config['INGEST_HEARTBEAT_INTERVAL'] = float(
+    os.environ.get('INGEST_HEARTBEAT_INTERVAL', 15.0))
 
-# Ensure instance folder has correct permissions
-os.makedirs('instance', exist_ok=True)
-os.chmod('instance', 0o777)
+# Background compaction and garbage collection of uploads/ and storage/;
+# files changed within the grace period are never removed
+app.config['STORAGE_COMPACTION_INTERVAL'] = float(
+    os.environ.get('STORAGE_COMPACTION_INTERVAL', 3600))  # seconds; 0 disables
+app.config['STORAGE_GC_GRACE'] = float(
+    os.environ.get('STORAGE_GC_GRACE', 86400))
 
-# Create database tables
-with app.app_context():
-    db.create_all()
-    # Ensure database file has correct permissions
-    os.chmod('instance/pdf_qa.db', 0o666)
+# Passages from across the library sent with a library-wide question
+app.config['LIBRARY_CONTEXT_PASSAGES'] = int(
+    os.environ.get('LIBRARY_CONTEXT_PASSAGES', 8))
+
+# Questions accepted by one /api/ask-batch request
+app.config['BATCH_MAX_QUESTIONS'] = int(
+    os.environ.get('BATCH_MAX_QUESTIONS', 50))
+
+# Prometheus metrics at /metrics, and an optional Server-Timing header with
+# per-stage durations on every response
+app.config['METRICS_ENABLED'] = os.environ.get(
+    'METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+app.config['TIMING_HEADER'] = os.environ.get(
+    'TIMING_HEADER', 'false').lower() in ('1', 'true', 'yes')
+
+# Sampling profiles of single requests, asked for with an X-Profile header
+# or armed from /api/admin/profiler; both need the token, unset disables them
+app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN', '')
+app.config['PROFILE_DIR'] = os.environ.get(
+    'PROFILE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+app.config['PROFILE_FORMAT'] = os.environ.get(
+    'PROFILE_FORMAT', 'speedscope')  # or 'collapsed'
+app.config['PROFILE_INTERVAL'] = float(
+    os.environ.get('PROFILE_INTERVAL', 0.005))  # seconds between samples
+app.config['PROFILE_MAX_ACTIVE'] = int(
+    os.environ.get('PROFILE_MAX_ACTIVE', 4))  # per process
+app.config['PROFILE_MAX_SECONDS'] = float(
+    os.environ.get('PROFILE_MAX_SECONDS', 300))
+app.config['PROFILE_KEEP'] = int(os.environ.get('PROFILE_KEEP', 200))
+
+_db_initialized = False
+_db_init_lock = threading.Lock()
+
+
+def init_db():
+    """Create the upload folder, database tables and missing columns."""
+    # Create upload directory if it doesn't exist
+    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+    # Ensure instance folder has correct permissions
+    os.makedirs('instance', exist_ok=True)
+    os.chmod('instance', 0o777)
+
+    # Create database tables
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+        # Ensure database file has correct permissions
+        if db.engine.dialect.name == 'sqlite' and os.path.exists(
+                db.engine.url.database):
+            os.chmod(db.engine.url.database, 0o666)
+
+
+def ensure_db():
+    """
+    Run init_db once per process, on the first request.
+
+    Importing the app stays free of filesystem and schema work, so forked
+    workers become ready sooner; deployments can run `flask init-db` once
+    beforehand instead.
+    """
+    global _db_initialized
+    if _db_initialized:
+        return
+    with _db_init_lock:
+        if not _db_initialized:
+            init_db()
+            _db_initialized = True
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create the database tables and upload folder."""
+    init_db()
+    print('Database initialized')
+
+
+@app.cli.command('bulk-ingest')
+@click.argument('source')
+@click.option('--checkpoint',
+              help='Progress file; defaults to one per source in the instance folder')
+@click.option('--extract-workers',
+              type=int,
+              default=None,
+              help='PDF extraction processes [default: CPU count]')
+@click.option('--index-workers',
+              type=int,
+              default=4,
+              show_default=True,
+              help='Documents indexed at once')
+@click.option('--batch-size',
+              type=int,
+              default=100,
+              show_default=True,
+              help='Documents written per transaction')
+@click.option('--retry-failed',
+              is_flag=True,
+              help='Try files that failed in an earlier run again')
+def bulk_ingest_command(source, checkpoint, extract_workers, index_workers,
+                        batch_size, retry_failed):
+    """Ingest every PDF in SOURCE, a directory or a manifest of paths."""
+    ensure_db()
+    sources = iter_sources(source)
+    if checkpoint is None:
+        digest = hashlib.sha256(
+            os.path.abspath(source).encode('utf-8')).hexdigest()[:12]
+        checkpoint = os.path.join(app.instance_path,
+                                  f'bulk_ingest_{digest}.jsonl')
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+    print(f'Ingesting {len(sources)} files; progress is saved to {checkpoint}')
+
+    def report(stats):
+        print(f"{stats['ingested'] + stats['duplicates']} ingested "
+              f"({stats['duplicates']} duplicates), {stats['skipped']} "
+              f"skipped, {stats['failed']} failed of {stats['total']} "
+              f"({stats['resumed']} done earlier); "
+              f"{stats['docs_per_minute']} docs/min, "
+              f"{stats['pages_per_minute']} pages/min")
+
+    summary = bulk_ingest(sources,
+                          index_pages,
+                          app.config['UPLOAD_FOLDER'],
+                          checkpoint_path=checkpoint,
+                          extract_workers=extract_workers,
+                          index_workers=index_workers,
+                          batch_size=batch_size,
+                          retry_failed=retry_failed,
+                          report=report,
+                          backend=app.config['QA_BACKEND'])
+    print(f"Done in {summary['elapsed_seconds']}s")
+    if summary['failed']:
+        raise SystemExit(1)
+
+
+@app.cli.command('storage-gc')
+@click.option('--dry-run',
+              is_flag=True,
+              help='Report what would be removed without removing it')
+@click.option('--grace',
+              type=float,
+              default=None,
+              help='Seconds since a file last changed before it is removed '
+              '[default: STORAGE_GC_GRACE]')
+def storage_gc_command(dry_run, grace):
+    """Remove orphaned uploads and indexes, and compact stored indexes."""
+    ensure_db()
+    report = storage_compactor.run(dry_run=dry_run, grace=grace)
+    if report is None:
+        print('Another process is compacting the storage; try again later')
+        raise SystemExit(1)
+    print(f"{'Would remove' if dry_run else 'Removed'} {report['indexes']} "
+          f"indexes, {report['uploads']} uploads, {report['parts']} "
+          f"unfinished uploads and {report['checkpoints']} checkpoints; "
+          f"compacted {report['compacted']} indexes; "
+          f"{report['bytes_freed'] / (1024 * 1024):.1f} MB "
+          f"{'reclaimable' if dry_run else 'freed'}")
+
+
+def qa_backend(name=None):
+    """
+    A backend module, imported on first use.
+
+    Args:
+        name (str): Backend recorded on a document; the configured backend
+            if None, as for documents ingested before it was recorded
+    """
+    return get_backend(name or app.config['QA_BACKEND'])
+
+
+def index_pages(pages, filename, previous_index_id=None, outline=None):
+    """Index extracted page texts with the configured backend; returns the index_id."""
+    index_id = qa_backend().process_document(
+        join_pages(pages),
+        filename,
+        pages=pages,
+        previous_index_id=previous_index_id,
+        outline=outline)
+
+    # Make the document searchable across the library; the document itself
+    # is usable even if this fails
+    if CORPUS_INDEX_ENABLED:
+        try:
+            corpus_index.add_index(index_id)
+        except Exception as e:
+            logger.error(f"Error adding {index_id} to corpus index: {str(e)}")
+
+    return index_id
+
+
+def ingest_document(document):
+    """Extract and index an uploaded PDF; runs on an ingestion worker thread."""
+    # Extract text from PDF, and its outline for the summary tree
+    pages = extract_pages_from_pdf(document.filepath)
+    outline = extract_outline(document.filepath)
+
+    # A new version reuses the embeddings of chunks that did not change
+    previous = db.session.get(
+        Document,
+        document.previous_version_id) if document.previous_version_id else None
+    previous_index_id = None
+    if previous and previous.index_id and (
+            previous.backend or app.config['QA_BACKEND']) == app.config['QA_BACKEND']:
+        previous_index_id = previous.index_id
+    document.backend = app.config['QA_BACKEND']
+
+    # Process document with LlamaIndex
+    return index_pages(pages, os.path.basename(document.filepath),
+                       previous_index_id, outline)
+
+
+ingestion_queue = IngestionQueue(ingest_document, app)
+storage_compactor = StorageCompactor(app)
+request_profiler = RequestProfiler(app)
+
+
+def ingestion_collector():
+    """Number of ingestion jobs in each state, read at scrape time."""
+    with app.app_context():
+        counts = db.session.query(IngestionJob.status,
+                                  db.func.count(IngestionJob.id)).group_by(
+                                      IngestionJob.status).all()
+    return [('ingest_jobs', 'gauge', 'Ingestion jobs by status',
+             [({
+                 'status': status
+             }, count) for status, count in counts])]
+
+
+metrics.add_collector(cache_collector('answer', answer_cache))
+metrics.add_collector(cache_collector('embedding', embedding_cache))
+
+
+def document_cache_collector():
+    """Index cache counters, once a request has loaded the backend."""
+    cache = loaded_cache(app.config['QA_BACKEND'])
+    return cache_collector('document', cache)() if cache is not None else []
+
+
+metrics.add_collector(document_cache_collector)
+metrics.add_collector(ingestion_collector)
+metrics.add_collector(limiter_collector)
 
 
 # Before request handler to ensure session works correctly
 @app.before_request
 def before_request():
+    g.request_start = time.perf_counter()
+    g.profile = request_profiler.start(request.path,
+                                       request.headers.get('X-Profile'),
+                                       threading.get_ident())
+    begin_request_timing()
+    ensure_db()
+
+    # Waiting model calls are served round-robin across clients
+    set_client_key(request.remote_addr)
+
+    # Make sure this process has ingestion workers to pick up queued jobs
+    ingestion_queue.ensure_started()
+    storage_compactor.ensure_started()
+
     # Make sure session is initialized for all requests
     if session.get('initialized') != True:
         session['initialized'] = True
@@ -66,11 +385,285 @@ def before_request():
         logger.debug("Session initialized")
 
 
+@app.after_request
+def after_request(response):
+    elapsed = time.perf_counter() - g.get('request_start', time.perf_counter())
+    # Streamed responses are timed until the first byte is ready
+    metrics.observe('http_request_duration_seconds',
+                    elapsed,
+                    'Time to handle an HTTP request',
+                    endpoint=request.endpoint or 'unknown',
+                    method=request.method,
+                    status=response.status_code)
+    if app.config['TIMING_HEADER']:
+        response.headers['Server-Timing'] = server_timing_header(
+            request_timings(), elapsed)
+
+    profile = g.pop('profile', None)
+    if profile is not None:
+        response.headers['X-Profile-Id'] = profile.id
+        info = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code
+        }
+        # Streamed responses are profiled until their last chunk is sent
+        response.call_on_close(
+            lambda: request_profiler.finish(profile, **info))
+    return response
+
+
+@app.teardown_request
+def teardown_request(error=None):
+    # Requests that never reached after_request still stop their sampler
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.finish(profile,
+                                method=request.method,
+                                path=request.path,
+                                endpoint=request.endpoint,
+                                status=500)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not app.config['METRICS_ENABLED']:
+        return jsonify({'error': 'Metrics are disabled'}), 404
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+def profiler_admin():
+    """Error response unless the request carries the profiler token as a bearer token."""
+    if not request_profiler.enabled:
+        return jsonify({'error': 'Profiling is disabled'}), 404
+    token = request.headers.get('Authorization', '')
+    if not token.startswith('Bearer ') or not request_profiler.authorized(
+            token[len('Bearer '):]):
+        return jsonify({'error': 'Invalid or missing token'}), 401
+    return None
+
+
+@app.route('/api/admin/profiler', methods=['GET', 'POST', 'DELETE'])
+def profiler_state():
+    """
+    Arm, disarm or inspect profiling of every request under a path.
+
+    POST takes {"duration": seconds, "path": prefix, "sample_rate": 0-1};
+    requests under the path are profiled in every worker until the duration
+    has passed or DELETE disarms it.
+    """
+    error = profiler_admin()
+    if error:
+        return error
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            duration = float(data.get('duration', 60))
+            sample_rate = float(data.get('sample_rate', 1.0))
+        except (TypeError, ValueError):
+            return jsonify(
+                {'error': 'duration and sample_rate must be numbers'}), 400
+        if duration <= 0 or not 0 < sample_rate <= 1:
+            return jsonify({
+                'error':
+                'duration must be positive and sample_rate between 0 and 1'
+            }), 400
+        request_profiler.arm(duration, data.get('path') or '/', sample_rate)
+    elif request.method == 'DELETE':
+        request_profiler.disarm()
+    return jsonify({'armed': request_profiler.armed()})
+
+
+@app.route('/api/admin/profiles', methods=['GET'])
+def list_profiles():
+    """Recent profiles, newest first, with ?limit= (default 50)."""
+    error = profiler_admin()
+    if error:
+        return error
+    limit = request.args.get('limit', 50, type=int)
+    profiles = request_profiler.list_profiles(max(1, limit))
+    for profile in profiles:
+        profile['url'] = url_for('get_profile', profile_id=profile['id'])
+    return jsonify({'profiles': profiles})
+
+
+@app.route('/api/admin/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """Download a profile, to open in speedscope or feed to flamegraph.pl."""
+    error = profiler_admin()
+    if error:
+        return error
+    path = request_profiler.profile_path(profile_id)
+    if path is None:
+        return jsonify({'error': f'Profile {profile_id} not found'}), 404
+    return send_file(path, as_attachment=True)
+
+
+def overloaded_response(error):
+    """503 telling the client to retry once this worker has capacity again."""
+    response = jsonify({'error': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit(
         '.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def save_upload(file):
+    """
+    Stream an uploaded file to disk under its content hash.
+
+    The bytes are hashed as they are copied, so identical uploads end up at
+    the same path and are only stored once.
+
+    Returns:
+        tuple: (filepath, content_hash)
+    """
+    hasher = hashlib.sha256()
+    temp_path = part_path(app.config['UPLOAD_FOLDER'], uuid.uuid4().hex)
+    try:
+        with open(temp_path, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(1024 * 1024), b''):
+                hasher.update(chunk)
+                out.write(chunk)
+
+        content_hash = hasher.hexdigest()
+        filepath = store_content_addressed(temp_path,
+                                           app.config['UPLOAD_FOLDER'],
+                                           content_hash)
+        return filepath, content_hash
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def register_upload(original_filename, filepath, content_hash,
+                    previous_document=None, upload=None):
+    """
+    Record a stored upload and queue it for indexing.
+
+    Identical content that is already indexed shares its index instead of
+    being processed again, and identical content that is still being
+    indexed joins that ingestion job.
+
+    Args:
+        previous_document (Document): Optional document this upload is a
+            new version of
+        upload (UploadSession): Optional chunked upload session, marked
+            committed in the same transaction that records the document
+
+    Returns:
+        tuple: (document, job); job is None for a deduplicated upload of
+        indexed content, and another document's job for one joining an
+        ingestion in progress
+    """
+    existing = Document.query.filter_by(
+        content_hash=content_hash,
+        status='ready').filter(Document.index_id != '').first()
+    in_flight = None
+    if not existing:
+        in_flight = IngestionJob.query.join(
+            Document, IngestionJob.document_id == Document.id).filter(
+                Document.content_hash == content_hash,
+                IngestionJob.status.in_(('queued', 'running'))).first()
+
+    # Save document metadata to database; new content is indexed by an
+    # ingestion worker so the request returns right away
+    new_document = Document(filename=original_filename,
+                            filepath=filepath,
+                            upload_date=datetime.utcnow(),
+                            content_hash=content_hash,
+                            index_id=existing.index_id if existing else '',
+                            backend=existing.backend if existing else None,
+                            status='ready' if existing else 'queued')
+    if previous_document:
+        new_document.previous_version_id = previous_document.id
+        new_document.version = previous_document.version + 1
+    db.session.add(new_document)
+    if upload:
+        db.session.flush()
+        upload.status = 'committed'
+        upload.content_hash = content_hash
+        upload.document_id = new_document.id
+        upload.updated_at = datetime.utcnow()
+    db.session.commit()
+
+    if existing:
+        logger.debug(
+            f"Duplicate upload of {content_hash}, reusing index "
+            f"{existing.index_id} (now shared by "
+            f"{index_ref_count(existing.index_id)} documents)")
+        return new_document, None
+
+    if in_flight:
+        # The job's worker updates documents without a job of their own when
+        # it finishes; if it finished before this row was committed, it has
+        # missed this one
+        db.session.refresh(in_flight)
+        if in_flight.status in ('queued', 'running'):
+            logger.debug(
+                f"Duplicate upload of {content_hash}, joining ingestion job {in_flight.id}")
+            return new_document, in_flight
+        leader = db.session.get(Document, in_flight.document_id)
+        if in_flight.status == 'done' and leader and leader.index_id:
+            new_document.index_id = leader.index_id
+            new_document.backend = leader.backend
+            new_document.status = 'ready'
+            db.session.commit()
+            return new_document, None
+
+    return new_document, ingestion_queue.enqueue(new_document)
+
+
+def upload_response(document, job):
+    """JSON body and status code describing a registered upload."""
+    if job is None:
+        return jsonify({
+            'job_id': None,
+            'document_id': document.id,
+            'status': document.status,
+            'deduplicated': True
+        }), 201
+
+    return jsonify({
+        'job_id': job.id,
+        'document_id': document.id,
+        'status': job.status,
+        'status_url': url_for('get_job', job_id=job.id),
+        # Joined the ingestion of an identical upload
+        'deduplicated': job.document_id != document.id
+    }), 202
+
+
+def find_previous_version(document_id):
+    """
+    Look up the document an upload is a new version of.
+
+    Returns:
+        tuple: (document or None, None) on success, or (None, error message)
+    """
+    if document_id in (None, ''):
+        return None, None
+    try:
+        previous = db.session.get(Document, int(document_id))
+    except (TypeError, ValueError):
+        previous = None
+    if not previous:
+        return None, f'Document with ID {document_id} not found'
+    return previous, None
+
+
+def wants_json():
+    """True when the client asked for a JSON response instead of a page."""
+    return request.accept_mimetypes.best == 'application/json'
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -93,34 +686,32 @@ def upload():
 
         if file and allowed_file(file.filename):
             try:
-                # Generate a unique filename
                 original_filename = secure_filename(file.filename)
-                file_extension = original_filename.rsplit('.', 1)[1].lower()
-                unique_filename = f"{uuid.uuid4().hex}.{file_extension}"
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'],
-                                        unique_filename)
 
-                # Save the file
-                file.save(filepath)
+                previous, error = find_previous_version(
+                    request.form.get('previous_document_id'))
+                if error:
+                    flash(error, 'error')
+                    return redirect(request.url)
 
-                # Extract text from PDF
-                extracted_text = extract_text_from_pdf(filepath)
-
-                # Process document with LlamaIndex
-                index_id = process_document(extracted_text, unique_filename)
-
-                # Save document metadata to database
-                new_document = Document(filename=original_filename,
-                                        filepath=filepath,
-                                        index_id=index_id,
-                                        upload_date=datetime.utcnow())
-                db.session.add(new_document)
-                db.session.commit()
+                # Save the file under its content hash
+                filepath, content_hash = save_upload(file)
+                new_document, job = register_upload(original_filename,
+                                                    filepath, content_hash,
+                                                    previous)
 
                 # Store document ID in session
                 session['current_document_id'] = new_document.id
 
-                flash('File uploaded successfully!', 'success')
+                if wants_json():
+                    return upload_response(new_document, job)
+
+                if job is None:
+                    flash('File uploaded successfully!', 'success')
+                else:
+                    flash(
+                        'File uploaded successfully! Processing has started.',
+                        'success')
                 return redirect(url_for('qa', document_id=new_document.id))
 
             except Exception as e:
@@ -131,8 +722,110 @@ def upload():
             flash('File type not allowed. Please upload a PDF file.', 'error')
             return redirect(request.url)
 
-    # GET request - show upload form
-    return render_template('upload.html')
+    # GET request - show upload form, optionally for a new version
+    previous, _ = find_previous_version(
+        request.args.get('previous_document_id'))
+    return render_template('upload.html', previous_document=previous)
+
+
+def upload_session_status(upload):
+    return {
+        'upload_id': upload.id,
+        'filename': upload.filename,
+        'status': upload.status,
+        'total_size': upload.total_size,
+        'received_bytes': upload.received_bytes,
+        'next_chunk': upload.next_chunk,
+        'chunk_size': app.config['UPLOAD_CHUNK_SIZE'],
+        'previous_document_id': upload.previous_document_id,
+        'document_id': upload.document_id
+    }
+
+
+@app.route('/api/uploads', methods=['POST'])
+def create_upload():
+    data = request.get_json(silent=True) or {}
+    filename = data.get('filename', '')
+    if not filename or not allowed_file(filename):
+        return jsonify(
+            {'error': 'File type not allowed. Please upload a PDF file.'}), 400
+
+    total_size = data.get('size')
+    if total_size is not None:
+        try:
+            total_size = int(total_size)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid upload size'}), 400
+        if total_size > app.config['MAX_UPLOAD_SIZE']:
+            return jsonify({
+                'error':
+                f"File exceeds the {app.config['MAX_UPLOAD_SIZE']} byte limit"
+            }), 413
+
+    previous, error = find_previous_version(data.get('previous_document_id'))
+    if error:
+        return jsonify({'error': error}), 404
+
+    upload = UploadSession(id=uuid.uuid4().hex,
+                           filename=secure_filename(filename),
+                           total_size=total_size,
+                           expected_hash=data.get('sha256'),
+                           previous_document_id=previous.id if previous else None)
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify(upload_session_status(upload)), 201
+
+
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    upload = db.session.get(UploadSession, upload_id)
+    if not upload:
+        return jsonify({'error': f'Upload with ID {upload_id} not found'}), 404
+    return jsonify(upload_session_status(upload))
+
+
+@app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    upload = db.session.get(UploadSession, upload_id)
+    if not upload:
+        return jsonify({'error': f'Upload with ID {upload_id} not found'}), 404
+
+    try:
+        receive_chunk(upload, index, request.stream,
+                      app.config['UPLOAD_FOLDER'],
+                      app.config['UPLOAD_CHUNK_SIZE'],
+                      upload.total_size or app.config['MAX_UPLOAD_SIZE'])
+    except UploadError as e:
+        return jsonify({'error': str(e), **upload_session_status(upload)}), e.status_code
+    return jsonify(upload_session_status(upload))
+
+
+@app.route('/api/uploads/<upload_id>/commit', methods=['POST'])
+def commit_chunked_upload(upload_id):
+    upload = db.session.get(UploadSession, upload_id)
+    if not upload:
+        return jsonify({'error': f'Upload with ID {upload_id} not found'}), 404
+
+    def register(filepath, content_hash):
+        previous = db.session.get(
+            Document, upload.previous_document_id
+        ) if upload.previous_document_id else None
+        return register_upload(upload.filename, filepath, content_hash,
+                               previous, upload)
+
+    try:
+        new_document, job = commit_upload(upload, app.config['UPLOAD_FOLDER'],
+                                          register)
+    except UploadError as e:
+        return jsonify({'error': str(e), **upload_session_status(upload)}), e.status_code
+    except Exception as e:
+        # The session is still open unless the document was recorded, so
+        # the client can retry the commit
+        logger.error(f"Error registering upload {upload_id}: {str(e)}")
+        return jsonify({'error': f'Error processing file: {str(e)}'}), 500
+
+    session['current_document_id'] = new_document.id
+    return upload_response(new_document, job)
 
 
 @app.route('/qa', methods=['GET'])
@@ -153,7 +846,7 @@ def qa(document_id=None):
         return redirect(url_for('upload'))
 
     # Look up the document
-    document = Document.query.get(document_id)
+    document = db.session.get(Document, document_id)
 
     if not document:
         logger.error(f"Document not found in database: {document_id}")
@@ -164,13 +857,22 @@ def qa(document_id=None):
     session['current_document_id'] = document_id
     session.modified = True
 
+    # Latest ingestion job, so the page can poll while the index is built
+    job = IngestionJob.query.filter_by(document_id=document.id).order_by(
+        IngestionJob.created_at.desc()).first()
+
     logger.debug(f"Rendering QA page with document: {document.filename}")
-    return render_template('qa.html', document=document)
+    return render_template('qa.html', document=document, job=job)
 
 
-@app.route('/api/ask', methods=['POST'])
-@app.route('/api/ask/<int:document_id>', methods=['POST'])
-def ask_question(document_id=None):
+def resolve_question_request(document_id=None):
+    """
+    Validate an ask request and look up the document it targets.
+
+    Returns:
+        tuple: (document, question, None) on success, or
+        (None, None, error_response) when the request cannot be answered
+    """
     # Get document_id from multiple sources (URL param, request data, session)
     if document_id is None:
         # Try to get from request data
@@ -182,50 +884,433 @@ def ask_question(document_id=None):
             document_id = session.get('current_document_id')
 
     if document_id is None:
-        return jsonify(
+        return None, None, (jsonify(
             {'error':
-             'No document selected. Please select a document first.'}), 400
+             'No document selected. Please select a document first.'}), 400)
 
     # Get question from request data
     data = request.json or {}
     question = data.get('question')
 
+    document, error = question_document(document_id, question)
+
+    # Always update session with current document
+    if document is not None:
+        session['current_document_id'] = document_id
+        session.modified = True
+
+    if error:
+        payload, status = error
+        return None, None, (jsonify(payload), status)
+
+    return document, question, None
+
+
+def question_document(document_id, question):
+    """
+    Look up the document a question is about and check it can be answered.
+
+    Shared by the Flask routes and the asyncio serving mode in asgi.py.
+
+    Returns:
+        tuple: (document or None, None) when it can be answered, or
+        (document or None, (error dict, HTTP status)) when it cannot
+    """
     if not question:
-        return jsonify({'error': 'No question provided'}), 400
+        return None, ({'error': 'No question provided'}, 400)
+
+    return ready_document(document_id)
+
 
-    # Look up document
-    document = Document.query.get(document_id)
+def ready_document(document_id):
+    """
+    Look up a document and check it is ready for questions.
+
+    Returns:
+        tuple: (document or None, None | (error dict, HTTP status)), as for
+        question_document
+    """
+    document = db.session.get(Document, document_id)
 
     if not document:
-        return jsonify({'error':
-                        f'Document with ID {document_id} not found'}), 404
+        return None, ({
+            'error': f'Document with ID {document_id} not found'
+        }, 404)
 
-    # Always update session with current document
-    session['current_document_id'] = document_id
-    session.modified = True
+    if document.status != 'ready':
+        return document, ({
+            'error':
+            f'Document is not ready for questions yet (status: {document.status})',
+            'status': document.status
+        }, 409)
+
+    return document, None
+
+
+def search_library(query, top_k=10):
+    """
+    Find the passages closest to a query across all ready documents.
+
+    Returns:
+        list: dicts with document_id, filename, score and text, best first
+    """
+    with span('library_search'):
+        hits = resolve_hits(corpus_index.search(qa_backend().embed_question(query), top_k))
+
+    # Deduplicated uploads share an index; cite the earliest document for it
+    documents = {}
+    for doc in Document.query.filter(
+            Document.index_id.in_({hit['index_id']
+                                   for hit in hits}),
+            Document.status == 'ready').order_by(Document.id):
+        documents.setdefault(doc.index_id, doc)
+
+    return [{
+        'document_id': documents[hit['index_id']].id,
+        'filename': documents[hit['index_id']].filename,
+        'score': hit['score'],
+        'text': hit['text']
+    } for hit in hits if hit['index_id'] in documents]
+
+
+@app.route('/api/search', methods=['GET'])
+def search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'No search query provided'}), 400
+
+    try:
+        top_k = min(int(request.args.get('k', 10)), 100)
+        return jsonify({'query': query, 'results': search_library(query, top_k)})
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error(f"Error searching library: {str(e)}")
+        return jsonify({'error': f'Error searching library: {str(e)}'}), 500
+
+
+def ask_library(question):
+    """Answer a question from passages across the whole library."""
+    if not question:
+        return jsonify({'error': 'No question provided'}), 400
+
+    try:
+        passages = search_library(question,
+                                  app.config['LIBRARY_CONTEXT_PASSAGES'])
+        if not passages:
+            return jsonify({
+                'answer': 'Not found in the library',
+                'scope': 'library',
+                'sources': []
+            })
+
+        answer = qa_backend().answer_from_passages(question, passages)
+        return jsonify({
+            'answer': answer,
+            'scope': 'library',
+            'sources': [{
+                'number': number,
+                'document_id': passage['document_id'],
+                'filename': passage['filename'],
+                'score': passage['score']
+            } for number, passage in enumerate(passages, start=1)]
+        })
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error(f"Error querying library: {str(e)}")
+        return jsonify({'error': f'Error processing question: {str(e)}'}), 500
+
+
+@app.route('/api/ask', methods=['POST'])
+@app.route('/api/ask/<int:document_id>', methods=['POST'])
+def ask_question(document_id=None):
+    # Questions about the whole library are not tied to one document
+    data = request.get_json(silent=True) or {}
+    if document_id is None and data.get('scope') == 'library':
+        return ask_library(data.get('question'))
+
+    document, question, error_response = resolve_question_request(document_id)
+    if error_response:
+        return error_response
 
     try:
-        # Query the document using LlamaIndex
-        answer = query_document(document.index_id, question)
+        # Query the document, reusing cached answers where possible
+        answer, cached = qa_backend(document.backend).query_document_cached(
+            document.index_id, question)
         return jsonify({
             'answer': answer,
-            'document_id': document_id,
-            'document_name': document.filename
+            'document_id': document.id,
+            'document_name': document.filename,
+            'cached': cached
         })
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         logger.error(f"Error querying document: {str(e)}")
         return jsonify({'error': f'Error processing question: {str(e)}'}), 500
 
 
+@app.route('/api/ask-batch', methods=['POST'])
+@app.route('/api/ask-batch/<int:document_id>', methods=['POST'])
+def ask_batch(document_id=None):
+    """Answer a list of questions about one document in a few model calls."""
+    data = request.get_json(silent=True) or {}
+    if document_id is None:
+        document_id = data.get('document_id')
+    if document_id is None:
+        return jsonify({'error': 'No document_id provided'}), 400
+
+    questions = data.get('questions')
+    if not isinstance(questions, list) or not questions or not all(
+            isinstance(question, str) and question.strip()
+            for question in questions):
+        return jsonify({
+            'error': 'Provide "questions" as a list of non-empty strings'
+        }), 400
+    if len(questions) > app.config['BATCH_MAX_QUESTIONS']:
+        return jsonify({
+            'error':
+            f"At most {app.config['BATCH_MAX_QUESTIONS']} questions per batch"
+        }), 400
+
+    document, error = ready_document(document_id)
+    if error:
+        payload, status = error
+        return jsonify(payload), status
+
+    try:
+        results, usage = qa_backend(document.backend).answer_questions(
+            document.index_id, questions)
+        return jsonify({
+            'document_id': document.id,
+            'document_name': document.filename,
+            'results': results,
+            'usage': usage
+        })
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        logger.error(f"Error answering batch: {str(e)}")
+        return jsonify({'error': f'Error processing questions: {str(e)}'}), 500
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/api/ask/stream', methods=['POST'])
+@app.route('/api/ask/<int:document_id>/stream', methods=['POST'])
+def ask_question_stream(document_id=None):
+    document, question, error_response = resolve_question_request(document_id)
+    if error_response:
+        return error_response
+
+    # Start generating before the response is committed, so a worker at
+    # capacity can still answer 503 rather than an error event
+    pieces, cached, first, error = iter(()), False, None, None
+    try:
+        pieces, cached = qa_backend(
+            document.backend).stream_query_document_cached(
+                document.index_id, question)
+        pieces = iter(pieces)
+        first = next(pieces, None)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        error = e
+
+    def generate():
+        try:
+            if error:
+                raise error
+            if first is not None:
+                yield sse_event('token', {'text': first})
+            for piece in pieces:
+                yield sse_event('token', {'text': piece})
+            yield sse_event(
+                'done', {
+                    'document_id': document.id,
+                    'document_name': document.filename,
+                    'cached': cached
+                })
+        except Exception as e:
+            logger.error(f"Error streaming answer: {str(e)}")
+            yield sse_event('error',
+                            {'error': f'Error processing question: {str(e)}'})
+
+    # Disable proxy buffering so tokens reach the browser as they are sent
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={
+                        'Cache-Control': 'no-cache',
+                        'X-Accel-Buffering': 'no'
+                    })
+
+
+def encode_cursor(document):
+    """Opaque position after a document in the newest-first list."""
+    position = f"{document.upload_date.isoformat()}|{document.id}"
+    return base64.urlsafe_b64encode(position.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Read a cursor from encode_cursor
+
+    Returns:
+        tuple: (upload_date, id)
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        upload_date, document_id = base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8').split('|')
+        return datetime.fromisoformat(upload_date), int(document_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor '{cursor}'")
+
+
 @app.route('/api/documents', methods=['GET'])
 def get_documents():
-    documents = Document.query.order_by(Document.upload_date.desc()).all()
+    """
+    List documents newest first, one page at a time.
+
+    Pages are read with a keyset on (upload_date, id) rather than an offset,
+    so every page costs the same however deep it is. Pass the returned
+    next_cursor as ?cursor= for the following page; it is null on the last
+    one. Responses carry an ETag, and If-None-Match gets a 304 while the
+    page is unchanged.
+    """
+    limit = request.args.get('limit', app.config['DOCUMENTS_PAGE_SIZE'],
+                             type=int)
+    if limit < 1:
+        return jsonify({'error': 'limit must be a positive integer'}), 400
+    limit = min(limit, app.config['DOCUMENTS_MAX_PAGE_SIZE'])
+
+    query = Document.query
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            upload_date, document_id = decode_cursor(cursor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        # The first condition alone is an index range scan
+        query = query.filter(
+            Document.upload_date <= upload_date,
+            db.or_(Document.upload_date < upload_date,
+                   Document.id < document_id))
+
+    documents = query.order_by(Document.upload_date.desc(),
+                               Document.id.desc()).limit(limit + 1).all()
     docs_list = [{
         'id': doc.id,
         'filename': doc.filename,
-        'upload_date': doc.upload_date.strftime('%Y-%m-%d %H:%M:%S')
-    } for doc in documents]
-    return jsonify({'documents': docs_list})
+        'upload_date': doc.upload_date.strftime('%Y-%m-%d %H:%M:%S'),
+        'status': doc.status,
+        'version': doc.version,
+        'previous_version_id': doc.previous_version_id
+    } for doc in documents[:limit]]
+    response = jsonify({
+        'documents':
+        docs_list,
+        'next_cursor':
+        encode_cursor(documents[limit - 1])
+        if len(documents) > limit else None
+    })
+    # Clients revalidate every time, and an unchanged page costs no transfer
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/api/documents/<int:document_id>/versions', methods=['GET'])
+def get_document_versions(document_id):
+    document = db.session.get(Document, document_id)
+
+    if not document:
+        return jsonify({'error':
+                        f'Document with ID {document_id} not found'}), 404
+
+    return jsonify({
+        'document_id': document_id,
+        'versions': [{
+            'id': doc.id,
+            'filename': doc.filename,
+            'version': doc.version,
+            'upload_date': doc.upload_date.strftime('%Y-%m-%d %H:%M:%S'),
+            'status': doc.status,
+            'changed_pages': load_changed_pages(os.path.join(STORAGE_DIR, doc.index_id))
+            if doc.index_id else None
+        } for doc in version_chain(document)]
+    })
+
+
+@app.route('/api/documents/<int:document_id>', methods=['DELETE'])
+def delete_document(document_id):
+    document = db.session.get(Document, document_id)
+
+    if not document:
+        return jsonify({'error':
+                        f'Document with ID {document_id} not found'}), 404
+
+    # A worker holds the rows of a queued or running job until it finishes
+    active_jobs = IngestionJob.query.filter(
+        IngestionJob.document_id == document_id,
+        IngestionJob.status.in_(('queued', 'running'))).count()
+    if active_jobs:
+        return jsonify({
+            'error':
+            f'Document is still being ingested (status: {document.status}); delete it once it is ready',
+            'status': document.status
+        }), 409
+
+    index_id = document.index_id
+    filepath = document.filepath
+    IngestionJob.query.filter_by(document_id=document_id).delete()
+    # Keep the version chain intact around the removed revision
+    Document.query.filter_by(previous_version_id=document_id).update(
+        {'previous_version_id': document.previous_version_id})
+    db.session.delete(document)
+    db.session.commit()
+
+    if session.get('current_document_id') == document_id:
+        session.pop('current_document_id')
+
+    # Other uploads of the same content may still use the index and file
+    freed_bytes = 0
+    if index_id and index_ref_count(index_id) == 0:
+        freed_bytes += remove_index(index_id)
+    if filepath and Document.query.filter_by(filepath=filepath).count() == 0:
+        freed_bytes += remove_upload(filepath)
+
+    return jsonify({
+        'success': True,
+        'document_id': document_id,
+        'freed_bytes': freed_bytes
+    })
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = db.session.get(IngestionJob, job_id)
+
+    if not job:
+        return jsonify({'error': f'Job with ID {job_id} not found'}), 404
+
+    return jsonify({
+        'id': job.id,
+        'document_id': job.document_id,
+        'status': job.status,
+        'error': job.error,
+        'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'started_at': job.started_at.strftime('%Y-%m-%d %H:%M:%S')
+        if job.started_at else None,
+        'finished_at': job.finished_at.strftime('%Y-%m-%d %H:%M:%S')
+        if job.finished_at else None
+    })
 
 
 @app.route('/api/select-document/<int:document_id>', methods=['POST'])
@@ -233,7 +1318,7 @@ def select_document(document_id):
     logger.debug(
         f"Selecting document with ID: {document_id}, session before: {session}"
     )
-    document = Document.query.get(document_id)
+    document = db.session.get(Document, document_id)
 
     if not document:
         logger.error(f"Document not found with ID: {document_id}")
@@ -0,0 +1,304 @@
+"""
+ASGI entry point: answers questions on an asyncio event loop.
+
+    uvicorn asgi:app --workers 2
+
+POST /api/ask/<id> and POST /api/ask/<id>/stream are served natively with
+the backends' async query APIs, so a question waiting on the LLM holds no
+thread and a few processes can keep hundreds of questions in flight. Unlike
+the Flask routes they do not record the document in the session cookie;
+the pages that read it are served by Flask. Every other request is passed
+to the Flask app from app.py, run on a thread pool.
+main.py remains the WSGI entry point for gunicorn and `flask run`.
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from app import (app as flask_app, ensure_db, ingestion_queue, storage_compactor, request_profiler, qa_backend,
+                 question_document, sse_event)
+from utils.metrics import metrics, begin_request_timing, request_timings, server_timing_header
+from utils.profiler import current_profile_id
+from utils.model_clients import Overloaded, set_client_key, iterate_in_thread
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# Threads for Flask requests and blocking work such as index loads
+ASGI_THREADS = int(os.environ.get("ASGI_THREADS", 64))
+
+ASK_ROUTE = re.compile(r"^/api/ask/(\d+)(/stream)?$")
+
+class RequestTooLarge(Exception):
+    pass
+
+async def read_body(receive, limit):
+    """Read the whole request body, refusing more than limit bytes."""
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise asyncio.CancelledError()
+        body += message.get("body", b"")
+        if limit and len(body) > limit:
+            raise RequestTooLarge()
+        if not message.get("more_body"):
+            return bytes(body)
+
+async def send_json(send, status, payload, headers=()):
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] +
+                   [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+def timing_headers(start):
+    headers = [("x-profile-id", current_profile_id())] if current_profile_id() else []
+    if not flask_app.config['TIMING_HEADER']:
+        return headers
+    return headers + [("server-timing", server_timing_header(request_timings(), time.perf_counter() - start))]
+
+def prepare_process():
+    """What Flask's before_request does once per process."""
+    ensure_db()
+    ingestion_queue.ensure_started()
+    storage_compactor.ensure_started()
+
+def lookup_document(document_id, question):
+    """question_document() inside an app context, returning plain values."""
+    with flask_app.app_context():
+        document, error = question_document(document_id, question)
+        if error:
+            return None, error
+        return {"id": document.id, "filename": document.filename, "index_id": document.index_id,
+                "backend": document.backend}, None
+
+async def ask(send, document, question, start):
+    try:
+        answer, cached = await qa_backend(document["backend"]).aquery_document_cached(document["index_id"], question)
+    except Overloaded as e:
+        await send_json(send, 503, {"error": str(e)}, [("retry-after", str(e.retry_after))])
+        return 503
+    except Exception as e:
+        logger.error(f"Error querying document: {str(e)}")
+        await send_json(send, 500, {"error": f"Error processing question: {str(e)}"}, timing_headers(start))
+        return 500
+    await send_json(send, 200, {
+        "answer": answer,
+        "document_id": document["id"],
+        "document_name": document["filename"],
+        "cached": cached
+    }, timing_headers(start))
+    return 200
+
+async def ask_stream(send, document, question, start):
+    # Start generating before the response is committed, so a worker at
+    # capacity can still answer 503 rather than an error event
+    pieces, cached, first, error = None, False, None, None
+    try:
+        pieces, cached = await qa_backend(document["backend"]).astream_query_document_cached(
+            document["index_id"], question)
+        first = await anext(pieces, None)
+    except Overloaded as e:
+        await send_json(send, 503, {"error": str(e)}, [("retry-after", str(e.retry_after))])
+        return 503
+    except Exception as e:
+        error = e
+
+    headers = [("content-type", "text/event-stream"), ("cache-control", "no-cache"),
+               ("x-accel-buffering", "no")] + timing_headers(start)
+    await send({"type": "http.response.start", "status": 200,
+                "headers": [(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers]})
+
+    async def event(name, data):
+        await send({"type": "http.response.body", "body": sse_event(name, data).encode("utf-8"), "more_body": True})
+
+    try:
+        if error:
+            raise error
+        if first is not None:
+            await event("token", {"text": first})
+            async for piece in pieces:
+                await event("token", {"text": piece})
+        await event("done", {"document_id": document["id"], "document_name": document["filename"],
+                             "cached": cached})
+    except Exception as e:
+        logger.error(f"Error streaming answer: {str(e)}")
+        await event("error", {"error": f"Error processing question: {str(e)}"})
+    finally:
+        # On a disconnect the task is cancelled between pieces; stop
+        # generating rather than leave the model call running
+        if hasattr(pieces, "aclose"):
+            await pieces.aclose()
+    await send({"type": "http.response.body", "body": b""})
+    return 200
+
+async def cancel_on_disconnect(receive, task):
+    """Cancel a request's task if its client goes away, freeing its model call slot."""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            task.cancel()
+            return
+
+async def handle_ask(scope, receive, send, document_id, stream):
+    start = time.perf_counter()
+    # The work of one question is spread over the event loop and pool
+    # threads, so its profile samples every thread, other requests' included
+    profile = request_profiler.start(scope["path"], dict(scope["headers"]).get(b"x-profile", b"").decode("latin-1"))
+    begin_request_timing()
+    # Waiting model calls are served round-robin across clients
+    set_client_key((scope.get("client") or [None])[0])
+    status = 500
+    try:
+        try:
+            data = json.loads(await read_body(receive, flask_app.config['MAX_CONTENT_LENGTH']) or b"{}")
+        except RequestTooLarge:
+            status = 413
+            await send_json(send, status, {"error": "Request body too large"})
+            return
+        except ValueError:
+            data = {}
+        if not isinstance(data, dict):
+            data = {}
+
+        await asyncio.to_thread(prepare_process)
+        question = data.get("question")
+        document, error = await asyncio.to_thread(lookup_document, document_id, question)
+        if error:
+            payload, status = error
+            await send_json(send, status, payload)
+            return
+
+        watcher = asyncio.create_task(cancel_on_disconnect(receive, asyncio.current_task()))
+        try:
+            status = await (ask_stream if stream else ask)(send, document, question, start)
+        except asyncio.CancelledError:
+            if not watcher.done():
+                raise
+            asyncio.current_task().uncancel()
+            status = 499
+            logger.debug("Client disconnected before the answer was complete")
+        finally:
+            watcher.cancel()
+    finally:
+        endpoint = 'ask_question_stream' if stream else 'ask_question'
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - start,
+                        'Time to handle an HTTP request', endpoint=endpoint, method='POST', status=status)
+        if profile is not None:
+            await asyncio.to_thread(request_profiler.finish, profile, method='POST', path=scope["path"],
+                                    endpoint=endpoint, status=status)
+
+def wsgi_environ(scope, body):
+    """Build a WSGI environ for an ASGI HTTP request."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name, value = name.decode("latin-1"), value.decode("latin-1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+async def call_flask(scope, receive, send):
+    """Serve a request with the Flask app on a worker thread, streaming its response."""
+    try:
+        # Flask rejects bodies over MAX_CONTENT_LENGTH itself; this only bounds buffering
+        body = await read_body(receive, flask_app.config['MAX_CONTENT_LENGTH'] + 1024 * 1024)
+    except RequestTooLarge:
+        await send_json(send, 413, {"error": "Request body too large"})
+        return
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+    def run():
+        result = flask_app(wsgi_environ(scope, body), start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    yield chunk
+        finally:
+            # Runs Flask's teardown, e.g. closing the database session
+            if hasattr(result, "close"):
+                result.close()
+
+    started = False
+    chunks = iterate_in_thread(run())
+    # A streamed response, e.g. /api/ask/stream, stops when its client goes away
+    watcher = asyncio.create_task(cancel_on_disconnect(receive, asyncio.current_task()))
+    try:
+        async for chunk in chunks:
+            if not started:
+                await send({"type": "http.response.start", "status": response["status"],
+                            "headers": response["headers"]})
+                started = True
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    except asyncio.CancelledError:
+        if not watcher.done():
+            raise
+        asyncio.current_task().uncancel()
+        logger.debug("Client disconnected before the response was complete")
+        return
+    finally:
+        watcher.cancel()
+        await chunks.aclose()
+    if not started:
+        await send({"type": "http.response.start", "status": response["status"], "headers": response["headers"]})
+    await send({"type": "http.response.body", "body": b""})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            asyncio.get_running_loop().set_default_executor(
+                ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix="asgi"))
+            await asyncio.to_thread(prepare_process)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    match = ASK_ROUTE.match(scope["path"]) if scope["method"] == "POST" else None
+    if match:
+        await handle_ask(scope, receive, send, int(match.group(1)), stream=bool(match.group(2)))
+    else:
+        await call_flask(scope, receive, send)
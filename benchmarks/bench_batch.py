@@ -0,0 +1,115 @@
+"""
+Compare answering a list of questions one at a time against /api/ask-batch.
+
+For each backend and synthetic PDF size, the same questions are answered
+with one query_document call each and then with a single answer_questions
+call, against the fake model service with the answer cache disabled. Each
+stage reports wall time, model calls and tokens sent; the batch stage also
+reports its own usage estimate, including the estimated cost.
+
+Usage:
+    python -m benchmarks.bench_batch --pages 2,50 --questions 50 --output benchmarks/results/batch.json
+"""
+import os
+import time
+import argparse
+import tempfile
+from benchmarks.common import make_synthetic_pdf, peak_rss_mb, run_metadata, write_results, compare_results
+from benchmarks.fakes import FakeModelService
+from benchmarks.bench_pipeline import isolate_storage
+
+def make_questions(count, pages, lines_per_page=45):
+    """Distinct questions about clauses spread over the synthetic document."""
+    return [f"What does clause {i * pages // count}.{(i * 7) % lines_per_page} set?" for i in range(count)]
+
+def stage_result(backend_name, pages, stage, questions, seconds, service, usage=None):
+    snapshot = service.snapshot()
+    run = {
+        "benchmark": "batch",
+        "backend": backend_name,
+        "pages": pages,
+        "stage": stage,
+        "samples": 1,
+        "questions": len(questions),
+        "latency_ms": {"p50": seconds * 1000, "p90": seconds * 1000, "p99": seconds * 1000},
+        "throughput": {"value": len(questions) / seconds, "unit": "questions/s"},
+        "llm_calls": snapshot["llm_calls"],
+        "embed_calls": snapshot["embed_calls"],
+        "tokens_sent": snapshot["tokens_sent"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if usage is not None:
+        run["usage"] = usage
+    return run
+
+def bench_document(backend_name, backend, pdf_path, pages, questions, service):
+    from utils.pdf_processor import extract_pages_from_pdf, join_pages
+
+    page_texts = extract_pages_from_pdf(pdf_path)
+    index_id = backend.process_document(join_pages(page_texts), "synthetic.pdf", pages=page_texts)
+    # Load the index, so neither stage pays for it
+    backend.query_document(index_id, questions[0])
+
+    service.reset()
+    start = time.perf_counter()
+    for question in questions:
+        backend.query_document(index_id, question)
+    runs = [stage_result(backend_name, pages, "sequential", questions, time.perf_counter() - start, service)]
+
+    service.reset()
+    start = time.perf_counter()
+    results, usage = backend.answer_questions(index_id, questions)
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for result in results if result["answer"] is None)
+    if failed:
+        print(f"warning: {failed} batch questions were not answered")
+    runs.append(stage_result(backend_name, pages, "batch", questions, elapsed, service, usage))
+    return runs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", default="2,50", help="Comma-separated synthetic PDF sizes")
+    parser.add_argument("--backends", default="gemini_direct,llama_index")
+    parser.add_argument("--questions", type=int, default=50, help="Questions per document")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Simulated seconds per LLM call")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="Simulated seconds per embedding request")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    # Read when the backends are first imported; every question should reach the model
+    os.environ["ANSWER_CACHE_ENABLED"] = "false"
+    os.environ.setdefault("CORPUS_INDEX_ENABLED", "false")
+    from utils.backends import get_backend
+
+    service = FakeModelService(llm_latency=args.llm_latency, embed_latency=args.embed_latency).install()
+    results = {"meta": run_metadata(args), "runs": []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for backend_name in args.backends.split(","):
+            backend = get_backend(backend_name)
+            isolate_storage(backend, os.path.join(tmp_dir, backend_name))
+            for pages in (int(value) for value in args.pages.split(",")):
+                pdf_path = os.path.join(tmp_dir, f"synthetic-{pages}.pdf")
+                if not os.path.exists(pdf_path):
+                    make_synthetic_pdf(pdf_path, pages)
+                questions = make_questions(args.questions, pages)
+                results["runs"].extend(bench_document(backend_name, backend, pdf_path, pages, questions, service))
+
+    print(f"{'backend':<14} {'pages':>5} {'stage':<11} {'wall ms':>9} {'llm calls':>9} {'embed calls':>11} "
+          f"{'tokens sent':>11}")
+    for run in results["runs"]:
+        print(f"{run['backend']:<14} {run['pages']:>5} {run['stage']:<11} {run['latency_ms']['p50']:>9.1f} "
+              f"{run['llm_calls']:>9} {run['embed_calls']:>11} {run['tokens_sent']:>11}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Throughput of `flask bulk-ingest` with different worker pool sizes.
+
+A directory of distinct synthetic PDFs is ingested once per configuration,
+given as <extract workers>x<index workers>, into scratch upload and index
+folders with the fake model service installed. 1x1 processes one document
+at a time, like the upload worker queue with a single thread. The rows
+written are removed after each run, so every configuration indexes the
+same documents from scratch.
+
+Usage:
+    python -m benchmarks.bench_bulk_ingest --documents 200 --workers 1x1,4x4,8x8
+"""
+import os
+import argparse
+import tempfile
+from benchmarks.common import make_synthetic_pdf, peak_rss_mb, run_metadata, write_results, compare_results
+from benchmarks.fakes import FakeModelService
+from benchmarks.bench_pipeline import isolate_storage
+
+def make_documents(directory, count, pages):
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        # Varying lengths keep the content, and so the content hashes, distinct
+        make_synthetic_pdf(os.path.join(directory, f"bench-{i:05d}.pdf"), pages + i % 3, lines_per_page=40 + i % 7)
+
+def remove_documents(filepaths):
+    import app as flask_app
+    from models import db, Document
+    with flask_app.app.app_context():
+        Document.query.filter(Document.filepath.in_(filepaths)).delete(synchronize_session=False)
+        db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=5, help="Pages per synthetic PDF")
+    parser.add_argument("--workers", default="1x1,4x4,8x8",
+                        help="Comma-separated <extract workers>x<index workers> configurations")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Simulated seconds per LLM call")
+    parser.add_argument("--embed-latency", type=float, default=0.1, help="Simulated seconds per embedding request")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    os.environ.setdefault("CORPUS_INDEX_ENABLED", "false")
+    import app as flask_app
+    from utils.bulk_ingest import iter_sources, bulk_ingest
+
+    service = FakeModelService(llm_latency=args.llm_latency, embed_latency=args.embed_latency).install()
+    results = {"meta": run_metadata(args), "runs": []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source = os.path.join(tmp_dir, "pdfs")
+        make_documents(source, args.documents, args.pages)
+        sources = iter_sources(source)
+        flask_app.ensure_db()
+
+        for configuration in args.workers.split(","):
+            extract_workers, index_workers = (int(value) for value in configuration.split("x"))
+            run_dir = os.path.join(tmp_dir, configuration)
+            upload_folder = os.path.join(run_dir, "uploads")
+            os.makedirs(upload_folder)
+            isolate_storage(flask_app.qa_backend(), os.path.join(run_dir, "storage"))
+
+            service.reset()
+            with flask_app.app.app_context():
+                summary = bulk_ingest(sources, flask_app.index_pages, upload_folder,
+                                      extract_workers=extract_workers, index_workers=index_workers,
+                                      batch_size=args.batch_size)
+            remove_documents([os.path.join(upload_folder, name) for name in os.listdir(upload_folder)])
+
+            seconds = summary["elapsed_seconds"]
+            results["runs"].append({
+                "benchmark": "bulk_ingest",
+                "backend": flask_app.app.config['QA_BACKEND'],
+                "pages": args.pages,
+                "stage": configuration,
+                "samples": 1,
+                "documents": summary["ingested"],
+                "failed": summary["failed"],
+                "latency_ms": {"p50": seconds * 1000, "p90": seconds * 1000, "p99": seconds * 1000},
+                "throughput": {"value": summary["docs_per_minute"], "unit": "docs/min"},
+                "pages_per_minute": summary["pages_per_minute"],
+                "embed_calls": service.snapshot()["embed_calls"],
+                "peak_rss_mb": peak_rss_mb(),
+            })
+
+    print(f"{'workers':<8} {'docs':>6} {'seconds':>8} {'docs/min':>9} {'pages/min':>10} {'embed calls':>11}")
+    for run in results["runs"]:
+        print(f"{run['stage']:<8} {run['documents']:>6} {run['latency_ms']['p50'] / 1000:>8.1f} "
+              f"{run['throughput']['value']:>9.1f} {run['pages_per_minute']:>10.1f} {run['embed_calls']:>11}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
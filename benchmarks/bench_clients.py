@@ -0,0 +1,158 @@
+"""
+Exercise the model client manager against a local stand-in Gemini server.
+
+The app is served in-process with its real Gemini SDK clients pointed at
+benchmarks.gemini_stub over REST, so connection reuse, the per-worker
+concurrency limit, fair queueing and 503 load shedding all run for real
+while the upstream stays deterministic. For each client concurrency the
+harness reports answered, shed (503) and failed requests, latency, and what
+the upstream saw: TCP connections opened, peak requests in flight and 429s.
+
+Usage:
+    python -m benchmarks.bench_clients --concurrency 1,8,64 --requests 200 --upstream-limit 16
+    # The same load without admission control, for comparison
+    python -m benchmarks.bench_clients --concurrency 64 --max-concurrency 0
+    # Served by uvicorn through asgi.py (REST has no asyncio client, so model calls run on threads)
+    python -m benchmarks.bench_clients --concurrency 64 --asgi
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.common import latency_summary, run_metadata, write_results, compare_results
+from benchmarks.fakes import FakeModelService
+from benchmarks.gemini_stub import GeminiStubServer
+from benchmarks.bench_pipeline import QUESTIONS
+
+def ask(base_url, document_id, question, stream):
+    """
+    Send one question and wait for the full answer.
+
+    Returns:
+        tuple: (seconds, HTTP status)
+    """
+    suffix = "/stream" if stream else ""
+    request = urllib.request.Request(
+        f"{base_url}/api/ask/{document_id}{suffix}",
+        data=json.dumps({"question": question}).encode("utf-8"),
+        headers={"Content-Type": "application/json"}, method="POST")
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            body = response.read()
+            status = 500 if stream and b"event: error" in body else response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except (urllib.error.URLError, OSError):
+        status = None
+    return time.perf_counter() - start, status
+
+def run_level(base_url, document_id, concurrency, total_requests, stream, stub, service):
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def one(i):
+        # Unique questions, so every request reaches the model
+        question = f"{QUESTIONS[i % len(QUESTIONS)]} (request {i})"
+        elapsed, status = ask(base_url, document_id, question, stream)
+        with lock:
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200:
+                latencies.append(elapsed)
+
+    stub.reset()
+    service.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total_requests)))
+    wall = time.perf_counter() - start
+
+    return {
+        "benchmark": "clients",
+        "stage": "ask_stream" if stream else "ask",
+        "concurrency": concurrency,
+        "samples": len(latencies),
+        "answered": statuses.get(200, 0),
+        "shed_503": statuses.get(503, 0),
+        "failed": sum(count for status, count in statuses.items() if status not in (200, 503)),
+        "latency_ms": latency_summary(latencies),
+        "throughput": {"value": len(latencies) / wall, "unit": "requests/s"},
+        "upstream": stub.snapshot(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", default="1,8,64", help="Comma-separated client thread counts")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per concurrency level")
+    parser.add_argument("--backend", default="gemini_direct", help="QA_BACKEND to serve questions with")
+    parser.add_argument("--stream", action="store_true", help="Use the Server-Sent Events endpoint")
+    parser.add_argument("--asgi", action="store_true", help="Serve the app with uvicorn via asgi.py")
+    parser.add_argument("--pages", type=int, default=5, help="Size of the test document")
+    parser.add_argument("--llm-latency", type=float, default=0.1, help="Simulated seconds per LLM call")
+    parser.add_argument("--upstream-limit", type=int, default=16,
+                        help="Concurrent requests the stand-in accepts before answering 429; 0 for no limit")
+    parser.add_argument("--max-concurrency", type=int, help="MODEL_MAX_CONCURRENCY for the app")
+    parser.add_argument("--queue-size", type=int, help="MODEL_QUEUE_SIZE for the app")
+    parser.add_argument("--queue-timeout", type=float, help="MODEL_QUEUE_TIMEOUT for the app")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    service = FakeModelService(llm_latency=args.llm_latency, embed_latency=0.005)
+    stub = GeminiStubServer(service, max_concurrent=args.upstream_limit or None)
+    stub_url = stub.start()
+
+    # Read by the app's modules when they are first imported
+    os.environ.update({
+        "GEMINI_API_ENDPOINT": stub_url,
+        "GEMINI_TRANSPORT": "rest",
+        "GOOGLE_API_KEY": os.environ.get("GOOGLE_API_KEY", "stand-in"),
+        "QA_BACKEND": args.backend,
+        "ANSWER_CACHE_ENABLED": "false",
+        "CORPUS_INDEX_ENABLED": "false",
+        "EMBED_REQUESTS_PER_SECOND": os.environ.get("EMBED_REQUESTS_PER_SECOND", "1000"),
+    })
+    for option, variable in (("max_concurrency", "MODEL_MAX_CONCURRENCY"), ("queue_size", "MODEL_QUEUE_SIZE"),
+                             ("queue_timeout", "MODEL_QUEUE_TIMEOUT")):
+        if getattr(args, option) is not None:
+            os.environ[variable] = str(getattr(args, option))
+
+    from benchmarks.bench_load import start_local_app, remove_local_document
+    from utils.model_clients import model_limiter
+
+    results = {"meta": run_metadata(args), "runs": []}
+    results["meta"]["limiter"] = {"max_concurrency": model_limiter.limit, "queue_size": model_limiter.max_queue,
+                                  "queue_timeout": model_limiter.timeout}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server, base_url, document_id = start_local_app(tmp_dir, args.pages, asgi=args.asgi)
+        try:
+            for concurrency in (int(value) for value in args.concurrency.split(",")):
+                run = run_level(base_url, document_id, concurrency, args.requests, args.stream, stub, service)
+                results["runs"].append(run)
+                latency = run["latency_ms"] or {"p50": 0, "p90": 0}
+                upstream = run["upstream"]
+                print(f"concurrency {concurrency:>4}: answered {run['answered']:>4}  503 {run['shed_503']:>4}  "
+                      f"failed {run['failed']:>4}  p50 {latency['p50']:8.1f}ms  p90 {latency['p90']:8.1f}ms | "
+                      f"upstream connections {upstream['connections']:>3}  peak {upstream['peak_in_flight']:>3}  "
+                      f"429 {upstream['rejected_429']:>4}")
+        finally:
+            server.shutdown()
+            remove_local_document(document_id)
+            stub.shutdown()
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
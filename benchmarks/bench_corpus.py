@@ -0,0 +1,108 @@
+"""
+Library search latency and recall as the corpus index grows.
+
+Synthetic documents of clustered, normalized vectors are added to a
+CorpusIndex one at a time, as ingestion does. At each size in --vectors the
+search latency is measured with the default nprobe, and recall@10 against
+exact search over every vector. Documents are removed at --removed share to
+exercise the removed-document filter. Reported with the index's lists and
+the vectors still in the unsorted tail.
+
+Usage:
+    python -m benchmarks.bench_corpus --vectors 50000,200000 --output benchmarks/results/corpus.json
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+from benchmarks.common import latency_summary, peak_rss_mb, run_metadata, write_results, compare_results
+from utils.corpus_index import CorpusIndex
+from utils.vector_store import write_vector_store
+
+def make_vectors(rng, centers, rows):
+    """Vectors scattered around random topic centers, like chunk embeddings of related documents."""
+    topics = rng.integers(len(centers), size=rows)
+    vectors = centers[topics] + rng.normal(scale=0.6, size=(rows, centers.shape[1])).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--vectors", default="50000,200000", help="Comma-separated index sizes")
+    parser.add_argument("--rows", type=int, default=500, help="Vectors per document")
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--removed", type=float, default=0.05, help="Share of documents removed")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(256, args.dimension)).astype(np.float32)
+    queries = make_vectors(rng, centers, args.queries)
+    results = {"meta": run_metadata(args), "runs": []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = CorpusIndex(os.path.join(tmp_dir, ".corpus"))
+        stores, removed, document = {}, set(), 0
+        for target in sorted(int(value) for value in args.vectors.split(",")):
+            start = time.perf_counter()
+            while sum(len(vectors) for vectors in stores.values()) < target:
+                index_id = f"doc-{document:06d}"
+                vectors = make_vectors(rng, centers, args.rows)
+                write_vector_store(os.path.join(tmp_dir, index_id), vectors,
+                                   [{"id": f"{index_id}:{i}", "text": ""} for i in range(args.rows)])
+                index.add_index(index_id, os.path.join(tmp_dir, index_id))
+                stores[index_id] = vectors
+                if rng.random() < args.removed:
+                    index.remove_index(index_id)
+                    removed.add(index_id)
+                document += 1
+            add_seconds = time.perf_counter() - start
+
+            live = [index_id for index_id in stores if index_id not in removed]
+            matrix = np.concatenate([stores[index_id] for index_id in live])
+            labels = [(index_id, position) for index_id in live for position in range(len(stores[index_id]))]
+
+            index.search(queries[0])
+            samples, recalls = [], []
+            for query in queries:
+                start = time.perf_counter()
+                hits = index.search(query, top_k=10)
+                samples.append(time.perf_counter() - start)
+                expected = {labels[i] for i in np.argsort(-(matrix @ query))[:10]}
+                recalls.append(len(expected & {(index_id, position) for index_id, position, _ in hits}) / 10)
+
+            stats = index.stats()
+            results["runs"].append({
+                "benchmark": "corpus",
+                "backend": "corpus_index",
+                "pages": target,
+                "stage": "search",
+                "samples": len(samples),
+                "vectors": stats["vectors"],
+                "lists": stats["lists"],
+                "unsorted": stats["unsorted"],
+                "recall_at_10": sum(recalls) / len(recalls),
+                "add_seconds": add_seconds,
+                "latency_ms": latency_summary(samples),
+                "throughput": {"value": len(samples) / sum(samples), "unit": "searches/s"},
+                "peak_rss_mb": peak_rss_mb(),
+            })
+
+    print(f"{'vectors':>9} {'lists':>6} {'unsorted':>8} {'search p50 ms':>13} {'p99 ms':>8} {'recall@10':>9}")
+    for run in results["runs"]:
+        print(f"{run['vectors']:>9} {run['lists']:>6} {run['unsorted']:>8} {run['latency_ms']['p50']:>13.2f} "
+              f"{run['latency_ms']['p99']:>8.2f} {run['recall_at_10']:>9.2f}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Document listing, lookup and concurrent write latency of the database layer.
+
+A scratch SQLite database (or the database in --database-url) is seeded
+with synthetic Document rows. Stages:
+
+- first_page / deep_page: GET /api/documents for the first page, and for a
+  page reached by following next_cursor most of the way through the list
+- not_modified: the first page again with If-None-Match
+- lookup: primary key lookups of random documents, as /api/ask does
+- concurrent_insert: Document rows inserted one per transaction from
+  several processes at once, as uploads to separate gunicorn workers are
+
+Usage:
+    python -m benchmarks.bench_db --documents 100000 --output benchmarks/results/db.json
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+from datetime import datetime, timedelta
+from benchmarks.common import latency_summary, peak_rss_mb, run_metadata, write_results, compare_results
+
+def stage_result(stage, documents, samples, unit="requests/s", errors=0):
+    return {
+        "benchmark": "db",
+        "backend": "n/a",
+        "pages": documents,
+        "stage": stage,
+        "samples": len(samples),
+        "errors": errors,
+        "latency_ms": latency_summary(samples),
+        "throughput": {"value": len(samples) / sum(samples) if samples else 0.0, "unit": unit},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def seed(count):
+    import app as flask_app
+    from models import db, Document
+
+    flask_app.ensure_db()
+    start = datetime(2024, 1, 1)
+    with flask_app.app.app_context():
+        existing = Document.query.count()
+        rows = []
+        for i in range(existing, count):
+            # Batches of uploads share a timestamp, which the cursor must handle
+            rows.append({"filename": f"doc-{i}.pdf", "filepath": f"/tmp/doc-{i}.pdf", "index_id": f"index-{i}",
+                         "upload_date": start + timedelta(seconds=i // 3), "status": "ready",
+                         "content_hash": f"{i:064x}", "version": 1})
+            if len(rows) == 10000:
+                db.session.execute(db.insert(Document), rows)
+                rows = []
+        if rows:
+            db.session.execute(db.insert(Document), rows)
+        db.session.commit()
+
+def insert_worker(count, results):
+    import app as flask_app
+    from models import db, Document
+
+    samples, errors = [], 0
+    with flask_app.app.app_context():
+        for i in range(count):
+            start = time.perf_counter()
+            try:
+                db.session.add(Document(filename=f"upload-{os.getpid()}-{i}.pdf", filepath="/tmp/upload.pdf",
+                                        upload_date=datetime.utcnow(), status='queued'))
+                db.session.commit()
+                samples.append(time.perf_counter() - start)
+            except Exception:
+                db.session.rollback()
+                errors += 1
+    results.put((samples, errors))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per read stage")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--writers", type=int, default=4, help="Processes inserting at once")
+    parser.add_argument("--inserts", type=int, default=200, help="Inserts per writer process")
+    parser.add_argument("--database-url", help="Database to use instead of a scratch SQLite file")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Read when app.py is imported, here and in the writer processes
+        os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+        seed(args.documents)
+
+        import app as flask_app
+        client = flask_app.app.test_client()
+        results = {"meta": run_metadata(args), "runs": []}
+
+        def timed_get(url, headers=None):
+            start = time.perf_counter()
+            response = client.get(url, headers=headers)
+            return time.perf_counter() - start, response
+
+        samples = [timed_get(f"/api/documents?limit={args.page_size}")[0] for _ in range(args.requests)]
+        results["runs"].append(stage_result("first_page", args.documents, samples))
+
+        # Walk to a page near the end of the list
+        cursor, pages = None, 0
+        while pages < args.documents // args.page_size - 1:
+            data = client.get(f"/api/documents?limit={args.page_size}" + (f"&cursor={cursor}" if cursor else "")).json
+            if not data["next_cursor"]:
+                break
+            cursor, pages = data["next_cursor"], pages + 1
+        deep = f"/api/documents?limit={args.page_size}&cursor={cursor}"
+        samples = [timed_get(deep)[0] for _ in range(args.requests)]
+        results["runs"].append(stage_result("deep_page", args.documents, samples))
+
+        etag = client.get(f"/api/documents?limit={args.page_size}").headers["ETag"]
+        timings = [timed_get(f"/api/documents?limit={args.page_size}", {"If-None-Match": etag})
+                   for _ in range(args.requests)]
+        errors = sum(1 for _, response in timings if response.status_code != 304)
+        results["runs"].append(stage_result("not_modified", args.documents, [t for t, _ in timings], errors=errors))
+
+        from models import db, Document
+        samples = []
+        with flask_app.app.app_context():
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                db.session.get(Document, random.randint(1, args.documents))
+                samples.append(time.perf_counter() - start)
+                # Each request starts with an empty identity map
+                db.session.expunge_all()
+        results["runs"].append(stage_result("lookup", args.documents, samples, unit="lookups/s"))
+
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        writers = [context.Process(target=insert_worker, args=(args.inserts, queue)) for _ in range(args.writers)]
+        for writer in writers:
+            writer.start()
+        samples, errors = [], 0
+        for _ in writers:
+            writer_samples, writer_errors = queue.get()
+            samples.extend(writer_samples)
+            errors += writer_errors
+        for writer in writers:
+            writer.join()
+        results["runs"].append(stage_result("concurrent_insert", args.documents, samples, unit="inserts/s",
+                                            errors=errors))
+
+    print(f"{'stage':<18} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    for run in results["runs"]:
+        print(f"{run['stage']:<18} {run['latency_ms'].get('p50', 0):>8.2f} {run['latency_ms'].get('p99', 0):>8.2f} "
+              f"{run['errors']:>6}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Ingest throughput and retrieval recall with remote and local embeddings.
+
+Distinct synthetic contracts (see bench_retrieval) are ingested by each
+backend with the fake model service installed. Stages:
+
+- remote: passages embedded through the (fake) Gemini API, paced by
+  EMBED_REQUESTS_PER_SECOND and delayed --embed-latency per request
+- local: EMBEDDING_BACKEND=local with the NumPy hashing model
+- remote_cached: the same documents ingested again remotely with a warm
+  embedding cache
+
+Reported per stage: passages embedded per second at ingest, embedding
+requests sent, question embedding latency and, for llama_index, recall of
+the labeled questions with vector-only retrieval.
+
+Usage:
+    python -m benchmarks.bench_embedding --documents 10 --pages 20 --output benchmarks/results/embedding.json
+"""
+import os
+import time
+import argparse
+import tempfile
+from benchmarks.common import latency_summary, peak_rss_mb, run_metadata, write_results, compare_results
+from benchmarks.fakes import FakeModelService
+from benchmarks.bench_pipeline import isolate_storage
+from benchmarks.bench_retrieval import make_qa_document, make_questions, evaluate
+
+STAGES = ["remote", "local", "remote_cached"]
+
+def use_local_embeddings(backend, enabled, fake_embedding_model):
+    """Switch a loaded backend between the fake Gemini embeddings and the local model."""
+    backend.LOCAL_EMBEDDINGS = enabled
+    if hasattr(backend, "LocalEmbedding"):
+        from utils.local_embedding import local_model_id, LOCAL_EMBEDDING_BATCH_SIZE
+        local_model = backend.LocalEmbedding(model_name=local_model_id(), embed_batch_size=LOCAL_EMBEDDING_BATCH_SIZE)
+        backend.get_embedding_model = (lambda: local_model) if enabled else (lambda: fake_embedding_model)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=10)
+    parser.add_argument("--pages", type=int, default=20, help="Pages per synthetic contract")
+    parser.add_argument("--questions", type=int, default=40, help="Labeled questions for the recall check")
+    parser.add_argument("--backends", default="gemini_direct,llama_index")
+    parser.add_argument("--embed-latency", type=float, default=0.1, help="Simulated seconds per embedding request")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    # Read when the backends are first imported; the hashing model needs no download
+    os.environ["ANSWER_CACHE_ENABLED"] = "false"
+    os.environ.setdefault("LOCAL_EMBEDDING_MODEL", "hashing")
+    from utils import local_embedding
+    from utils.backends import get_backend
+    from utils.vector_store import MemmapVectorStore
+    from utils.pdf_processor import extract_pages_from_pdf, join_pages
+
+    service = FakeModelService(llm_latency=0.0, embed_latency=args.embed_latency).install()
+    results = {"meta": run_metadata(args), "runs": []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        documents = []
+        for i in range(args.documents):
+            pdf_path = os.path.join(tmp_dir, f"contract-{i}.pdf")
+            make_qa_document(pdf_path, args.pages, seed=i)
+            documents.append(extract_pages_from_pdf(pdf_path))
+        qa_path = os.path.join(tmp_dir, "contract-qa.pdf")
+        questions = make_questions(make_qa_document(qa_path, args.pages), args.questions)
+
+        for backend_name in args.backends.split(","):
+            backend = get_backend(backend_name)
+            fake_embedding_model = getattr(backend, "get_embedding_model", lambda: None)()
+            for stage in STAGES:
+                storage_dir = os.path.join(tmp_dir, backend_name, stage)
+                isolate_storage(backend, storage_dir)
+                use_local_embeddings(backend, stage == "local", fake_embedding_model)
+                if stage == "remote_cached":
+                    # Warm a scratch cache, then measure the second ingest
+                    local_embedding.embedding_cache = local_embedding.EmbeddingCache(
+                        os.path.join(tmp_dir, f"{backend_name}-embeddings.db"))
+                    local_embedding.EMBEDDING_CACHE_ENABLED = True
+                    for i, pages in enumerate(documents):
+                        backend.process_document(join_pages(pages), f"contract-{i}.pdf", pages=pages)
+                try:
+                    service.reset()
+                    start = time.perf_counter()
+                    index_ids = [backend.process_document(join_pages(pages), f"contract-{i}.pdf", pages=pages)
+                                 for i, pages in enumerate(documents)]
+                    ingest_seconds = time.perf_counter() - start
+                    ingest = service.snapshot()
+                    passages = sum(len(MemmapVectorStore(os.path.join(storage_dir, index_id)))
+                                   for index_id in index_ids)
+
+                    samples = []
+                    for question, _ in questions:
+                        start = time.perf_counter()
+                        backend.embed_question(question)
+                        samples.append(time.perf_counter() - start)
+
+                    recall = None
+                    if backend_name == "llama_index" and stage != "remote_cached":
+                        default_mode, backend.RETRIEVAL_MODE = backend.RETRIEVAL_MODE, "vector"
+                        try:
+                            recall = evaluate(backend_name, backend, stage, qa_path, questions, service)["recall"]
+                        finally:
+                            backend.RETRIEVAL_MODE = default_mode
+                finally:
+                    use_local_embeddings(backend, False, fake_embedding_model)
+                    local_embedding.EMBEDDING_CACHE_ENABLED = False
+
+                results["runs"].append({
+                    "benchmark": "embedding",
+                    "backend": backend_name,
+                    "pages": args.pages,
+                    "stage": stage,
+                    "samples": len(samples),
+                    "passages": passages,
+                    "passages_per_second": passages / ingest_seconds,
+                    "ingest_embed_calls": ingest["embed_calls"],
+                    "vector_recall": recall,
+                    "latency_ms": latency_summary(samples),
+                    "throughput": {"value": passages / ingest_seconds, "unit": "passages/s"},
+                    "peak_rss_mb": peak_rss_mb(),
+                })
+
+    print(f"{'backend':<14} {'stage':<14} {'passages/s':>10} {'embed calls':>11} {'question p50 ms':>15} "
+          f"{'recall':>6}")
+    for run in results["runs"]:
+        recall = f"{run['vector_recall']:.2f}" if run["vector_recall"] is not None else "-"
+        print(f"{run['backend']:<14} {run['stage']:<14} {run['passages_per_second']:>10.1f} "
+              f"{run['ingest_embed_calls']:>11} {run['latency_ms']['p50']:>15.2f} {recall:>6}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Compare serial and page-parallel PDF text extraction.
+
+Usage:
+    python -m benchmarks.bench_extract --pages 1000 --workers 4
+"""
+import os
+import time
+import argparse
+import tempfile
+from utils.pdf_processor import extract_text_from_pdf, iter_pdf_pages
+from benchmarks.common import make_synthetic_pdf
+
+def time_call(fn, repeat):
+    """Return the best wall time over several runs, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "synthetic.pdf")
+        make_synthetic_pdf(pdf_path, args.pages)
+
+        # Warm the pool so worker start-up is not billed to the first run
+        next(iter_pdf_pages(pdf_path, args.workers))
+
+        serial = time_call(lambda: extract_text_from_pdf(pdf_path, workers=1), args.repeat)
+        parallel = time_call(lambda: extract_text_from_pdf(pdf_path, workers=args.workers), args.repeat)
+
+        # Time until the first page is available to downstream stages
+        start = time.perf_counter()
+        next(iter_pdf_pages(pdf_path, args.workers))
+        first_page = time.perf_counter() - start
+
+        assert extract_text_from_pdf(pdf_path, workers=1) == extract_text_from_pdf(pdf_path, workers=args.workers)
+
+    print(f"pages:               {args.pages}")
+    print(f"serial:              {serial:.3f}s ({args.pages / serial:.0f} pages/s)")
+    print(f"parallel ({args.workers} procs): {parallel:.3f}s ({args.pages / parallel:.0f} pages/s)")
+    print(f"speedup:             {serial / parallel:.2f}x")
+    print(f"first page (stream): {first_page * 1000:.1f}ms")
+
+if __name__ == "__main__":
+    main()
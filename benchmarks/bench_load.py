@@ -0,0 +1,213 @@
+"""
+Concurrent load test of the question endpoints of the Flask app.
+
+By default the app is served in-process on a local port with the fake model
+service installed, and a synthetic PDF is ingested for the test and removed
+afterwards. With --asgi it is served by uvicorn through asgi.py, which
+answers questions on an event loop, instead of the threaded WSGI server.
+With --url, requests go to an already running server instead and
+--document-id picks the document to ask about.
+
+Usage:
+    python -m benchmarks.bench_load --concurrency 1,8,32 --requests 200 \
+        --output benchmarks/results/load.json
+    python -m benchmarks.bench_load --asgi --concurrency 64,256 --max-concurrency 256
+    python -m benchmarks.bench_load --url http://localhost:5000 --document-id 3 --stream
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from benchmarks.common import (make_synthetic_pdf, latency_summary, peak_rss_mb, run_metadata,
+                               write_results, compare_results)
+from benchmarks.fakes import FakeModelService
+from benchmarks.bench_pipeline import QUESTIONS
+
+def ask(base_url, document_id, question, stream):
+    """
+    Send one question and wait for the full answer.
+
+    Returns:
+        tuple: (total seconds, seconds to the first byte of the answer, ok)
+    """
+    suffix = "/stream" if stream else ""
+    request = urllib.request.Request(
+        f"{base_url}/api/ask/{document_id}{suffix}",
+        data=json.dumps({"question": question}).encode("utf-8"),
+        headers={"Content-Type": "application/json"}, method="POST")
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            response.read(1)
+            first_byte = time.perf_counter() - start
+            body = response.read()
+            ok = response.status == 200 and (not stream or b"event: error" not in body)
+    except (urllib.error.URLError, OSError):
+        return time.perf_counter() - start, None, False
+    return time.perf_counter() - start, first_byte, ok
+
+def run_load(base_url, document_id, concurrency, total_requests, stream, unique_questions):
+    latencies, first_bytes, errors = [], [], 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        question = QUESTIONS[i % len(QUESTIONS)]
+        if unique_questions:
+            # Defeat the answer cache so every request reaches the model
+            question = f"{question} (request {i})"
+        elapsed, first_byte, ok = ask(base_url, document_id, question, stream)
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+                first_bytes.append(first_byte)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total_requests)))
+    wall = time.perf_counter() - start
+
+    return {
+        "benchmark": "load",
+        "stage": "ask_stream" if stream else "ask",
+        "concurrency": concurrency,
+        "samples": len(latencies),
+        "errors": errors,
+        "latency_ms": latency_summary(latencies),
+        "first_byte_ms": latency_summary(first_bytes),
+        "throughput": {"value": len(latencies) / wall, "unit": "requests/s"},
+    }
+
+class _UvicornServer:
+    """uvicorn serving asgi.py from a background thread, stopped like a WSGI server."""
+
+    def __init__(self):
+        import socket
+        import uvicorn
+        import asgi
+        self.socket = socket.socket()
+        self.socket.bind(("127.0.0.1", 0))
+        self.server_port = self.socket.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(asgi.app, log_level="warning", backlog=2048))
+        self.thread = threading.Thread(target=self.server.run, kwargs={"sockets": [self.socket]}, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+
+    def shutdown(self):
+        self.server.should_exit = True
+        self.thread.join()
+
+def start_local_app(tmp_dir, pages, asgi=False):
+    """Serve the app in a background thread with one ingested synthetic document."""
+    from werkzeug.serving import make_server
+    import app as flask_app
+    from models import db, Document
+    from utils.answer_cache import answer_cache
+    from utils.pdf_processor import extract_pages_from_pdf, join_pages
+    from benchmarks.bench_pipeline import isolate_storage
+
+    backend = flask_app.qa_backend()
+    isolate_storage(backend, os.path.join(tmp_dir, "storage"))
+    answer_cache.path = os.path.join(tmp_dir, "answer_cache.db")
+
+    pdf_path = os.path.join(tmp_dir, "synthetic.pdf")
+    make_synthetic_pdf(pdf_path, pages)
+    page_texts = extract_pages_from_pdf(pdf_path)
+    # Indexed directly rather than through ingest_document, which would also
+    # add the test document to the library-wide search index
+    index_id = backend.process_document(join_pages(page_texts), "benchmark.pdf", pages=page_texts)
+    flask_app.ensure_db()
+    with flask_app.app.app_context():
+        document = Document(filename="benchmark.pdf", filepath=pdf_path, index_id=index_id,
+                            backend=flask_app.app.config['QA_BACKEND'], status='ready')
+        db.session.add(document)
+        db.session.commit()
+        document_id = document.id
+
+    if asgi:
+        server = _UvicornServer()
+        server.start()
+    else:
+        server = make_server("127.0.0.1", 0, flask_app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}", document_id
+
+def remove_local_document(document_id):
+    import app as flask_app
+    from models import db, Document
+    with flask_app.app.app_context():
+        document = db.session.get(Document, document_id)
+        if document:
+            db.session.delete(document)
+            db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="Base URL of a running server; omit to serve the app in-process")
+    parser.add_argument("--document-id", type=int, help="Document to ask about with --url")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated client thread counts")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per concurrency level")
+    parser.add_argument("--stream", action="store_true", help="Use the Server-Sent Events endpoint")
+    parser.add_argument("--asgi", action="store_true", help="Serve the in-process app with uvicorn via asgi.py")
+    parser.add_argument("--max-concurrency", type=int, help="MODEL_MAX_CONCURRENCY for the in-process app")
+    parser.add_argument("--cached", action="store_true", help="Repeat questions so the answer cache is hit")
+    parser.add_argument("--pages", type=int, default=50, help="Size of the in-process test document")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Simulated seconds per LLM call")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="Simulated seconds per embedding request")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    if args.url and args.document_id is None:
+        parser.error("--document-id is required with --url")
+
+    results = {"meta": run_metadata(args), "runs": []}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server = document_id = None
+        if args.url:
+            base_url, document_id = args.url.rstrip("/"), args.document_id
+        else:
+            if args.max_concurrency is not None:
+                # Read when utils.model_clients is first imported
+                os.environ["MODEL_MAX_CONCURRENCY"] = str(args.max_concurrency)
+                os.environ.setdefault("MODEL_QUEUE_SIZE", str(max(args.max_concurrency, 32)))
+            FakeModelService(llm_latency=args.llm_latency, embed_latency=args.embed_latency).install()
+            server, base_url, document_id = start_local_app(tmp_dir, args.pages, asgi=args.asgi)
+
+        try:
+            for concurrency in (int(value) for value in args.concurrency.split(",")):
+                run = run_load(base_url, document_id, concurrency, args.requests, args.stream,
+                               unique_questions=not args.cached)
+                # Only meaningful when the server runs in this process
+                run["peak_rss_mb"] = None if args.url else peak_rss_mb()
+                results["runs"].append(run)
+                latency = run["latency_ms"] or {"p50": 0, "p90": 0, "p99": 0}
+                print(f"concurrency {concurrency:>4}: {run['throughput']['value']:7.1f} req/s  "
+                      f"p50 {latency['p50']:8.1f}ms  p90 {latency['p90']:8.1f}ms  "
+                      f"p99 {latency['p99']:8.1f}ms  errors {run['errors']}")
+        finally:
+            if server:
+                server.shutdown()
+                remove_local_document(document_id)
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""
+Measure extraction, ingest and query cost of both backends.
+
+Synthetic PDFs of each size are extracted, processed and queried against a
+deterministic fake LLM/embedding service (benchmarks.fakes), so the numbers
+reflect this code rather than network latency. Each stage reports latency
+percentiles, throughput, tokens sent to the models and peak RSS.
+
+Usage:
+    python -m benchmarks.bench_pipeline --pages 10,100 --backends gemini_direct,llama_index \
+        --output benchmarks/results/latest.json --compare benchmarks/results/baseline.json
+
+Embedding requests are paced by EMBED_REQUESTS_PER_SECOND as in production;
+set it in the environment to benchmark without the pacing.
+"""
+import os
+import time
+import argparse
+import tempfile
+from benchmarks.common import (make_synthetic_pdf, latency_summary, peak_rss_mb, run_metadata,
+                               write_results, compare_results)
+from benchmarks.fakes import FakeModelService
+from utils.backends import BACKENDS, get_backend
+
+QUESTIONS = [
+    "What sets the delivery deadline?",
+    "What does the quick brown fox jump over?",
+    "Which clause is on page 3, line 7?",
+    "Summarize the first page.",
+    "What happens in clause 2.14?",
+]
+
+def isolate_storage(backend, storage_dir):
+    """Point a backend at a scratch storage directory."""
+    backend.STORAGE_DIR = storage_dir
+    if hasattr(backend, "CHECKPOINT_DIR"):
+        backend.CHECKPOINT_DIR = os.path.join(storage_dir, ".checkpoints")
+
+def stage_result(backend_name, pages, stage, samples, service, throughput, unit):
+    usage = service.snapshot()
+    return {
+        "benchmark": "pipeline",
+        "backend": backend_name,
+        "pages": pages,
+        "stage": stage,
+        "samples": len(samples),
+        "latency_ms": latency_summary(samples),
+        "throughput": {"value": throughput, "unit": unit},
+        "tokens_sent": usage["tokens_sent"],
+        "tokens_per_call": usage["tokens_sent"] / len(samples),
+        "llm_calls": usage["llm_calls"],
+        "embed_calls": usage["embed_calls"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def bench_document(backend_name, backend, pdf_path, pages, args, service):
+    from utils.pdf_processor import extract_pages_from_pdf, join_pages
+
+    runs = []
+
+    samples = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        page_texts = extract_pages_from_pdf(pdf_path)
+        samples.append(time.perf_counter() - start)
+    service.reset()
+    runs.append(stage_result(backend_name, pages, "extract", samples, service,
+                             pages / min(samples), "pages/s"))
+
+    text = join_pages(page_texts)
+    samples = []
+    service.reset()
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        index_id = backend.process_document(text, "synthetic.pdf", pages=page_texts)
+        samples.append(time.perf_counter() - start)
+    runs.append(stage_result(backend_name, pages, "process", samples, service,
+                             pages / min(samples), "pages/s"))
+
+    # The first question loads the index into the per-process cache
+    service.reset()
+    start = time.perf_counter()
+    backend.query_document(index_id, QUESTIONS[0])
+    first = [time.perf_counter() - start]
+    runs.append(stage_result(backend_name, pages, "query_cold", first, service, 1 / first[0], "queries/s"))
+
+    samples = []
+    service.reset()
+    for i in range(args.queries):
+        start = time.perf_counter()
+        backend.query_document(index_id, QUESTIONS[i % len(QUESTIONS)])
+        samples.append(time.perf_counter() - start)
+    runs.append(stage_result(backend_name, pages, "query", samples, service,
+                             len(samples) / sum(samples), "queries/s"))
+
+    samples = []
+    service.reset()
+    for i in range(args.queries):
+        start = time.perf_counter()
+        pieces = backend.stream_query_document(index_id, QUESTIONS[i % len(QUESTIONS)])
+        next(iter(pieces))
+        samples.append(time.perf_counter() - start)
+        for _ in pieces:
+            pass
+    runs.append(stage_result(backend_name, pages, "first_token", samples, service,
+                             len(samples) / sum(samples), "queries/s"))
+    return runs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", default="10,100", help="Comma-separated synthetic PDF sizes")
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of the extract and process stages")
+    parser.add_argument("--queries", type=int, default=20, help="Questions per document")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Simulated seconds per LLM call")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="Simulated seconds per embedding request")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    service = FakeModelService(llm_latency=args.llm_latency, embed_latency=args.embed_latency).install()
+    results = {"meta": run_metadata(args), "runs": []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        from utils.answer_cache import answer_cache
+        answer_cache.path = os.path.join(tmp_dir, "answer_cache.db")
+
+        for backend_name in args.backends.split(","):
+            backend = get_backend(backend_name)
+            isolate_storage(backend, os.path.join(tmp_dir, backend_name))
+            for pages in (int(value) for value in args.pages.split(",")):
+                pdf_path = os.path.join(tmp_dir, f"synthetic-{pages}.pdf")
+                if not os.path.exists(pdf_path):
+                    make_synthetic_pdf(pdf_path, pages)
+                results["runs"].extend(bench_document(backend_name, backend, pdf_path, pages, args, service))
+
+    print(f"{'backend':<14} {'pages':>5} {'stage':<12} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+          f"{'throughput':>18} {'tokens/call':>11} {'rss MiB':>8}")
+    for run in results["runs"]:
+        latency = run["latency_ms"]
+        throughput = f"{run['throughput']['value']:.1f} {run['throughput']['unit']}"
+        print(f"{run['backend']:<14} {run['pages']:>5} {run['stage']:<12} {latency['p50']:>9.1f} "
+              f"{latency['p90']:>9.1f} {latency['p99']:>9.1f} {throughput:>18} {run['tokens_per_call']:>11.0f} "
+              f"{run['peak_rss_mb']:>8.0f}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Latency cost of profiling a request.
+
+The app is served in-process with the fake model service installed (see
+bench_load), and the same questions are asked without profiling, with an
+X-Profile header at each --intervals sampling interval, and while profiling
+is armed for another path, which is what every request pays when armed.
+
+Usage:
+    python -m benchmarks.bench_profiler --requests 100 --intervals 0.005,0.001 \
+        --output benchmarks/results/profiler.json
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import urllib.request
+from benchmarks.common import latency_summary, peak_rss_mb, run_metadata, write_results, compare_results
+from benchmarks.fakes import FakeModelService
+from benchmarks.bench_pipeline import QUESTIONS
+from benchmarks.bench_load import start_local_app, remove_local_document
+
+TOKEN = "benchmark"
+
+def ask(base_url, document_id, question, headers):
+    """Send one question; returns (seconds, profile id or None)."""
+    request = urllib.request.Request(
+        f"{base_url}/api/ask/{document_id}", data=json.dumps({"question": question}).encode("utf-8"),
+        headers=dict(headers, **{"Content-Type": "application/json"}), method="POST")
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=300) as response:
+        response.read()
+        return time.perf_counter() - start, response.headers.get("X-Profile-Id")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=100, help="Questions per stage")
+    parser.add_argument("--intervals", default="0.005,0.001", help="Comma-separated sampling intervals in seconds")
+    parser.add_argument("--pages", type=int, default=50, help="Size of the test document")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Simulated seconds per LLM call")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    # Read when app.py is first imported; every question should reach the model
+    os.environ["PROFILER_TOKEN"] = TOKEN
+    os.environ["ANSWER_CACHE_ENABLED"] = "false"
+    FakeModelService(llm_latency=args.llm_latency, embed_latency=0.0).install()
+    results = {"meta": run_metadata(args), "runs": []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        server, base_url, document_id = start_local_app(tmp_dir, args.pages)
+        import app as flask_app
+        profiler = flask_app.request_profiler
+        profiler.profile_dir = os.path.join(tmp_dir, "profiles")
+
+        stages = [("off", None, {}), ("armed_elsewhere", None, {})]
+        stages += [(f"profiled_{interval}", float(interval), {"X-Profile": TOKEN})
+                   for interval in args.intervals.split(",")]
+        try:
+            for label, interval, headers in stages:
+                if label == "armed_elsewhere":
+                    profiler.arm(3600, "/api/documents")
+                else:
+                    profiler.disarm()
+                if interval is not None:
+                    profiler.interval = interval
+                samples, profiled = [], 0
+                for i in range(args.requests):
+                    elapsed, profile_id = ask(base_url, document_id, f"{QUESTIONS[i % len(QUESTIONS)]} ({i})",
+                                              headers)
+                    samples.append(elapsed)
+                    profiled += profile_id is not None
+                written = profiler.list_profiles(limit=args.requests) if profiled else []
+                results["runs"].append({
+                    "benchmark": "profiler",
+                    "stage": label,
+                    "samples": len(samples),
+                    "profiled": profiled,
+                    "stack_samples_per_profile": (sum(p["samples"] for p in written) / len(written)
+                                                  if written else 0),
+                    "latency_ms": latency_summary(samples),
+                    "throughput": {"value": len(samples) / sum(samples), "unit": "requests/s"},
+                    "peak_rss_mb": peak_rss_mb(),
+                })
+        finally:
+            profiler.disarm()
+            server.shutdown()
+            remove_local_document(document_id)
+
+    baseline = results["runs"][0]["latency_ms"]["p50"]
+    for run in results["runs"]:
+        latency = run["latency_ms"]
+        print(f"{run['stage']:<18} p50 {latency['p50']:7.1f}ms ({(latency['p50'] / baseline - 1) * 100:+5.1f}%)  "
+              f"p99 {latency['p99']:7.1f}ms  profiled {run['profiled']:>4}  "
+              f"samples/profile {run['stack_samples_per_profile']:6.1f}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""
+Recall, prompt size and answer latency of the retrieval settings on a labeled QA set.
+
+The QA set is generated from a fixed seed. A synthetic contract has facts
+such as "Clause 12.3: the carrier shall deliver the solar inverters to Oslo
+within 14 days.", set among filler paragraphs that cite other clauses.
+Half the questions name a clause ("What does clause 12.3 require?") and
+half paraphrase a fact ("Within how many days must the solar inverters
+reach Oslo?"). A question counts as recalled when its fact is in the
+prompt sent to the model.
+
+Each configuration ingests the document and asks every question once
+against the fake model service. The service adds --prefill-latency
+seconds per 1000 prompt tokens, as a real model does.
+
+Usage:
+    python -m benchmarks.bench_retrieval --pages 40 --questions 60 --output benchmarks/results/retrieval.json
+"""
+import os
+import re
+import time
+import random
+import argparse
+import tempfile
+import fitz  # PyMuPDF
+from benchmarks.common import latency_summary, peak_rss_mb, run_metadata, write_results, compare_results
+from benchmarks.fakes import FakeModelService
+from benchmarks.bench_pipeline import isolate_storage
+
+PARTIES = ["the supplier", "the buyer", "the carrier", "the licensee", "the contractor", "the distributor"]
+ITEMS = ["turbine blades", "solar inverters", "copper cathodes", "steel girders", "lithium cells", "glass panels",
+         "server racks", "pump housings", "cable drums", "brake assemblies", "circuit boards", "valve bodies",
+         "rotor shafts", "fibre spools", "ceramic tiles", "gear boxes", "pallet jacks", "fuel filters",
+         "hydraulic hoses", "optical lenses", "timber beams", "wind masts", "cooling fans", "relay switches",
+         "bearing rings", "drill bits", "paint drums", "rubber seals", "sensor arrays", "battery packs"]
+CITIES = ["Oslo", "Lisbon", "Osaka", "Denver", "Nairobi", "Quito", "Tallinn", "Perth", "Halifax", "Porto",
+          "Lagos", "Hanoi", "Bergen", "Tucson", "Cairo", "Lyon", "Sapporo", "Dakar", "Leeds", "Malmo"]
+FILLER = ("party notice term agreement obligation remedy breach warranty payment invoice schedule period "
+          "termination liability indemnity confidential information dispute arbitration governing law "
+          "amendment assignment force majeure insurance audit records compliance reasonable written consent "
+          "prior effective date renewal default cure material adverse").split()
+FACTS_PER_PAGE = 3
+
+def make_qa_document(path, pages, seed=7):
+    """
+    Write the synthetic contract and return its labeled facts
+
+    Returns:
+        list: dicts with "clause", "item", "city", "days" and "text"
+    """
+    rng = random.Random(seed)
+    items = [f"{rng.choice(['grade A', 'grade B', 'coated', 'sealed', 'spare'])} {item}"
+             for item in ITEMS for _ in range(max(1, pages * FACTS_PER_PAGE // len(ITEMS) + 1))]
+    rng.shuffle(items)
+    facts = []
+    with fitz.open() as pdf_document:
+        for page_num in range(pages):
+            paragraphs = []
+            for k in range(1, FACTS_PER_PAGE + 1):
+                item = items.pop()
+                fact = {"clause": f"{page_num + 1}.{k}", "item": item, "city": rng.choice(CITIES),
+                        "days": rng.randint(3, 90), "party": rng.choice(PARTIES)}
+                fact["text"] = (f"Clause {fact['clause']}: {fact['party']} shall deliver the {item} to "
+                                f"{fact['city']} within {fact['days']} days.")
+                facts.append(fact)
+                filler = " ".join(rng.choice(FILLER) for _ in range(70))
+                reference = f"{rng.randint(1, pages)}.{rng.randint(1, FACTS_PER_PAGE)}"
+                paragraphs.append(f"{fact['text']} Subject to clause {reference}, the {filler}.")
+            page = pdf_document.new_page()
+            page.insert_textbox(fitz.Rect(36, 36, 576, 806), "\n\n".join(paragraphs), fontsize=8)
+        pdf_document.save(path)
+    return facts
+
+def make_questions(facts, count, seed=11):
+    """Labeled questions: (question, fact text) pairs, alternating exact-term and paraphrased."""
+    rng = random.Random(seed)
+    questions = []
+    for i, fact in enumerate(rng.sample(facts, min(count, len(facts)))):
+        if i % 2 == 0:
+            question = f"What does clause {fact['clause']} require?"
+        else:
+            question = f"Within how many days must the {fact['item']} reach {fact['city']}?"
+        questions.append((question, fact["text"]))
+    return questions
+
+def normalize(text):
+    return re.sub(r"\s+", " ", text)
+
+def evaluate(backend_name, backend, label, pdf_path, questions, service):
+    from utils.pdf_processor import extract_pages_from_pdf, join_pages
+
+    page_texts = extract_pages_from_pdf(pdf_path)
+    index_id = backend.process_document(join_pages(page_texts), "contract.pdf", pages=page_texts)
+    # Load the index, so no question pays for it
+    backend.query_document(index_id, questions[0][0])
+
+    service.reset()
+    samples, recalled, prompt_tokens = [], 0, []
+    for question, fact in questions:
+        start = time.perf_counter()
+        backend.query_document(index_id, question)
+        samples.append(time.perf_counter() - start)
+        recalled += normalize(fact) in normalize(service.last_prompt)
+        prompt_tokens.append(service.snapshot()["prompt_tokens"] - sum(prompt_tokens))
+    return {
+        "benchmark": "retrieval",
+        "backend": backend_name,
+        "pages": len(page_texts),
+        "stage": label,
+        "samples": len(samples),
+        "recall": recalled / len(questions),
+        "prompt_tokens_per_answer": sum(prompt_tokens) / len(prompt_tokens),
+        "latency_ms": latency_summary(samples),
+        "throughput": {"value": len(samples) / sum(samples), "unit": "answers/s"},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+# (label, module attributes) per backend; the first of each is the previous behaviour
+CONFIGURATIONS = {
+    "llama_index": [
+        ("vector", {"RETRIEVAL_MODE": "vector"}),
+        ("hybrid", {"RETRIEVAL_MODE": "hybrid"}),
+        ("hybrid-512", {"RETRIEVAL_MODE": "hybrid", "CHUNK_TOKENS": 512, "CHUNK_OVERLAP_TOKENS": 64,
+                        "CONTEXT_TOKENS": 1500}),
+    ],
+    "gemini_direct": [
+        ("retrieval", {"CONTEXT_MODE": "retrieval"}),
+    ],
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--questions", type=int, default=60)
+    parser.add_argument("--backends", default="llama_index,gemini_direct")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Simulated seconds per LLM call")
+    parser.add_argument("--prefill-latency", type=float, default=0.1,
+                        help="Simulated seconds per 1000 prompt tokens")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    # Read when the backends are first imported; every question should reach the model
+    os.environ["ANSWER_CACHE_ENABLED"] = "false"
+    os.environ.setdefault("CORPUS_INDEX_ENABLED", "false")
+    from utils.backends import get_backend
+
+    service = FakeModelService(llm_latency=args.llm_latency, embed_latency=0.0,
+                               prefill_latency=args.prefill_latency).install()
+    results = {"meta": run_metadata(args), "runs": []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "contract.pdf")
+        questions = make_questions(make_qa_document(pdf_path, args.pages), args.questions)
+        for backend_name in args.backends.split(","):
+            backend = get_backend(backend_name)
+            for label, settings in CONFIGURATIONS[backend_name]:
+                isolate_storage(backend, os.path.join(tmp_dir, backend_name, label))
+                defaults = {name: getattr(backend, name) for name in settings}
+                for name, value in settings.items():
+                    setattr(backend, name, value)
+                try:
+                    results["runs"].append(evaluate(backend_name, backend, label, pdf_path, questions, service))
+                finally:
+                    for name, value in defaults.items():
+                        setattr(backend, name, value)
+
+    print(f"{'backend':<14} {'stage':<11} {'recall':>6} {'prompt tokens':>13} {'p50 ms':>8}")
+    for run in results["runs"]:
+        print(f"{run['backend']:<14} {run['stage']:<11} {run['recall']:>6.2f} {run['prompt_tokens_per_answer']:>13.0f} "
+              f"{run['latency_ms']['p50']:>8.1f}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
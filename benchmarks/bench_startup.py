@@ -0,0 +1,85 @@
+"""
+Measure how long a fresh worker process takes to import the app and serve.
+
+Each sample runs in a new interpreter, like a newly forked gunicorn worker
+without --preload: it imports app, then serves a first lightweight request
+(GET /api/documents) and reports which heavy SDKs were loaded on the way.
+
+Usage:
+    python -m benchmarks.bench_startup --repeat 10 --output benchmarks/results/startup.json
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+from benchmarks.common import latency_summary, run_metadata, write_results, compare_results
+
+HEAVY_MODULES = ("google.generativeai", "llama_index.core", "sqlalchemy", "fitz", "numpy")
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+heavy_after_import = [name for name in {heavy!r} if name in sys.modules]
+modules_after_import = len(sys.modules)
+response = app.app.test_client().get("/api/documents")
+served = time.perf_counter()
+print(json.dumps({{
+    "import_s": imported - start,
+    "first_request_s": served - imported,
+    "ready_s": served - start,
+    "status": response.status_code,
+    "modules_after_import": modules_after_import,
+    "heavy_after_import": heavy_after_import,
+}}))
+"""
+
+def sample(repo_root):
+    code = PROBE.format(heavy=HEAVY_MODULES)
+    result = subprocess.run([sys.executable, "-c", code], cwd=repo_root, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    # The first run also warms the OS page cache and bytecode caches
+    sample(repo_root)
+    samples = [sample(repo_root) for _ in range(args.repeat)]
+
+    results = {"meta": run_metadata(args), "runs": []}
+    for stage in ("import", "first_request", "ready"):
+        results["runs"].append({
+            "benchmark": "startup",
+            "stage": stage,
+            "samples": len(samples),
+            "latency_ms": latency_summary([s[f"{stage}_s"] for s in samples]),
+        })
+    results["modules_after_import"] = samples[-1]["modules_after_import"]
+    results["heavy_after_import"] = samples[-1]["heavy_after_import"]
+
+    for run in results["runs"]:
+        latency = run["latency_ms"]
+        print(f"{run['stage']:<14} p50 {latency['p50']:8.1f}ms  p90 {latency['p90']:8.1f}ms  max {latency['max']:8.1f}ms")
+    print(f"modules loaded by import: {results['modules_after_import']}")
+    print(f"heavy SDKs loaded by import: {', '.join(results['heavy_after_import']) or 'none'}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
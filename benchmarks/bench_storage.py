@@ -0,0 +1,120 @@
+"""
+Disk footprint and cold-load cost of stored indexes.
+
+Distinct synthetic contracts (see bench_retrieval) are ingested into a
+scratch storage folder with the fake model service installed. Reported per
+backend:
+
+- bytes on disk per document, in total and per file
+- cold_load: the first question after the index cache was cleared, with the
+  bytes it read (rchar from /proc/self/io, Linux only)
+
+Run it on two checkouts to compare storage layouts.
+
+Usage:
+    python -m benchmarks.bench_storage --documents 20 --pages 40 --output benchmarks/results/storage.json
+"""
+import os
+import time
+import argparse
+import tempfile
+from collections import Counter
+from benchmarks.common import latency_summary, peak_rss_mb, run_metadata, write_results, compare_results
+from benchmarks.fakes import FakeModelService
+from benchmarks.bench_pipeline import isolate_storage
+from benchmarks.bench_retrieval import make_qa_document
+
+def bytes_read():
+    """Bytes this process has read so far, including from the page cache; None if unknown."""
+    try:
+        with open("/proc/self/io", "r") as f:
+            return int(next(line for line in f if line.startswith("rchar:")).split()[1])
+    except (OSError, StopIteration):
+        return None
+
+def footprint(storage_dir, index_ids):
+    """Bytes per file name across the given index directories."""
+    sizes = Counter()
+    for index_id in index_ids:
+        persist_dir = os.path.join(storage_dir, index_id)
+        for name in os.listdir(persist_dir):
+            sizes[name] += os.path.getsize(os.path.join(persist_dir, name))
+    return sizes
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=40, help="Pages per synthetic contract")
+    parser.add_argument("--backends", default="gemini_direct,llama_index")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    # Read when the backends are first imported; every question should load its index
+    os.environ["ANSWER_CACHE_ENABLED"] = "false"
+    from utils.backends import get_backend, BACKENDS
+    from utils.pdf_processor import extract_pages_from_pdf, join_pages
+
+    FakeModelService(llm_latency=0.0, embed_latency=0.0).install()
+    results = {"meta": run_metadata(args), "runs": []}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        documents = []
+        for i in range(args.documents):
+            pdf_path = os.path.join(tmp_dir, f"contract-{i}.pdf")
+            make_qa_document(pdf_path, args.pages, seed=i)
+            documents.append(extract_pages_from_pdf(pdf_path))
+
+        for backend_name in args.backends.split(","):
+            backend = get_backend(backend_name)
+            storage_dir = os.path.join(tmp_dir, backend_name)
+            isolate_storage(backend, storage_dir)
+            cache = getattr(backend, BACKENDS[backend_name][1])
+
+            index_ids = [backend.process_document(join_pages(pages), f"contract-{i}.pdf", pages=pages)
+                         for i, pages in enumerate(documents)]
+            sizes = footprint(storage_dir, index_ids)
+
+            samples, read = [], []
+            for index_id in index_ids:
+                cache.clear()
+                before = bytes_read()
+                start = time.perf_counter()
+                backend.query_document(index_id, "What does clause 3.2 require?")
+                samples.append(time.perf_counter() - start)
+                if before is not None:
+                    read.append(bytes_read() - before)
+
+            results["runs"].append({
+                "benchmark": "storage",
+                "backend": backend_name,
+                "pages": args.pages,
+                "stage": "cold_load",
+                "samples": len(samples),
+                "bytes_per_document": sum(sizes.values()) / len(index_ids),
+                "files": {name: size / len(index_ids) for name, size in sorted(sizes.items())},
+                "bytes_read_per_load": sum(read) / len(read) if read else None,
+                "latency_ms": latency_summary(samples),
+                "throughput": {"value": len(samples) / sum(samples), "unit": "loads/s"},
+                "peak_rss_mb": peak_rss_mb(),
+            })
+
+    for run in results["runs"]:
+        read = run["bytes_read_per_load"]
+        print(f"{run['backend']}: {run['bytes_per_document'] / 1024:.1f} KB/document on disk, "
+              f"{read / 1024 if read is not None else float('nan'):.1f} KB read per cold load, "
+              f"p50 {run['latency_ms']['p50']:.1f} ms")
+        for name, size in run["files"].items():
+            print(f"    {name:<28} {size / 1024:>9.1f} KB")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+"""
+Prompt size of summary questions as documents grow, with and without the summary tree.
+
+For each length in --pages, a synthetic contract (see bench_retrieval) gets
+an outline of articles ten pages long, each with two subsections, and is
+ingested by gemini_direct with the fake model service installed. Each
+question asks for a summary of one article ("Summarize article 7") or of
+the whole document. Stages:
+
+- full: the whole document in every prompt (GEMINI_DIRECT_CONTEXT_MODE=full)
+- retrieval: BM25 passages within the token budget, without a tree
+- tree: summaries routed down the summary tree
+
+"routed" is the share of article questions whose prompt holds that
+article's summary. Ingest model calls are reported as the tree's cost.
+
+Usage:
+    python -m benchmarks.bench_summary_tree --pages 50,100,200,400 --output benchmarks/results/summary_tree.json
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import fitz  # PyMuPDF
+from benchmarks.common import latency_summary, peak_rss_mb, run_metadata, write_results, compare_results
+from benchmarks.fakes import FakeModelService
+from benchmarks.bench_pipeline import isolate_storage
+from benchmarks.bench_retrieval import make_qa_document
+
+ARTICLE_PAGES = 10
+
+def make_outlined_document(path, pages):
+    """Write the synthetic contract with an outline; returns the number of articles."""
+    make_qa_document(path, pages)
+    articles = (pages + ARTICLE_PAGES - 1) // ARTICLE_PAGES
+    toc = []
+    for article in range(articles):
+        first = article * ARTICLE_PAGES + 1
+        toc.append([1, f"Article {article + 1}: Deliveries", first])
+        toc.append([2, f"{article + 1}.1 Schedule", first])
+        toc.append([2, f"{article + 1}.2 Remedies", min(pages, first + ARTICLE_PAGES // 2)])
+    with fitz.open(path) as pdf_document:
+        pdf_document.set_toc(toc)
+        pdf_document.saveIncr()
+    return articles
+
+# (label, gemini_direct attributes, build the tree)
+STAGES = [
+    ("full", {"CONTEXT_MODE": "full"}, False),
+    ("retrieval", {"CONTEXT_MODE": "retrieval"}, False),
+    ("tree", {"CONTEXT_MODE": "retrieval"}, True),
+]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--pages", default="50,100,200,400", help="Comma-separated document lengths")
+    parser.add_argument("--questions", type=int, default=10, help="Article questions per document")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per LLM call")
+    parser.add_argument("--output", help="Write results to this JSON file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown reported as a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if anything regressed")
+    args = parser.parse_args()
+
+    # Read when the backends are first imported; every question should reach the model
+    os.environ["ANSWER_CACHE_ENABLED"] = "false"
+    os.environ.setdefault("CORPUS_INDEX_ENABLED", "false")
+    from utils import summary_tree
+    from utils.backends import get_backend
+    from utils.pdf_processor import extract_pages_from_pdf, extract_outline, join_pages
+
+    service = FakeModelService(llm_latency=args.llm_latency, embed_latency=0.0).install()
+    backend = get_backend("gemini_direct")
+    results = {"meta": run_metadata(args), "runs": []}
+    rng = random.Random(3)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for pages_count in (int(value) for value in args.pages.split(",")):
+            pdf_path = os.path.join(tmp_dir, f"contract-{pages_count}.pdf")
+            articles = make_outlined_document(pdf_path, pages_count)
+            pages, outline = extract_pages_from_pdf(pdf_path), extract_outline(pdf_path)
+            targets = [rng.randint(1, articles) for _ in range(args.questions)]
+            questions = [(f"Summarize article {target}", f"Summary of Article {target}:") for target in targets]
+            questions.append(("Give an overview of the document", None))
+
+            for label, settings, with_tree in STAGES:
+                isolate_storage(backend, os.path.join(tmp_dir, f"{pages_count}-{label}"))
+                defaults = {name: getattr(backend, name) for name in settings}
+                for name, value in settings.items():
+                    setattr(backend, name, value)
+                summary_tree.SUMMARY_TREE_ENABLED = with_tree
+                try:
+                    service.reset()
+                    index_id = backend.process_document(join_pages(pages), "contract.pdf", pages=pages,
+                                                        outline=outline)
+                    ingest = service.snapshot()
+                    backend.query_document(index_id, questions[0][0])
+
+                    samples, prompt_tokens, routed = [], [], 0
+                    for question, expected in questions:
+                        service.reset()
+                        start = time.perf_counter()
+                        backend.query_document(index_id, question)
+                        samples.append(time.perf_counter() - start)
+                        prompt_tokens.append(service.snapshot()["prompt_tokens"])
+                        routed += expected is not None and expected in service.last_prompt
+                finally:
+                    for name, value in defaults.items():
+                        setattr(backend, name, value)
+
+                results["runs"].append({
+                    "benchmark": "summary_tree",
+                    "backend": "gemini_direct",
+                    "pages": pages_count,
+                    "stage": label,
+                    "samples": len(samples),
+                    "prompt_tokens_per_answer": sum(prompt_tokens) / len(prompt_tokens),
+                    "max_prompt_tokens": max(prompt_tokens),
+                    "routed": routed / args.questions,
+                    "ingest_llm_calls": ingest["llm_calls"],
+                    "ingest_prompt_tokens": ingest["prompt_tokens"],
+                    "latency_ms": latency_summary(samples),
+                    "throughput": {"value": len(samples) / sum(samples), "unit": "answers/s"},
+                    "peak_rss_mb": peak_rss_mb(),
+                })
+
+    print(f"{'pages':>5} {'stage':<10} {'prompt tokens':>13} {'max':>7} {'routed':>6} {'ingest calls':>12}")
+    for run in results["runs"]:
+        print(f"{run['pages']:>5} {run['stage']:<10} {run['prompt_tokens_per_answer']:>13.0f} "
+              f"{run['max_prompt_tokens']:>7} {run['routed']:>6.2f} {run['ingest_llm_calls']:>12}")
+
+    if args.output:
+        write_results(args.output, results)
+    if args.compare:
+        regressions = compare_results(args.compare, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Helpers shared by the benchmark scripts: synthetic PDFs, latency
+statistics, peak RSS and JSON results that can be compared between runs.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import numpy as np
+import fitz  # PyMuPDF
+
+def make_synthetic_pdf(path, pages, lines_per_page=45):
+    """Write a text-heavy PDF with the given number of pages."""
+    with fitz.open() as pdf_document:
+        for page_num in range(pages):
+            page = pdf_document.new_page()
+            body = "\n".join(
+                f"Page {page_num + 1}, line {line}: the quick brown fox jumps over the lazy dog "
+                f"while clause {page_num}.{line} sets the delivery deadline."
+                for line in range(lines_per_page))
+            page.insert_textbox(fitz.Rect(36, 36, 576, 806), body, fontsize=8)
+        pdf_document.save(path)
+
+def latency_summary(samples):
+    """Percentiles of a list of durations in seconds, reported in milliseconds."""
+    if not samples:
+        return {}
+    values = np.asarray(samples) * 1000
+    return {
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "mean": float(values.mean()),
+        "max": float(values.max()),
+    }
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_metadata(args):
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+    }
+
+def write_results(path, results):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {path}")
+
+def result_key(run):
+    """Fields that identify the same measurement across two result files."""
+    return tuple(run.get(field) for field in ("benchmark", "backend", "pages", "stage", "concurrency"))
+
+def compare_results(baseline_path, results, threshold=0.10):
+    """
+    Print latency and throughput changes against an earlier results file.
+
+    Args:
+        threshold (float): Relative p50 slowdown reported as a regression
+
+    Returns:
+        list: Keys of the measurements that regressed
+    """
+    with open(baseline_path, "r") as f:
+        baseline = {result_key(run): run for run in json.load(f)["runs"]}
+
+    regressions = []
+    print(f"\ncompared with {baseline_path}:")
+    for run in results["runs"]:
+        before = baseline.get(result_key(run))
+        if not before or not before.get("latency_ms") or not run.get("latency_ms"):
+            continue
+        old_p50, new_p50 = before["latency_ms"]["p50"], run["latency_ms"]["p50"]
+        change = (new_p50 - old_p50) / old_p50 if old_p50 else 0.0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(result_key(run))
+        label = " ".join(str(part) for part in result_key(run) if part is not None)
+        print(f"  {label:<45} p50 {old_p50:9.1f}ms -> {new_p50:9.1f}ms ({change:+.0%})"
+              f"{'  REGRESSION' if regressed else ''}")
+    return regressions
@@ -0,0 +1,238 @@
+"""
+Deterministic local stand-ins for the Gemini LLM and embedding APIs.
+
+FakeModelService.install() patches google.generativeai and the LlamaIndex
+model factories, so both backends run unchanged without network access.
+Every call sleeps for a fixed simulated latency, optionally plus time per
+prompt token, and is counted, together with the estimated tokens sent, so
+results are comparable between runs.
+"""
+import time
+import json
+import zlib
+import asyncio
+import threading
+from typing import Any
+import numpy as np
+from utils.bm25 import TOKEN_PATTERN, estimate_tokens
+
+class _Text:
+    """Mimics the .text attribute of a Gemini response or stream chunk."""
+
+    def __init__(self, text):
+        self.text = text
+
+class FakeModelService:
+    """
+    Fake LLM and embedding service with call and token counters.
+
+    Embeddings are hashed bag-of-words vectors, so retrieval still ranks
+    passages that share words with the question first.
+    """
+
+    def __init__(self, llm_latency=0.05, embed_latency=0.02, dimension=768, answer_words=40, prefill_latency=0.0):
+        """
+        Args:
+            prefill_latency (float): Extra seconds before the first token per
+                1000 prompt tokens, as a real model spends reading the prompt
+        """
+        self.llm_latency = llm_latency
+        self.prefill_latency = prefill_latency
+        self.last_prompt = None
+        self.embed_latency = embed_latency
+        self.dimension = dimension
+        self.answer = " ".join(["answer"] * answer_words)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.llm_calls = 0
+            self.prompt_tokens = 0
+            self.embed_calls = 0
+            self.embed_texts = 0
+            self.embed_tokens = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "llm_calls": self.llm_calls,
+                "prompt_tokens": self.prompt_tokens,
+                "embed_calls": self.embed_calls,
+                "embed_texts": self.embed_texts,
+                "embed_tokens": self.embed_tokens,
+                "tokens_sent": self.prompt_tokens + self.embed_tokens,
+            }
+
+    def embed(self, texts):
+        """Embed a batch of texts as one simulated request."""
+        with self._lock:
+            self.embed_calls += 1
+            self.embed_texts += len(texts)
+            self.embed_tokens += sum(estimate_tokens(text) for text in texts)
+        time.sleep(self.embed_latency)
+        return [self._vector(text) for text in texts]
+
+    async def aembed(self, texts):
+        """embed() for the SDKs' asyncio clients."""
+        with self._lock:
+            self.embed_calls += 1
+            self.embed_texts += len(texts)
+            self.embed_tokens += sum(estimate_tokens(text) for text in texts)
+        await asyncio.sleep(self.embed_latency)
+        return [self._vector(text) for text in texts]
+
+    def _vector(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            vector[zlib.crc32(token.encode("utf-8")) % self.dimension] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _record_prompt(self, prompt):
+        """Count a prompt; returns the simulated seconds before the first token."""
+        tokens = estimate_tokens(prompt)
+        with self._lock:
+            self.llm_calls += 1
+            self.prompt_tokens += tokens
+            self.last_prompt = prompt
+        return tokens / 1000 * self.prefill_latency
+
+    def _reply(self, prompt):
+        """
+        The canned answer, or a JSON array of them for a batch prompt
+        (utils.batch_qa) or a page summary prompt (utils.summary_tree)
+        """
+        if not prompt.rstrip().endswith("JSON:"):
+            return self.answer
+        if "\nQuestions:\n" in prompt:
+            count = len(prompt.split("\nQuestions:\n", 1)[1].split("\n\n", 1)[0].splitlines())
+        else:
+            count = prompt.count("\n[Page ")
+        return json.dumps([{"id": number, "answer": self.answer} for number in range(1, count + 1)])
+
+    def complete(self, prompt):
+        prefill = self._record_prompt(prompt)
+        time.sleep(prefill + self.llm_latency)
+        return self._reply(prompt)
+
+    def stream(self, prompt):
+        """Yield the answer word by word: half the latency before the first word, the rest spread out."""
+        prefill = self._record_prompt(prompt)
+        words = self.answer.split(" ")
+        time.sleep(prefill + self.llm_latency / 2)
+        for i, word in enumerate(words):
+            time.sleep(self.llm_latency / 2 / len(words))
+            yield word if i == 0 else " " + word
+
+    async def acomplete(self, prompt):
+        prefill = self._record_prompt(prompt)
+        await asyncio.sleep(prefill + self.llm_latency)
+        return self._reply(prompt)
+
+    async def astream(self, prompt):
+        prefill = self._record_prompt(prompt)
+        words = self.answer.split(" ")
+        await asyncio.sleep(prefill + self.llm_latency / 2)
+        for i, word in enumerate(words):
+            await asyncio.sleep(self.llm_latency / 2 / len(words))
+            yield word if i == 0 else " " + word
+
+    def install(self):
+        """Route both backends' model calls to this service."""
+        import google.generativeai as genai
+        service = self
+
+        class FakeGenerativeModel:
+            def __init__(self, *args, **kwargs):
+                pass
+
+            def generate_content(self, prompt, stream=False, **kwargs):
+                if stream:
+                    return (_Text(piece) for piece in service.stream(prompt))
+                return _Text(service.complete(prompt))
+
+            async def generate_content_async(self, prompt, stream=False, **kwargs):
+                if stream:
+                    return (_Text(piece) async for piece in service.astream(prompt))
+                return _Text(await service.acomplete(prompt))
+
+        def embed_content(model=None, content=None, **kwargs):
+            if isinstance(content, str):
+                return {"embedding": service.embed([content])[0]}
+            return {"embedding": service.embed(list(content))}
+
+        async def embed_content_async(model=None, content=None, **kwargs):
+            if isinstance(content, str):
+                return {"embedding": (await service.aembed([content]))[0]}
+            return {"embedding": await service.aembed(list(content))}
+
+        genai.GenerativeModel = FakeGenerativeModel
+        genai.embed_content = embed_content
+        genai.embed_content_async = embed_content_async
+
+        # Fake vectors must not be written to, or served from, the real embedding cache
+        from utils import local_embedding
+        local_embedding.EMBEDDING_CACHE_ENABLED = False
+
+        try:
+            from utils import llama_index_helper
+        except ImportError:
+            return self
+        llm, embed_model = self._llama_index_models()
+        llama_index_helper.get_llm = lambda: llm
+        llama_index_helper.get_embedding_model = lambda: embed_model
+        return self
+
+    def _llama_index_models(self):
+        from llama_index.core.llms import CustomLLM, CompletionResponse, LLMMetadata
+        from llama_index.core.llms.callbacks import llm_completion_callback
+        from llama_index.core.embeddings import BaseEmbedding
+        service = self
+
+        class FakeLLM(CustomLLM):
+            @property
+            def metadata(self):
+                return LLMMetadata(context_window=1000000, num_output=256, model_name="fake")
+
+            @llm_completion_callback()
+            def complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+                return CompletionResponse(text=service.complete(prompt))
+
+            @llm_completion_callback()
+            def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+                text = ""
+                for piece in service.stream(prompt):
+                    text += piece
+                    yield CompletionResponse(text=text, delta=piece)
+
+            @llm_completion_callback()
+            async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+                return CompletionResponse(text=await service.acomplete(prompt))
+
+            @llm_completion_callback()
+            async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+                async def gen():
+                    text = ""
+                    async for piece in service.astream(prompt):
+                        text += piece
+                        yield CompletionResponse(text=text, delta=piece)
+                return gen()
+
+        class FakeEmbedding(BaseEmbedding):
+            def _get_query_embedding(self, query):
+                return service.embed([query])[0]
+
+            async def _aget_query_embedding(self, query):
+                return (await service.aembed([query]))[0]
+
+            async def _aget_text_embeddings(self, texts):
+                return await service.aembed(texts)
+
+            def _get_text_embedding(self, text):
+                return service.embed([text])[0]
+
+            def _get_text_embeddings(self, texts):
+                return service.embed(texts)
+
+        return FakeLLM(), FakeEmbedding(model_name="fake", embed_batch_size=100)
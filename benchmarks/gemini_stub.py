@@ -0,0 +1,154 @@
+"""
+Local stand-in for the Gemini REST API.
+
+Serves the generateContent, streamGenerateContent, embedContent,
+batchEmbedContents and models.get endpoints used by both backends, backed by
+a FakeModelService for the answers and vectors. It counts TCP connections
+(so reuse of warm HTTP sessions is visible), tracks peak concurrent
+requests and, like the real API under load, answers 429 RESOURCE_EXHAUSTED
+once more than max_concurrent requests are in flight.
+
+Point the app at it with GEMINI_API_ENDPOINT=http://127.0.0.1:<port> and
+GEMINI_TRANSPORT=rest.
+"""
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.bm25 import estimate_tokens
+
+def _content_text(content):
+    return "".join(part.get("text", "") for part in (content or {}).get("parts", []))
+
+def _candidate(text, prompt_tokens=0):
+    return {
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+        "usageMetadata": {"promptTokenCount": prompt_tokens, "candidatesTokenCount": estimate_tokens(text),
+                          "totalTokenCount": prompt_tokens + estimate_tokens(text)},
+    }
+
+class GeminiStubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, service, max_concurrent=None, host="127.0.0.1", port=0):
+        super().__init__((host, port), _Handler)
+        self.service = service
+        self.max_concurrent = max_concurrent
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connections = 0
+            self.requests = 0
+            self.rejected = 0
+            self.in_flight = 0
+            self.peak_in_flight = 0
+
+    def snapshot(self):
+        with self._lock:
+            return {"connections": self.connections, "requests": self.requests, "rejected_429": self.rejected,
+                    "peak_in_flight": self.peak_in_flight}
+
+    def process_request(self, request, client_address):
+        with self._lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def enter(self):
+        """Admit a request, or return False when over the concurrency limit."""
+        with self._lock:
+            self.requests += 1
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def start(self):
+        """Serve in a background thread and return the base URL."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server_port}"
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep-alive, so a client with a warm session reuses its connection
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Headers and body are written separately; without this, delayed ACKs
+        # add ~40ms to every keep-alive response
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _route(self):
+        # e.g. /v1beta/models/gemini-2.5-flash:generateContent?$alt=json
+        path = self.path.split("?", 1)[0]
+        name, _, method = path.rpartition("/")[2].partition(":")
+        return name, method
+
+    def do_GET(self):
+        name, _ = self._route()
+        self._send_json(200, {
+            "name": f"models/{name}", "baseModelId": name, "version": "001", "displayName": name,
+            "inputTokenLimit": 1048576, "outputTokenLimit": 8192,
+            "supportedGenerationMethods": ["generateContent", "countTokens", "embedContent"],
+        })
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)) or 0)
+        request = json.loads(body or b"{}")
+        _, method = self._route()
+        server = self.server
+        if not server.enter():
+            self._send_json(429, {"error": {"code": 429, "message": "Resource has been exhausted (stand-in limit).",
+                                            "status": "RESOURCE_EXHAUSTED"}})
+            return
+        try:
+            if method == "generateContent":
+                prompt = "".join(_content_text(content) for content in request.get("contents", []))
+                self._send_json(200, _candidate(server.service.complete(prompt), estimate_tokens(prompt)))
+            elif method == "streamGenerateContent":
+                prompt = "".join(_content_text(content) for content in request.get("contents", []))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                # A JSON array of responses, written element by element
+                self._send_chunk("[")
+                for i, piece in enumerate(server.service.stream(prompt)):
+                    self._send_chunk(("," if i else "") + json.dumps(_candidate(piece)))
+                self._send_chunk("]")
+                self.wfile.write(b"0\r\n\r\n")
+            elif method == "embedContent":
+                vector = server.service.embed([_content_text(request.get("content"))])[0]
+                self._send_json(200, {"embedding": {"values": vector}})
+            elif method == "batchEmbedContents":
+                texts = [_content_text(item.get("content")) for item in request.get("requests", [])]
+                self._send_json(200, {"embeddings": [{"values": vector} for vector in server.service.embed(texts)]})
+            else:
+                self._send_json(404, {"error": {"code": 404, "message": f"Unknown method {method}",
+                                                "status": "NOT_FOUND"}})
+        finally:
+            server.leave()
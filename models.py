@@ -1,4 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
 from datetime import datetime
 
 db = SQLAlchemy()
@@ -7,8 +8,116 @@ class Document(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     filepath = db.Column(db.String(255), nullable=False)
-    index_id = db.Column(db.String(255), nullable=False)  # ID for LlamaIndex
+    index_id = db.Column(db.String(255), nullable=False, default='')  # ID for LlamaIndex, filled in by the ingestion job
+    backend = db.Column(db.String(50))  # QA backend that wrote the index; None for indexes written before it was recorded
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
-    
+    status = db.Column(db.String(20), nullable=False, default='ready')  # queued, processing, ready or failed
+    content_hash = db.Column(db.String(64), index=True)  # SHA-256 of the uploaded bytes
+    previous_version_id = db.Column(db.Integer, db.ForeignKey('document.id'), index=True)  # revision this one replaces
+    version = db.Column(db.Integer, nullable=False, default=1)
+
+    # Serves the newest-first document list and its keyset pagination
+    __table_args__ = (db.Index('ix_document_upload_date_id', 'upload_date', 'id'),)
+
     def __repr__(self):
         return f"<Document {self.filename}>"
+
+def version_chain(document):
+    """A document followed by every earlier version of it, newest first."""
+    chain = [document]
+    seen = {document.id}
+    while chain[-1].previous_version_id and chain[-1].previous_version_id not in seen:
+        previous = db.session.get(Document, chain[-1].previous_version_id)
+        if previous is None:
+            break
+        chain.append(previous)
+        seen.add(previous.id)
+    return chain
+
+def index_ref_count(index_id):
+    """Number of documents sharing an index; it can be removed when this reaches zero."""
+    return Document.query.filter_by(index_id=index_id).count()
+
+def configure_sqlite(engine, busy_timeout):
+    """
+    Open every SQLite connection in WAL mode with a busy timeout.
+
+    In WAL mode readers do not block the writer, and the busy timeout makes
+    a writer in another gunicorn worker wait for the lock instead of failing
+    with "database is locked". Does nothing for other databases.
+
+    Args:
+        engine: SQLAlchemy engine
+        busy_timeout (float): Seconds to wait for a lock
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout * 1000)}')
+        # Durable at each checkpoint rather than each commit, which is safe in WAL mode
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+
+class IngestionJob(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex, returned to the client
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)  # queued, running, done or failed
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # refreshed while a live worker runs the job
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<IngestionJob {self.id} {self.status}>"
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex, returned to the client
+    filename = db.Column(db.String(255), nullable=False)
+    total_size = db.Column(db.BigInteger)  # declared by the client, checked on commit
+    expected_hash = db.Column(db.String(64))  # optional SHA-256 declared by the client
+    received_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    next_chunk = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, committed or expired
+    content_hash = db.Column(db.String(64))
+    previous_document_id = db.Column(db.Integer, db.ForeignKey('document.id'))  # set when uploading a new version
+    document_id = db.Column(db.Integer, db.ForeignKey('document.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<UploadSession {self.id} {self.status}>"
+
+def upgrade_schema():
+    """
+    Add columns that were introduced after a table was first created.
+
+    db.create_all() only creates missing tables, so databases from older
+    versions would otherwise keep their original column set.
+    """
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+                default = column.default.arg if column.default is not None and column.default.is_scalar else None
+                if default is not None:
+                    ddl += f" DEFAULT {default!r}" if isinstance(default, str) else f" DEFAULT {default}"
+                if not column.nullable and default is not None:
+                    ddl += " NOT NULL"
+                connection.execute(text(ddl))
+
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    index.create(connection)
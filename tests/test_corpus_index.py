@@ -0,0 +1,129 @@
+"""
+CorpusIndex layout: list-ordered merges, removal, retraining and indexes
+written before generations, checked against exact search.
+"""
+import os
+import json
+import numpy as np
+import pytest
+from utils.corpus_index import CorpusIndex
+from utils.vector_store import write_vector_store
+
+DIMENSION = 16
+
+def make_store(storage_dir, index_id, rows, seed):
+    vectors = np.random.default_rng(seed).normal(size=(rows, DIMENSION)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    write_vector_store(os.path.join(storage_dir, index_id), vectors,
+                       [{"id": f"{index_id}:{i}", "text": "text"} for i in range(rows)])
+    return vectors
+
+def exact(stores, query, top_k, removed=()):
+    hits = [(index_id, position, float(vector @ query))
+            for index_id, vectors in stores.items() if index_id not in removed
+            for position, vector in enumerate(vectors)]
+    return sorted(hits, key=lambda hit: -hit[2])[:top_k]
+
+@pytest.fixture
+def storage(tmp_path):
+    return str(tmp_path / "storage")
+
+def add_documents(index, storage, stores, count, rows=50, start=0):
+    for number in range(start, start + count):
+        index_id = f"doc-{number:03d}"
+        stores[index_id] = make_store(storage, index_id, rows, seed=number)
+        index.add_index(index_id, os.path.join(storage, index_id))
+
+def assert_matches_exact(index, stores, removed=(), queries=5):
+    for seed in range(queries):
+        query = np.random.default_rng(1000 + seed).normal(size=DIMENSION).astype(np.float32)
+        query /= np.linalg.norm(query)
+        # Probing every list makes the IVF search exact
+        hits = index.search(query, top_k=10, nprobe=10 ** 6)
+        expected = exact(stores, query, 10, removed)
+        assert [(index_id, position) for index_id, position, _ in hits] == \
+            [(index_id, position) for index_id, position, _ in expected]
+
+def test_untrained_index_is_exact(storage):
+    index = CorpusIndex(os.path.join(storage, ".corpus"), train_min_vectors=10 ** 6)
+    stores = {}
+    add_documents(index, storage, stores, 5)
+    assert index.stats()["lists"] == 1
+    assert_matches_exact(index, stores)
+
+def test_training_sorts_vectors_into_contiguous_lists(storage):
+    corpus_dir = os.path.join(storage, ".corpus")
+    index = CorpusIndex(corpus_dir, train_min_vectors=1000, tail_fraction=0.1)
+    stores = {}
+    add_documents(index, storage, stores, 30)
+    stats = index.stats()
+    assert stats["lists"] > 1
+    assert stats["unsorted"] < 0.1 * stats["vectors"] + 50
+
+    manifest = json.load(open(os.path.join(corpus_dir, "manifest.json")))
+    generation = manifest["generation"]
+    offsets = np.fromfile(os.path.join(corpus_dir, f"ivf.{generation}.offsets.i64"), dtype=np.int64)
+    assert offsets[0] == 0 and offsets[-1] == manifest["sealed"]
+    assert np.all(np.diff(offsets) >= 0)
+    # Only the current generation's files are left
+    assert not [name for name in os.listdir(corpus_dir) if name.startswith(("ivf.", "tail."))
+                and f".{generation}." not in name]
+    assert_matches_exact(index, stores)
+
+def test_removed_documents_are_hidden_then_dropped(storage):
+    index = CorpusIndex(os.path.join(storage, ".corpus"), train_min_vectors=500)
+    stores = {}
+    add_documents(index, storage, stores, 12)
+    assert index.remove_index("doc-003")
+    assert index.remove_index("doc-010")
+    removed = {"doc-003", "doc-010"}
+    assert_matches_exact(index, stores, removed)
+
+    vectors_before = index.stats()["vectors"]
+    # Growing the index past the retraining point merges without the removed rows
+    add_documents(index, storage, stores, 20, start=12)
+    stats = index.stats()
+    assert stats["vectors"] < vectors_before + 20 * 50
+    assert stats["documents"] == 30
+    assert_matches_exact(index, stores, removed)
+
+def test_retrains_as_the_index_grows(storage):
+    corpus_dir = os.path.join(storage, ".corpus")
+    index = CorpusIndex(corpus_dir, train_min_vectors=500, retrain_growth=2.0)
+    stores = {}
+    add_documents(index, storage, stores, 10)
+    first = json.load(open(os.path.join(corpus_dir, "manifest.json")))
+    add_documents(index, storage, stores, 30, start=10)
+    second = json.load(open(os.path.join(corpus_dir, "manifest.json")))
+    assert second["trained_count"] >= 2 * first["trained_count"]
+    assert second["nlist"] > first["nlist"]
+    assert_matches_exact(index, stores)
+
+def test_index_without_generations_is_migrated(storage):
+    corpus_dir = os.path.join(storage, ".corpus")
+    os.makedirs(corpus_dir)
+    stores = {}
+    centroids = np.eye(2, DIMENSION, dtype=np.float32)
+    # Plain file names, as written before the list-ordered layout
+    with open(os.path.join(corpus_dir, "documents.txt"), "w") as documents:
+        for number in range(4):
+            index_id = f"doc-{number:03d}"
+            vectors = stores[index_id] = make_store(storage, index_id, 50, seed=number)
+            lists = np.argmax(vectors @ centroids.T, axis=1)
+            for name, values in (("vectors.f32", vectors), ("lists.i32", lists.astype(np.int32)),
+                                 ("owners.i32", np.full(50, number, dtype=np.int32)),
+                                 ("positions.i32", np.arange(50, dtype=np.int32))):
+                with open(os.path.join(corpus_dir, name), "ab") as f:
+                    f.write(values.tobytes())
+            documents.write(index_id + "\n")
+    np.save(os.path.join(corpus_dir, "centroids.npy"), centroids)
+    with open(os.path.join(corpus_dir, "manifest.json"), "w") as f:
+        json.dump({"count": 200, "documents": 4, "dimension": DIMENSION, "nlist": 2, "removed": []}, f)
+
+    index = CorpusIndex(corpus_dir, train_min_vectors=100)
+    assert_matches_exact(index, stores)
+    add_documents(index, storage, stores, 1, start=4)
+    manifest = json.load(open(os.path.join(corpus_dir, "manifest.json")))
+    assert manifest["generation"] == 0 and manifest["sealed"] == 250
+    assert not os.path.exists(os.path.join(corpus_dir, "vectors.f32"))
+    assert_matches_exact(index, stores)
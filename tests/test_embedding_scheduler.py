@@ -0,0 +1,138 @@
+"""
+EmbeddingScheduler against injected embed_batch callables and the local
+Gemini stand-in from benchmarks/gemini_stub.py.
+"""
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from benchmarks.fakes import FakeModelService
+from benchmarks.gemini_stub import GeminiStubServer
+from utils.embedding_scheduler import EmbeddingScheduler, TokenBucket, chunk_key
+
+def vector(text):
+    return [float(len(text)), float(sum(map(ord, text)) % 97)]
+
+def make_scheduler(embed_batch, **kwargs):
+    options = {"batch_size": 2, "max_concurrency": 2, "requests_per_second": 1000,
+               "max_retries": 3, "base_delay": 0.001, "max_delay": 0.01}
+    options.update(kwargs)
+    return EmbeddingScheduler(embed_batch, **options)
+
+class FlakyEmbedder:
+    """Fails the first `failures` calls with `error`, then embeds."""
+
+    def __init__(self, failures, error):
+        self.failures = failures
+        self.error = error
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self._lock:
+            self.calls.append(list(texts))
+            failing = len(self.calls) <= self.failures
+        if failing:
+            raise self.error
+        return [vector(text) for text in texts]
+
+def test_embeds_in_order_across_batches():
+    texts = [f"chunk {i}" for i in range(7)]
+    embedder = FlakyEmbedder(0, None)
+    assert make_scheduler(embedder).embed(texts) == [vector(text) for text in texts]
+    assert sorted(len(batch) for batch in embedder.calls) == [1, 2, 2, 2]
+
+def test_retries_rate_limit_errors_and_drains_bucket(monkeypatch):
+    drained = []
+    monkeypatch.setattr(TokenBucket, "drain", lambda self: drained.append(True))
+    embedder = FlakyEmbedder(2, Exception("429 Resource has been exhausted"))
+    scheduler = make_scheduler(embedder, batch_size=10, max_concurrency=1)
+    assert scheduler.embed(["a", "b"]) == [vector("a"), vector("b")]
+    assert len(embedder.calls) == 3
+    assert len(drained) == 2
+
+def test_gives_up_after_max_retries():
+    embedder = FlakyEmbedder(10, Exception("RESOURCE_EXHAUSTED"))
+    with pytest.raises(Exception, match="RESOURCE_EXHAUSTED"):
+        make_scheduler(embedder, max_retries=2).embed(["a"])
+    assert len(embedder.calls) == 3
+
+def test_other_errors_are_not_retried():
+    embedder = FlakyEmbedder(1, Exception("400 Invalid argument"))
+    with pytest.raises(Exception, match="400"):
+        make_scheduler(embedder).embed(["a"])
+    assert len(embedder.calls) == 1
+
+def test_length_mismatch_raises():
+    with pytest.raises(ValueError, match="Expected 2 embeddings, got 1"):
+        make_scheduler(lambda texts: [vector(texts[0])]).embed(["a", "b"])
+
+def test_reuses_known_embeddings():
+    embedder = FlakyEmbedder(0, None)
+    known = {chunk_key("a"): [9.0, 9.0]}
+    assert make_scheduler(embedder).embed(["a", "b"], known=known) == [[9.0, 9.0], vector("b")]
+    assert embedder.calls == [["b"]]
+
+def test_failed_run_leaves_checkpoint_for_resume(tmp_path):
+    checkpoint_path = tmp_path / "embeddings.jsonl"
+    texts = [f"chunk {i}" for i in range(4)]
+
+    def fail_second_batch(batch):
+        if batch == texts[2:]:
+            raise Exception("400 Invalid argument")
+        return [vector(text) for text in batch]
+
+    with pytest.raises(Exception, match="400"):
+        make_scheduler(fail_second_batch, max_concurrency=1).embed(texts, checkpoint_path=str(checkpoint_path))
+    saved = [json.loads(line)["key"] for line in checkpoint_path.read_text().splitlines()]
+    assert saved == [chunk_key(text) for text in texts[:2]]
+
+    embedder = FlakyEmbedder(0, None)
+    result = make_scheduler(embedder).embed(texts, checkpoint_path=str(checkpoint_path))
+    assert result == [vector(text) for text in texts]
+    assert embedder.calls == [texts[2:]]
+    assert not checkpoint_path.exists()
+
+def test_resumes_from_half_written_checkpoint(tmp_path):
+    checkpoint_path = tmp_path / "embeddings.jsonl"
+    record = json.dumps({"key": chunk_key("a"), "embedding": [1.0, 2.0]})
+    # A crash while appending leaves the last line cut off
+    checkpoint_path.write_text(record + "\n" + record[:len(record) // 2])
+
+    embedder = FlakyEmbedder(0, None)
+    result = make_scheduler(embedder).embed(["a", "b"], checkpoint_path=str(checkpoint_path))
+    assert result == [[1.0, 2.0], vector("b")]
+    assert embedder.calls == [["b"]]
+
+def test_against_stub_server_under_rate_limiting():
+    service = FakeModelService(llm_latency=0.0, embed_latency=0.02, dimension=8)
+    # One request at a time; concurrent batches are answered with 429
+    server = GeminiStubServer(service, max_concurrent=1)
+    base_url = server.start()
+
+    def embed_batch(texts):
+        body = json.dumps({"requests": [{"model": "models/text-embedding-004",
+                                         "content": {"parts": [{"text": text}]}} for text in texts]})
+        request = urllib.request.Request(f"{base_url}/v1beta/models/text-embedding-004:batchEmbedContents",
+                                         data=body.encode("utf-8"),
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return [item["values"] for item in json.load(response)["embeddings"]]
+        except urllib.error.HTTPError as e:
+            raise Exception(f"{e.code} {e.read().decode('utf-8')}")
+
+    try:
+        texts = [f"passage {i} about deliveries" for i in range(20)]
+        scheduler = make_scheduler(embed_batch, batch_size=4, max_concurrency=4, max_retries=50)
+        result = scheduler.embed(texts)
+        stats = server.snapshot()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert result == service.embed(texts)
+    assert stats["peak_in_flight"] == 1
+    # Every rejected request was retried until all five batches went through
+    assert stats["requests"] == 5 + stats["rejected_429"]
@@ -0,0 +1,412 @@
+import os
+import re
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+import numpy as np
+from utils.metrics import span
+from utils.model_clients import Overloaded
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANSWER_CACHE_PATH = os.environ.get(
+    "ANSWER_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'answer_cache.db'))
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", 7 * 24 * 3600))  # seconds
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 10000))
+ANSWER_CACHE_SIMILARITY = float(os.environ.get("ANSWER_CACHE_SIMILARITY", 0.95))
+
+def normalize_question(question):
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip(" ?!.")
+
+def _reuse(embedding, embed_for_retrieval):
+    """Keyword arguments handing a cache lookup's question embedding on to compute."""
+    return {"embedding": embedding} if embed_for_retrieval and embedding is not None else {}
+
+class AnswerCache:
+    """
+    Persistent cache of answers keyed on (index_id, normalized question).
+
+    Lookups try an exact match on the normalized question first and then,
+    when an embedding function is supplied, the most similar cached question
+    for the same document above a cosine similarity threshold. Entries expire
+    after a TTL and the least recently used are evicted beyond max_entries.
+    """
+
+    def __init__(self, path, ttl=ANSWER_CACHE_TTL, max_entries=ANSWER_CACHE_MAX_ENTRIES,
+                 similarity_threshold=ANSWER_CACHE_SIMILARITY):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "id INTEGER PRIMARY KEY, index_id TEXT NOT NULL, question TEXT NOT NULL, "
+                "embedding BLOB, answer TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS ix_answers_question ON answers (index_id, question)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_answers_last_used ON answers (last_used)")
+            self._conn.commit()
+        return self._conn
+
+    def get_or_compute(self, index_id, question, compute, embed=None, embed_for_retrieval=False):
+        """
+        Return a cached answer, or compute and cache a new one.
+
+        Args:
+            index_id (str): Document index the question is about
+            question (str): User's question
+            compute (callable): Called with (index_id, question) on a miss
+            embed (callable): Optional; maps a question to an embedding vector
+                for near-duplicate matching
+            embed_for_retrieval (bool): Pass the lookup's embedding to compute
+                as embedding=, so retrieval does not embed the question again
+
+        Returns:
+            tuple: (answer, served_from_cache)
+        """
+        if not ANSWER_CACHE_ENABLED:
+            return compute(index_id, question), False
+
+        answer, embedding = self.lookup(index_id, question, embed)
+        if answer is not None:
+            return answer, True
+
+        answer = compute(index_id, question, **_reuse(embedding, embed_for_retrieval))
+        self.store(index_id, question, answer, embedding)
+        return answer, False
+
+    def stream_or_compute(self, index_id, question, stream, embed=None, embed_for_retrieval=False):
+        """
+        Streaming counterpart of get_or_compute.
+
+        A cached answer is replayed as a single piece; otherwise the pieces
+        from stream are passed through and the joined answer is cached once
+        the stream completes.
+
+        Args:
+            stream (callable): Called with (index_id, question) on a miss;
+                returns an iterator of answer text pieces
+
+        Returns:
+            tuple: (iterator of answer text pieces, served_from_cache)
+        """
+        if not ANSWER_CACHE_ENABLED:
+            return stream(index_id, question), False
+
+        answer, embedding = self.lookup(index_id, question, embed)
+        if answer is not None:
+            return iter([answer]), True
+
+        def generate():
+            pieces = []
+            for piece in stream(index_id, question, **_reuse(embedding, embed_for_retrieval)):
+                pieces.append(piece)
+                yield piece
+            self.store(index_id, question, "".join(pieces), embedding)
+
+        return generate(), False
+
+    async def aget_or_compute(self, index_id, question, compute, embed=None, prepare=None,
+                              embed_for_retrieval=False):
+        """
+        Coroutine form of get_or_compute.
+
+        After an exact-match miss, the question embedding and prepare() run
+        concurrently, so work compute needs anyway (such as loading the
+        document's index) overlaps the semantic lookup.
+
+        Args:
+            compute (callable): Coroutine function called with (index_id, question) on a miss
+            embed (callable): Optional coroutine function mapping a question to an embedding
+            prepare (callable): Optional coroutine function run alongside the embedding
+
+        Returns:
+            tuple: (answer, served_from_cache)
+        """
+        if not ANSWER_CACHE_ENABLED:
+            return await compute(index_id, question), False
+
+        answer, embedding = await self.alookup(index_id, question, embed, prepare)
+        if answer is not None:
+            return answer, True
+
+        answer = await compute(index_id, question, **_reuse(embedding, embed_for_retrieval))
+        await asyncio.to_thread(self.store, index_id, question, answer, embedding)
+        return answer, False
+
+    async def astream_or_compute(self, index_id, question, stream, embed=None, prepare=None,
+                                 embed_for_retrieval=False):
+        """
+        Coroutine form of stream_or_compute.
+
+        Args:
+            stream (callable): Called with (index_id, question) on a miss;
+                returns an async iterator of answer text pieces
+
+        Returns:
+            tuple: (async iterator of answer text pieces, served_from_cache)
+        """
+        if not ANSWER_CACHE_ENABLED:
+            return stream(index_id, question), False
+
+        answer, embedding = await self.alookup(index_id, question, embed, prepare)
+        if answer is not None:
+            async def replay():
+                yield answer
+            return replay(), True
+
+        async def generate():
+            pieces = []
+            async for piece in stream(index_id, question, **_reuse(embedding, embed_for_retrieval)):
+                pieces.append(piece)
+                yield piece
+            await asyncio.to_thread(self.store, index_id, question, "".join(pieces), embedding)
+
+        return generate(), False
+
+    async def alookup(self, index_id, question, embed=None, prepare=None):
+        """
+        Coroutine form of lookup, running prepare() alongside the embedding on an exact miss.
+
+        Returns:
+            tuple: (answer or None, question embedding or None)
+        """
+        with span("answer_cache_lookup"):
+            answer = await asyncio.to_thread(self._lookup_exact, index_id, normalize_question(question))
+        if answer is not None:
+            return answer, None
+
+        async def nothing():
+            return None
+
+        embedded, prepared = await asyncio.gather(embed(question) if embed else nothing(),
+                                                  prepare() if prepare else nothing(),
+                                                  return_exceptions=True)
+        for result in (embedded, prepared):
+            if isinstance(result, (Overloaded, asyncio.CancelledError)):
+                raise result
+        # A failed prepare() is left for compute to report
+
+        embedding = None
+        if isinstance(embedded, Exception):
+            logger.warning(f"Skipping semantic answer cache lookup: {str(embedded)}")
+        elif embedded is not None:
+            embedding = np.asarray(embedded, dtype=np.float32)
+            with span("answer_cache_lookup"):
+                answer = await asyncio.to_thread(self._lookup_similar, index_id, embedding)
+            if answer is not None:
+                return answer, embedding
+
+        with self._lock:
+            self.misses += 1
+        return None, embedding
+
+    def lookup(self, index_id, question, embed=None):
+        """
+        Find a cached answer without computing one.
+
+        Returns:
+            tuple: (answer or None, question embedding or None); pass the
+            embedding to store() so a miss does not embed the question twice
+        """
+        with span("answer_cache_lookup"):
+            answer = self._lookup_exact(index_id, normalize_question(question))
+        if answer is not None:
+            return answer, None
+
+        embedding = None
+        if embed is not None:
+            try:
+                embedding = np.asarray(embed(question), dtype=np.float32)
+                with span("answer_cache_lookup"):
+                    answer = self._lookup_similar(index_id, embedding)
+                if answer is not None:
+                    return answer, embedding
+            except Overloaded:
+                # The answer would be shed too; fail before computing it
+                raise
+            except Exception as e:
+                logger.warning(f"Skipping semantic answer cache lookup: {str(e)}")
+
+        with self._lock:
+            self.misses += 1
+        return None, embedding
+
+    def lookup_many(self, index_id, questions, embed=None):
+        """
+        lookup() for several questions at once.
+
+        Exact matches are found with one query; the remaining questions are
+        embedded in one request and matched against the cached questions
+        with a single similarity computation.
+
+        Args:
+            embed (callable): Optional; maps a list of questions to a list of embeddings
+
+        Returns:
+            tuple: (answers, embeddings), lists aligned with questions holding
+            None where there is no cached answer or no embedding
+        """
+        normalized = [normalize_question(question) for question in questions]
+        with span("answer_cache_lookup"):
+            exact = self._lookup_exact_many(index_id, set(normalized))
+        answers = [exact.get(question) for question in normalized]
+        embeddings = [None] * len(questions)
+
+        misses = [i for i, answer in enumerate(answers) if answer is None]
+        if misses and embed is not None:
+            try:
+                matrix = np.asarray(embed([questions[i] for i in misses]), dtype=np.float32)
+                for i, embedding in zip(misses, matrix):
+                    embeddings[i] = embedding
+                with span("answer_cache_lookup"):
+                    similar = self._lookup_similar_many(index_id, matrix)
+                for i, answer in zip(misses, similar):
+                    answers[i] = answer
+            except Overloaded:
+                raise
+            except Exception as e:
+                logger.warning(f"Skipping semantic answer cache lookup: {str(e)}")
+
+        with self._lock:
+            self.misses += sum(1 for answer in answers if answer is None)
+        return answers, embeddings
+
+    def _lookup_exact(self, index_id, normalized):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT id, answer FROM answers WHERE index_id = ? AND question = ? AND created_at > ?",
+                (index_id, normalized, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE answers SET last_used = ? WHERE id = ?", (now, row[0]))
+            conn.commit()
+            self.hits += 1
+            return row[1]
+
+    def _lookup_exact_many(self, index_id, normalized):
+        """Cached answers for a set of normalized questions, keyed by question."""
+        now = time.time()
+        normalized = list(normalized)
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            # Stay under SQLite's limit on bound parameters
+            for start in range(0, len(normalized), 500):
+                part = normalized[start:start + 500]
+                found.update((question, (row_id, answer)) for row_id, question, answer in conn.execute(
+                    f"SELECT id, question, answer FROM answers WHERE index_id = ? AND created_at > ? "
+                    f"AND question IN ({','.join('?' * len(part))})",
+                    [index_id, now - self.ttl] + part))
+            if found:
+                conn.executemany("UPDATE answers SET last_used = ? WHERE id = ?",
+                                 [(now, row_id) for row_id, _ in found.values()])
+                conn.commit()
+                self.hits += len(found)
+        return {question: answer for question, (_, answer) in found.items()}
+
+    def _lookup_similar(self, index_id, embedding):
+        return self._lookup_similar_many(index_id, embedding[np.newaxis, :])[0]
+
+    def _lookup_similar_many(self, index_id, embeddings):
+        """Best cached answer above the similarity threshold for each row of embeddings."""
+        now = time.time()
+        answers = [None] * len(embeddings)
+        with self._lock:
+            conn = self._connection()
+            rows = conn.execute(
+                "SELECT id, embedding, answer FROM answers "
+                "WHERE index_id = ? AND embedding IS NOT NULL AND created_at > ?",
+                (index_id, now - self.ttl)).fetchall()
+            if not rows:
+                return answers
+
+            matrix = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+            if matrix.shape[1] != embeddings.shape[1]:
+                return answers
+            query_norms = np.linalg.norm(embeddings, axis=1)
+            norms = np.outer(np.linalg.norm(matrix, axis=1), np.where(query_norms == 0, 1.0, query_norms))
+            similarities = matrix @ embeddings.T / np.where(norms == 0, 1.0, norms)
+            best = np.argmax(similarities, axis=0)
+
+            used = []
+            for column, row in enumerate(best):
+                similarity = similarities[row, column]
+                if similarity < self.similarity_threshold:
+                    continue
+                answers[column] = rows[row][2]
+                used.append((now, rows[row][0]))
+                self.hits += 1
+                self.semantic_hits += 1
+                logger.debug(f"Semantic answer cache hit (similarity {similarity:.3f})")
+            if used:
+                conn.executemany("UPDATE answers SET last_used = ? WHERE id = ?", used)
+                conn.commit()
+            return answers
+
+    def store(self, index_id, question, answer, embedding=None):
+        """Cache an answer, evicting expired and least recently used entries."""
+        self.store_many(index_id, [(question, answer, embedding)])
+
+    def store_many(self, index_id, entries):
+        """
+        Cache several answers in one transaction.
+
+        Args:
+            entries (list): (question, answer, embedding or None) tuples
+        """
+        now = time.time()
+        rows = [(index_id, normalize_question(question),
+                 np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None,
+                 answer, now, now)
+                for question, answer, embedding in entries]
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR REPLACE INTO answers (index_id, question, embedding, answer, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            conn.execute("DELETE FROM answers WHERE created_at <= ?", (now - self.ttl,))
+            conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+            conn.commit()
+
+    def invalidate(self, index_id):
+        """Forget every cached answer for a document, e.g. after it was re-indexed."""
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM answers WHERE index_id = ?", (index_id,))
+            conn.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+# Shared by both backends so a document's answers are invalidated in one place
+answer_cache = AnswerCache(ANSWER_CACHE_PATH)
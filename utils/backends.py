@@ -0,0 +1,94 @@
+"""
+Registry of question-answering backends, imported on first use.
+
+A backend is a module providing process_document, query_document_cached,
+stream_query_document_cached, embed_question, answer_from_passages and
+answer_questions, plus an IndexCache of loaded indexes. For asgi.py it also provides the coroutine
+forms aquery_document_cached and astream_query_document_cached. Importing one pulls in its model SDKs, so
+app.py asks for the configured backend when a request needs it rather than
+at import time; workers start without loading SDKs they never call.
+
+Indexes are written in a backend-specific layout, so app.py records the
+backend on each document it ingests and queries the document with that one.
+"""
+import os
+import logging
+import threading
+import functools
+import importlib
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# name -> (module path, name of the module's index cache)
+BACKENDS = {
+    "gemini_direct": ("utils.gemini_direct", "document_cache"),
+    "llama_index": ("utils.llama_index_helper", "index_cache"),
+}
+
+_loaded = {}
+_lock = threading.Lock()
+
+def register_backend(name, module_path, cache_attr):
+    """
+    Make another backend selectable by name
+
+    Args:
+        name (str): Value of QA_BACKEND that selects it
+        module_path (str): Dotted path of the module implementing it
+        cache_attr (str): Name of the module's IndexCache attribute
+    """
+    BACKENDS[name] = (module_path, cache_attr)
+
+def get_backend(name):
+    """
+    Return a backend module, importing it the first time it is asked for
+
+    Args:
+        name (str): Registered backend name
+
+    Returns:
+        module: The backend module
+    """
+    backend = _loaded.get(name)
+    if backend is not None:
+        return backend
+    if name not in BACKENDS:
+        raise Exception(f"Unknown QA backend '{name}'; expected one of: {', '.join(sorted(BACKENDS))}")
+    with _lock:
+        if name not in _loaded:
+            logger.info(f"Loading QA backend {name}")
+            _loaded[name] = importlib.import_module(BACKENDS[name][0])
+        return _loaded[name]
+
+def loaded_cache(name):
+    """
+    The index cache of a backend if it has been loaded, without loading it
+
+    Returns:
+        IndexCache or None
+    """
+    backend = _loaded.get(name)
+    return getattr(backend, BACKENDS[name][1]) if backend is not None else None
+
+def per_process(factory):
+    """
+    Build a shared client once per process and reuse it
+
+    The result is keyed by process id: a client created before a fork (for
+    example by a preloading gunicorn master) holds connections that must not
+    be shared, so each forked worker builds its own on first use.
+    """
+    lock = threading.Lock()
+    state = {}
+
+    @functools.wraps(factory)
+    def wrapper():
+        pid = os.getpid()
+        if state.get("pid") != pid:
+            with lock:
+                if state.get("pid") != pid:
+                    state["value"] = factory()
+                    state["pid"] = pid
+        return state["value"]
+    return wrapper
@@ -0,0 +1,302 @@
+"""
+Answering many questions about one document in a few model calls.
+
+answer_batch() serves /api/ask-batch for both backends. Cached answers are
+found with one exact-match query plus one embedding request for the rest
+of the questions, and the same embeddings drive vector retrieval where the
+backend uses it. Questions that share context are then packed, up to
+BATCH_QUESTIONS_PER_CALL at a time, into generation calls that return a
+JSON array of answers, so the document or its passages are sent once per
+call instead of once per question. Answers missing from a call's output
+are asked again one at a time.
+"""
+import os
+import re
+import json
+import logging
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from utils.answer_cache import answer_cache, ANSWER_CACHE_ENABLED
+from utils.bm25 import estimate_tokens
+from utils.model_clients import Overloaded
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+BATCH_QUESTIONS_PER_CALL = int(os.environ.get("BATCH_QUESTIONS_PER_CALL", 8))
+BATCH_CONTEXT_TOKENS = int(os.environ.get("BATCH_CONTEXT_TOKENS", 12000))  # context per call
+BATCH_PARALLEL_CALLS = int(os.environ.get("BATCH_PARALLEL_CALLS", 4))
+
+# USD per million tokens, for the cost estimate in batch results
+LLM_INPUT_PRICE = float(os.environ.get("LLM_INPUT_PRICE_PER_MTOK", 0.30))
+LLM_OUTPUT_PRICE = float(os.environ.get("LLM_OUTPUT_PRICE_PER_MTOK", 2.50))
+
+class BatchContext:
+    """Context retrieved for the questions of a batch"""
+
+    def __init__(self, filename, label, passages, selections):
+        """
+        Args:
+            filename (str): Document name shown in prompts
+            label (str): Heading of the context in prompts, e.g. "Relevant Excerpts"
+            passages (dict): passage id -> text; ids order passages in prompts
+            selections (list): Passage ids chosen for each question
+        """
+        self.filename = filename
+        self.label = label
+        self.passages = passages
+        self.selections = selections
+
+class BatchUsage:
+    """Model calls and tokens spent on one batch"""
+
+    def __init__(self):
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.response_tokens = 0
+        self.embedding_calls = 0
+        self.embedding_tokens = 0
+        self.unbatched_prompt_tokens = 0
+        self._lock = threading.Lock()
+
+    def add_generation(self, prompt_tokens, response_tokens):
+        with self._lock:
+            self.llm_calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.response_tokens += response_tokens
+
+    def add_embedding(self, texts):
+        with self._lock:
+            self.embedding_calls += 1
+            self.embedding_tokens += sum(estimate_tokens(text) for text in texts)
+
+    def report(self):
+        cost = (self.prompt_tokens * LLM_INPUT_PRICE + self.response_tokens * LLM_OUTPUT_PRICE) / 1e6
+        return {
+            "llm_calls": self.llm_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "response_tokens": self.response_tokens,
+            "embedding_calls": self.embedding_calls,
+            "embedding_tokens": self.embedding_tokens,
+            "estimated_cost_usd": round(cost, 6),
+            # What asking the uncached questions one at a time would have sent
+            "unbatched_prompt_tokens": self.unbatched_prompt_tokens,
+        }
+
+def build_batch_prompt(filename, label, passages, questions):
+    """
+    Build a prompt that answers several questions about one document.
+
+    Returns:
+        str: Prompt asking for a JSON array of {"id", "answer"} objects
+    """
+    context = "\n\n[...]\n\n".join(passages)
+    numbered = "\n".join(f"{number}. {question}" for number, question in enumerate(questions, start=1))
+    return f"""You are an AI assistant analyzing a document. Answer each of the numbered questions below based ONLY on the information in this document.
+
+Document: {filename}
+
+{label}:
+{context}
+
+Questions:
+{numbered}
+
+Instructions:
+- Answer each question concisely and directly, independently of the others
+- Only include information found in the document
+- If information is not in document, answer "Not found in document"
+- Respond with only a JSON array holding one object per question, in order: [{{"id": 1, "answer": "..."}}]
+
+JSON:"""
+
+# Template text of a batch prompt, for estimating unbatched prompt sizes
+PROMPT_OVERHEAD_TOKENS = estimate_tokens(build_batch_prompt("", "", [], []))
+
+def parse_batch_answers(text, count):
+    """
+    Read the answers from a batch call's output.
+
+    Accepts the JSON array asked for, optionally inside a code fence or
+    surrounded by other text, or an object holding it under "answers".
+
+    Returns:
+        list: count answers in question order; None where one is missing
+    """
+    text = text.strip()
+    fenced = re.match(r"^```(?:json)?\s*(.*?)\s*```$", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1)
+    try:
+        items = json.loads(text)
+    except ValueError:
+        start, end = text.find("["), text.rfind("]")
+        try:
+            items = json.loads(text[start:end + 1]) if start != -1 and end > start else []
+        except ValueError:
+            items = []
+    if isinstance(items, dict):
+        items = items.get("answers", [])
+
+    answers = [None] * count
+    for position, item in enumerate(items if isinstance(items, list) else []):
+        if isinstance(item, dict):
+            number, answer = item.get("id", position + 1), item.get("answer")
+        else:
+            number, answer = position + 1, item
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            continue
+        if 1 <= number <= count and isinstance(answer, str) and answer.strip():
+            answers[number - 1] = answer.strip()
+    return answers
+
+def group_questions(selections, passage_tokens, max_questions, token_budget):
+    """
+    Pack questions into calls, keeping questions that share passages together.
+
+    Questions are taken in order of their first passage and added to the
+    current call while it has room for their new passages; a question that
+    needs no new passages always fits.
+
+    Args:
+        selections (list): Passage ids chosen for each question
+        passage_tokens (dict): passage id -> estimated tokens
+        max_questions (int): Questions per call
+        token_budget (int): Context tokens per call
+
+    Returns:
+        list: Lists of question positions, one per call
+    """
+    order = sorted(range(len(selections)), key=lambda i: (min(selections[i], default=-1), i))
+    groups, current, current_passages, current_tokens = [], [], set(), 0
+    for i in order:
+        new = set(selections[i]) - current_passages
+        added = sum(passage_tokens[passage] for passage in new)
+        if current and (len(current) >= max_questions or (new and current_tokens + added > token_budget)):
+            groups.append(current)
+            current, current_passages, current_tokens = [], set(), 0
+            new = set(selections[i])
+            added = sum(passage_tokens[passage] for passage in new)
+        current.append(i)
+        current_passages |= new
+        current_tokens += added
+    if current:
+        groups.append(current)
+    return groups
+
+def answer_batch(index_id, questions, retrieve, generate, embed=None, embed_for_retrieval=False):
+    """
+    Answer several questions about one document with as few model calls as possible
+
+    Args:
+        index_id (str): Document index the questions are about
+        questions (list): Question strings
+        retrieve (callable): Called with (questions, embeddings) for the
+            questions not answered from the cache; returns a BatchContext.
+            embeddings is None unless embed_for_retrieval is set
+        generate (callable): Called with a prompt; returns
+            (text, prompt tokens, response tokens)
+        embed (callable): Optional; maps a list of questions to embeddings
+            in one request, for near-duplicate cache matching
+        embed_for_retrieval (bool): Whether retrieve needs the embeddings
+
+    Returns:
+        tuple: (list of {"question", "answer", "cached"} dicts, with "error"
+        instead of an answer where one failed, and the usage report dict)
+
+    Raises:
+        Overloaded: When this worker is at capacity; answers generated
+            before that are cached, so a retry costs less
+    """
+    usage = BatchUsage()
+    results = [{"question": question, "answer": None, "cached": False} for question in questions]
+
+    def embed_counted(texts):
+        usage.add_embedding(texts)
+        return embed(texts)
+
+    if ANSWER_CACHE_ENABLED:
+        answers, embeddings = answer_cache.lookup_many(index_id, questions, embed_counted if embed else None)
+    else:
+        answers, embeddings = [None] * len(questions), [None] * len(questions)
+    for result, answer in zip(results, answers):
+        if answer is not None:
+            result["answer"], result["cached"] = answer, True
+
+    pending = [i for i, answer in enumerate(answers) if answer is None]
+    if not pending:
+        return results, usage.report()
+
+    pending_embeddings = None
+    if embed_for_retrieval:
+        missing = [i for i in pending if embeddings[i] is None]
+        if missing:
+            for i, embedding in zip(missing, embed_counted([questions[i] for i in missing])):
+                embeddings[i] = embedding
+        pending_embeddings = [embeddings[i] for i in pending]
+    context = retrieve([questions[i] for i in pending], pending_embeddings)
+
+    passage_tokens = {passage: estimate_tokens(text) for passage, text in context.passages.items()}
+    for position, selection in enumerate(context.selections):
+        usage.unbatched_prompt_tokens += (PROMPT_OVERHEAD_TOKENS + estimate_tokens(questions[pending[position]]) +
+                                          sum(passage_tokens[passage] for passage in selection))
+
+    def answer_group(group):
+        """Ask one call for the answers to a group; returns the positions it left unanswered."""
+        passages = sorted(set().union(*(context.selections[position] for position in group)))
+        prompt = build_batch_prompt(context.filename, context.label, [context.passages[p] for p in passages],
+                                    [questions[pending[position]] for position in group])
+        text, prompt_tokens, response_tokens = generate(prompt)
+        usage.add_generation(prompt_tokens, response_tokens)
+        answers = parse_batch_answers(text, len(group))
+        if len(group) == 1 and answers[0] is None and text.strip():
+            # A lone question answered in prose rather than JSON
+            answers = [text.strip()]
+
+        entries = []
+        for position, answer in zip(group, answers):
+            if answer is not None:
+                i = pending[position]
+                results[i]["answer"] = answer
+                entries.append((questions[i], answer, embeddings[i]))
+        if ANSWER_CACHE_ENABLED and entries:
+            answer_cache.store_many(index_id, entries)
+        return [position for position, answer in zip(group, answers) if answer is None]
+
+    def run_groups(executor, groups):
+        """Answer groups in parallel; returns the positions left unanswered."""
+        # Each call runs in a copy of this request's context, so model
+        # calls are queued under its client and timed into its spans
+        futures = [(group, executor.submit(contextvars.copy_context().run, answer_group, group))
+                   for group in groups]
+        unanswered, overloaded = [], None
+        for group, future in futures:
+            try:
+                unanswered.extend(future.result())
+            except Overloaded as e:
+                overloaded = e
+            except Exception as e:
+                logger.error(f"Error answering batch questions: {str(e)}")
+                for position in group:
+                    results[pending[position]]["error"] = str(e)
+        if overloaded:
+            raise overloaded
+        return unanswered
+
+    groups = group_questions(context.selections, passage_tokens, BATCH_QUESTIONS_PER_CALL, BATCH_CONTEXT_TOKENS)
+    with ThreadPoolExecutor(max_workers=max(1, BATCH_PARALLEL_CALLS)) as executor:
+        unanswered = run_groups(executor, groups)
+        if unanswered:
+            # Questions a call did not answer are asked again on their own
+            logger.debug(f"Retrying {len(unanswered)} batch questions individually")
+            run_groups(executor, [[position] for position in unanswered])
+
+    for i in pending:
+        if results[i]["answer"] is None and "error" not in results[i]:
+            results[i]["error"] = "No answer was returned for this question"
+    logger.debug(f"Answered {len(questions)} questions ({len(questions) - len(pending)} cached) "
+                 f"in {usage.llm_calls} calls")
+    return results, usage.report()
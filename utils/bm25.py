@@ -0,0 +1,148 @@
+import re
+import json
+import math
+import heapq
+from collections import Counter
+
+# Words, numbers and dotted/hyphenated identifiers such as "4.2.1" or "non-compete"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the "
+    "this to was were what when where which who why will with".split()
+)
+
+def tokenize(text):
+    """Lowercase text and split it into index terms, dropping stopwords."""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+def estimate_tokens(text):
+    """Rough LLM token count; Gemini averages about four characters per token."""
+    return len(text) // 4 + 1
+
+def chunk_text(text, chunk_tokens=300, overlap_tokens=50):
+    """
+    Split text into overlapping chunks on whitespace boundaries.
+
+    Args:
+        text (str): Full document text
+        chunk_tokens (int): Target chunk size in estimated LLM tokens
+        overlap_tokens (int): Overlap between neighbouring chunks
+
+    Returns:
+        list: (start, end) character offsets into text
+    """
+    chunk_chars = chunk_tokens * 4
+    step = max(1, chunk_chars - overlap_tokens * 4)
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_chars)
+        if end < len(text):
+            # Do not cut words in half
+            boundary = text.rfind(" ", start + step, end)
+            if boundary == -1:
+                boundary = text.rfind("\n", start + step, end)
+            if boundary != -1:
+                end = boundary
+        chunks.append((start, end))
+        if end >= len(text):
+            break
+        next_start = max(start + 1, end - overlap_tokens * 4)
+        # Start the next chunk on a word boundary as well
+        space = text.find(" ", next_start, end)
+        start = space + 1 if space != -1 else next_start
+    return chunks
+
+def chunk_spans(text, spans, chunk_tokens=300, overlap_tokens=50):
+    """
+    Chunk each span of text separately, e.g. one span per page.
+
+    Chunks never cross a span boundary, so an unchanged page yields the same
+    chunks no matter what changed elsewhere in the document.
+
+    Returns:
+        list: (start, end) character offsets into text
+    """
+    chunks = []
+    for span_start, span_end in spans:
+        chunks.extend((span_start + start, span_start + end)
+                      for start, end in chunk_text(text[span_start:span_end], chunk_tokens, overlap_tokens))
+    return chunks
+
+class BM25Index:
+    """
+    Okapi BM25 over a compact inverted index.
+
+    Postings are stored as flat [chunk_id, term_frequency, ...] lists so the
+    persisted JSON stays small and loads quickly.
+    """
+
+    def __init__(self, postings, doc_lengths, k1=1.5, b=0.75):
+        self.postings = postings
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.avg_length = sum(doc_lengths) / len(doc_lengths) if doc_lengths else 0.0
+
+    @classmethod
+    def build(cls, passages, **kwargs):
+        """
+        Args:
+            passages (list): Passage strings, indexed by position
+        """
+        postings = {}
+        doc_lengths = []
+        for chunk_id, passage in enumerate(passages):
+            terms = tokenize(passage)
+            doc_lengths.append(len(terms))
+            for term, freq in Counter(terms).items():
+                postings.setdefault(term, []).extend((chunk_id, freq))
+        return cls(postings, doc_lengths, **kwargs)
+
+    def search(self, query, top_k=10):
+        """
+        Score passages against a query.
+
+        Returns:
+            list: (chunk_id, score) pairs, best first
+        """
+        num_docs = len(self.doc_lengths)
+        if not num_docs:
+            return []
+
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            doc_freq = len(posting) // 2
+            idf = math.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+            for i in range(0, len(posting), 2):
+                chunk_id, freq = posting[i], posting[i + 1]
+                length_norm = 1 - self.b + self.b * self.doc_lengths[chunk_id] / (self.avg_length or 1)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * freq * (self.k1 + 1) / (freq + self.k1 * length_norm)
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def to_dict(self):
+        return {"k1": self.k1, "b": self.b, "doc_lengths": self.doc_lengths, "postings": self.postings}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["postings"], data["doc_lengths"], k1=data["k1"], b=data["b"])
+
+    def save(self, path, **extra):
+        """Write the index, plus any extra top-level fields, as compact JSON."""
+        with open(path, "w") as f:
+            json.dump(dict(extra, index=self.to_dict()), f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Returns:
+            tuple: (BM25Index, dict of the extra fields saved with it)
+        """
+        with open(path, "r") as f:
+            data = json.load(f)
+        return cls.from_dict(data.pop("index")), data
@@ -0,0 +1,299 @@
+"""
+Bulk ingestion of a directory or manifest of PDFs, run with `flask bulk-ingest`.
+
+Files move through three stages:
+
+1. A process pool extracts each PDF's pages and copies the file into the
+   upload folder under its content hash.
+2. A thread pool indexes the text with the configured backend, including
+   embedding. Extraction pauses when too many documents are waiting here,
+   so memory stays bounded however large the backlog.
+3. The main thread writes Document rows in batched transactions.
+
+Identical content is indexed once and shared, as with web uploads. After
+each transaction the files it covered are appended to a JSONL checkpoint,
+so an interrupted run skips them when started again.
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+import multiprocessing
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from models import db, Document
+from utils.pdf_processor import extract_pages_from_pdf, extract_outline
+from utils.uploads import READ_SIZE, part_path, store_content_addressed
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+def iter_sources(source):
+    """
+    List the PDFs to ingest
+
+    Args:
+        source (str): A directory, searched recursively for .pdf files, or a
+            manifest file with one path per line, or one JSON object per
+            line with "path" and optionally "filename". Relative manifest
+            paths are relative to the manifest; blank lines and lines
+            starting with # are ignored.
+
+    Returns:
+        list: (path, filename) tuples
+    """
+    if os.path.isdir(source):
+        found = []
+        for directory, subdirectories, filenames in os.walk(source):
+            subdirectories.sort()
+            found.extend((os.path.join(directory, name), name)
+                         for name in sorted(filenames) if name.lower().endswith(".pdf"))
+        return found
+
+    base = os.path.dirname(os.path.abspath(source))
+    found = []
+    with open(source, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                path, filename = entry["path"], entry.get("filename")
+            else:
+                path, filename = line, None
+            path = os.path.join(base, path)
+            found.append((path, filename or os.path.basename(path)))
+    return found
+
+def prepare_file(path, upload_folder):
+    """
+    Extract a PDF's pages and store a copy under its content hash; runs in a worker process
+
+    Returns:
+        tuple: (stored path, content hash, page texts, outline)
+    """
+    # Extract first, so a broken PDF leaves nothing behind in the upload folder
+    pages = extract_pages_from_pdf(path, workers=1)
+    outline = extract_outline(path)
+
+    hasher = hashlib.sha256()
+    temp_path = part_path(upload_folder, uuid.uuid4().hex)
+    try:
+        with open(path, "rb") as source, open(temp_path, "wb") as out:
+            for chunk in iter(lambda: source.read(READ_SIZE), b""):
+                hasher.update(chunk)
+                out.write(chunk)
+        content_hash = hasher.hexdigest()
+        return store_content_addressed(temp_path, upload_folder, content_hash), content_hash, pages, outline
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def load_checkpoint(checkpoint_path):
+    """Checkpoint records of an earlier run, keyed by source path."""
+    done = {}
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash
+                    continue
+                done[record["path"]] = record
+    return done
+
+def append_checkpoint(checkpoint_path, records):
+    if not checkpoint_path or not records:
+        return
+    with open(checkpoint_path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+class _Item:
+    """One source file on its way through the pipeline"""
+
+    __slots__ = ("path", "filename", "filepath", "content_hash", "pages", "index_id", "backend", "status", "error")
+
+    def __init__(self, path, filename):
+        self.path = path
+        self.filename = filename
+        self.filepath = None
+        self.content_hash = None
+        self.pages = 0
+        self.index_id = None
+        self.backend = None
+        self.status = None
+        self.error = None
+
+def bulk_ingest(sources, index, upload_folder, checkpoint_path=None, extract_workers=None, index_workers=4,
+                batch_size=100, retry_failed=False, report=None, report_interval=10.0, backend=None):
+    """
+    Ingest many PDFs, resuming from a checkpoint
+
+    Must run inside a Flask app context.
+
+    Args:
+        sources (list): (path, filename) tuples, e.g. from iter_sources
+        index (callable): Called with (pages, filename, outline=outline)
+            on an indexing thread; returns the index_id
+        upload_folder (str): Where ingested files are stored
+        checkpoint_path (str): JSONL file recording finished files
+        extract_workers (int): Extraction processes; defaults to the CPU count
+        index_workers (int): Documents indexed at once
+        batch_size (int): Document rows written per transaction
+        retry_failed (bool): Try files that failed in an earlier run again
+        report (callable): Optional; called with the stats dict every
+            report_interval seconds and once at the end
+        backend (str): Name of the QA backend `index` writes with, recorded
+            on the documents it indexes
+
+    Returns:
+        dict: Counts, elapsed seconds, and throughput in docs/min and pages/min
+    """
+    extract_workers = extract_workers or os.cpu_count() or 1
+    finished = load_checkpoint(checkpoint_path)
+    todo = deque(_Item(path, filename) for path, filename in sources
+                 if path not in finished or (retry_failed and finished[path]["status"] == "failed"))
+
+    stats = {"total": len(sources), "resumed": len(sources) - len(todo), "ingested": 0, "duplicates": 0,
+             "skipped": 0, "failed": 0, "pages": 0}
+    start = time.perf_counter()
+
+    def snapshot():
+        elapsed = time.perf_counter() - start
+        completed = stats["ingested"] + stats["duplicates"]
+        return dict(stats, elapsed_seconds=round(elapsed, 1),
+                    docs_per_minute=round(completed / elapsed * 60, 1) if elapsed else 0.0,
+                    pages_per_minute=round(stats["pages"] / elapsed * 60, 1) if elapsed else 0.0)
+
+    pending_rows = []
+    failed_records = []
+
+    def flush():
+        """Write finished documents in one transaction, then checkpoint them."""
+        records = list(failed_records)
+        failed_records.clear()
+        if pending_rows:
+            now = datetime.utcnow()
+            documents = [Document(filename=item.filename, filepath=item.filepath, upload_date=now,
+                                  content_hash=item.content_hash, index_id=item.index_id, backend=item.backend,
+                                  status='ready')
+                         for item in pending_rows]
+            db.session.add_all(documents)
+            db.session.commit()
+            records.extend({"path": item.path, "status": item.status, "document_id": document.id,
+                            "index_id": item.index_id}
+                           for item, document in zip(pending_rows, documents))
+            pending_rows.clear()
+        append_checkpoint(checkpoint_path, records)
+
+    def finish(item, status, error=None):
+        item.status, item.error = status, error
+        if status == "failed":
+            stats["failed"] += 1
+            logger.error(f"Failed to ingest {item.path}: {error}")
+            failed_records.append({"path": item.path, "status": "failed", "error": error})
+        elif status == "skipped":
+            stats["skipped"] += 1
+            failed_records.append({"path": item.path, "status": "skipped"})
+        else:
+            stats["ingested" if status == "ready" else "duplicates"] += 1
+            stats["pages"] += item.pages
+            pending_rows.append(item)
+
+    # (index_id, backend) of content indexed during this run, and items
+    # waiting on content being indexed
+    indexed = {}
+    waiting = {}
+
+    def route(item, pages):
+        """Decide what an extracted file needs; returns True if it must be indexed."""
+        if Document.query.filter_by(content_hash=item.content_hash, filename=item.filename).first():
+            # Ingested by a run that stopped before checkpointing it
+            finish(item, "skipped")
+            return False
+        if item.content_hash in indexed:
+            item.index_id, item.backend = indexed[item.content_hash]
+            finish(item, "duplicate")
+            return False
+        if item.content_hash in waiting:
+            waiting[item.content_hash].append(item)
+            return False
+        existing = Document.query.filter_by(content_hash=item.content_hash, status='ready').filter(
+            Document.index_id != '').first()
+        if existing:
+            item.index_id, item.backend = indexed[item.content_hash] = existing.index_id, existing.backend
+            finish(item, "duplicate")
+            return False
+        waiting[item.content_hash] = []
+        return True
+
+    def run_index(item, pages, outline):
+        # Named after the stored file, as web uploads are
+        return index(pages, os.path.basename(item.filepath), outline=outline)
+
+    extract_pool = ProcessPoolExecutor(max_workers=extract_workers, mp_context=multiprocessing.get_context("spawn"))
+    index_pool = ThreadPoolExecutor(max_workers=index_workers, thread_name_prefix="bulk-index")
+    extracting, indexing, to_index = {}, {}, deque()
+    last_flush = last_report = time.perf_counter()
+    try:
+        while todo or extracting or indexing or to_index:
+            # Extraction runs ahead of indexing only by a bounded amount
+            while todo and len(extracting) + len(to_index) < extract_workers * 2:
+                item = todo.popleft()
+                extracting[extract_pool.submit(prepare_file, item.path, upload_folder)] = item
+            while to_index and len(indexing) < index_workers * 2:
+                item, pages, outline = to_index.popleft()
+                indexing[index_pool.submit(run_index, item, pages, outline)] = item
+
+            done, _ = wait(list(extracting) + list(indexing), timeout=1.0, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in extracting:
+                    item = extracting.pop(future)
+                    try:
+                        item.filepath, item.content_hash, pages, outline = future.result()
+                    except Exception as e:
+                        finish(item, "failed", str(e))
+                        continue
+                    item.pages = len(pages)
+                    if route(item, pages):
+                        to_index.append((item, pages, outline))
+                else:
+                    item = indexing.pop(future)
+                    followers = waiting.pop(item.content_hash, [])
+                    try:
+                        item.index_id, item.backend = indexed[item.content_hash] = future.result(), backend
+                    except Exception as e:
+                        for failed in [item] + followers:
+                            finish(failed, "failed", str(e))
+                        continue
+                    finish(item, "ready")
+                    for follower in followers:
+                        follower.index_id, follower.backend = item.index_id, item.backend
+                        finish(follower, "duplicate")
+
+            now = time.perf_counter()
+            if len(pending_rows) >= batch_size or (pending_rows or failed_records) and now - last_flush >= 5.0:
+                flush()
+                last_flush = now
+            if report and now - last_report >= report_interval:
+                report(snapshot())
+                last_report = now
+    finally:
+        # Whatever finished before an interruption is still recorded
+        flush()
+        extract_pool.shutdown(wait=False, cancel_futures=True)
+        index_pool.shutdown(wait=True, cancel_futures=True)
+
+    summary = snapshot()
+    if report:
+        report(summary)
+    return summary
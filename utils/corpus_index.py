@@ -0,0 +1,549 @@
+"""
+Library-wide approximate nearest neighbour index over every document's chunks.
+
+The index is an inverted-file (IVF) structure: vectors are assigned to the
+nearest of `nlist` k-means centroids, and a search only scores the vectors
+in the `nprobe` lists closest to the query. Vectors are kept sorted by list,
+so each probed list is one contiguous slice of a memory-mapped file. New
+documents are appended to a small unsorted tail; once it outgrows
+CORPUS_TAIL_FRACTION of the sorted part, both are merged into a new
+generation of files, dropping removed documents. The centroids are fitted
+again whenever the index has grown CORPUS_RETRAIN_GROWTH times since the
+last training. A search never loads per-document indexes.
+
+Layout under storage/.corpus/ (<g> is the generation in the manifest):
+    manifest.json            counts, dimension, embedding model, nlist,
+                             generation, removed documents
+    ivf.<g>.centroids.npy    float32 (nlist, dimension) coarse quantizer
+    ivf.<g>.offsets.i64      int64 (nlist + 1) start of each list
+    ivf.<g>.vectors.f32      float32 normalized embeddings, sorted by list
+    ivf.<g>.owners.i32       int32 document number per vector
+    ivf.<g>.positions.i32    int32 node position within the document's own store
+    tail.<g>.*.f32/.i32      vectors, lists, owners and positions appended
+                             since the merge, in insertion order
+    documents.txt            index_id per document number, one per line
+
+Rebuild (retrain centroids, drop removed documents, backfill existing
+storage) with:
+    python -m utils.corpus_index rebuild [--embedding-model MODEL]
+"""
+import os
+import json
+import logging
+import argparse
+import threading
+import numpy as np
+from contextlib import contextmanager
+from utils.vector_store import MemmapVectorStore, has_vector_store
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+STORAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'storage')
+CORPUS_DIR = os.path.join(STORAGE_DIR, ".corpus")
+
+CORPUS_INDEX_ENABLED = os.environ.get("CORPUS_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+# Below this many vectors every search is exact; above it centroids are trained
+CORPUS_TRAIN_MIN_VECTORS = int(os.environ.get("CORPUS_TRAIN_MIN_VECTORS", 20000))
+CORPUS_NPROBE = int(os.environ.get("CORPUS_NPROBE", 16))
+# Centroids are fitted again once the index has grown by this factor since the last training
+CORPUS_RETRAIN_GROWTH = float(os.environ.get("CORPUS_RETRAIN_GROWTH", 2.0))
+# Unsorted vectors, as a share of the list-ordered ones, that trigger a merge
+CORPUS_TAIL_FRACTION = float(os.environ.get("CORPUS_TAIL_FRACTION", 0.1))
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    """Spherical k-means over normalized vectors; returns normalized centroids."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        counts = np.bincount(assignments, minlength=k)
+        # Empty clusters keep their previous centroid
+        filled = counts > 0
+        centroids[filled] = sums[filled]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+class CorpusIndex:
+    """IVF index shared by every worker process through files in corpus_dir."""
+
+    def __init__(self, corpus_dir=CORPUS_DIR, train_min_vectors=CORPUS_TRAIN_MIN_VECTORS, nprobe=CORPUS_NPROBE,
+                 retrain_growth=CORPUS_RETRAIN_GROWTH, tail_fraction=CORPUS_TAIL_FRACTION):
+        self.corpus_dir = corpus_dir
+        self.train_min_vectors = train_min_vectors
+        self.nprobe = nprobe
+        self.retrain_growth = retrain_growth
+        self.tail_fraction = tail_fraction
+        self._lock = threading.Lock()
+        self._reader = None  # (manifest mtime, loaded arrays)
+
+    def _path(self, name):
+        return os.path.join(self.corpus_dir, name)
+
+    @staticmethod
+    def _files(manifest, generation=None):
+        """File names of one generation; indexes written before generations used plain names."""
+        generation = manifest.get("generation") if generation is None else generation
+        if generation is None:
+            return {"centroids": "centroids.npy", "vectors": "vectors.f32", "lists": "lists.i32",
+                    "owners": "owners.i32", "positions": "positions.i32"}
+        return {
+            "centroids": f"ivf.{generation}.centroids.npy",
+            "offsets": f"ivf.{generation}.offsets.i64",
+            "ivf_vectors": f"ivf.{generation}.vectors.f32",
+            "ivf_owners": f"ivf.{generation}.owners.i32",
+            "ivf_positions": f"ivf.{generation}.positions.i32",
+            "vectors": f"tail.{generation}.vectors.f32",
+            "lists": f"tail.{generation}.lists.i32",
+            "owners": f"tail.{generation}.owners.i32",
+            "positions": f"tail.{generation}.positions.i32",
+        }
+
+    def _map(self, name, dtype, shape):
+        """Memory-map a raw array file read-only; np.memmap cannot map empty files."""
+        if not shape[0]:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(self._path(name), dtype=dtype, mode="r", shape=shape)
+
+    @contextmanager
+    def _exclusive(self):
+        """Serialize writers across threads and processes."""
+        with self._lock:
+            os.makedirs(self.corpus_dir, exist_ok=True)
+            with open(self._path("lock"), "w") as handle:
+                if fcntl:
+                    fcntl.flock(handle, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if fcntl:
+                        fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _read_manifest(self):
+        path = self._path("manifest.json")
+        if not os.path.exists(path):
+            return {"count": 0, "documents": 0, "dimension": None, "nlist": 1, "removed": [],
+                    "generation": 0, "sealed": 0, "trained_count": 0}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        # Readers only look at the first `count` rows, so publishing the new
+        # manifest last makes appended vectors visible atomically
+        temp_path = self._path("manifest.json.tmp")
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f, separators=(",", ":"))
+        os.replace(temp_path, self._path("manifest.json"))
+
+    def _document_ids(self):
+        path = self._path("documents.txt")
+        if not os.path.exists(path):
+            return []
+        with open(path, "r") as f:
+            return f.read().split()
+
+    def _truncate_to(self, manifest):
+        """Drop rows a crashed writer appended without publishing them."""
+        dimension = manifest["dimension"] or 0
+        tail = manifest["count"] - manifest.get("sealed", 0)
+        files = self._files(manifest)
+        for key, row_bytes in (("vectors", 4 * dimension), ("lists", 4), ("owners", 4), ("positions", 4)):
+            path = self._path(files[key])
+            if os.path.exists(path) and os.path.getsize(path) > tail * row_bytes:
+                os.truncate(path, tail * row_bytes)
+        documents = self._document_ids()
+        if len(documents) > manifest["documents"]:
+            with open(self._path("documents.txt"), "w") as f:
+                f.writelines(index_id + "\n" for index_id in documents[:manifest["documents"]])
+
+    def add_index(self, index_id, persist_dir=None):
+        """
+        Append the vectors of one document's store to the corpus index.
+
+        Args:
+            index_id (str): Document index to add
+            persist_dir (str): Its storage directory; defaults to storage/<index_id>
+
+        Returns:
+            int: Number of vectors added (0 if the document was already indexed
+            or has no vector store)
+        """
+        persist_dir = persist_dir or os.path.join(STORAGE_DIR, index_id)
+        if not has_vector_store(persist_dir):
+            return 0
+        store = MemmapVectorStore(persist_dir)
+        vectors = np.asarray(store.embeddings, dtype=np.float32)
+
+        with self._exclusive():
+            manifest = self._read_manifest()
+            self._truncate_to(manifest)
+            removed = set(manifest["removed"])
+            if any(value == index_id and number not in removed
+                   for number, value in enumerate(self._document_ids())):
+                return 0
+            if not len(vectors):
+                return 0
+            if manifest["dimension"] is None:
+                manifest["dimension"] = int(vectors.shape[1])
+                manifest["embedding_model"] = store.embedding_model
+            elif vectors.shape[1] != manifest["dimension"]:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match "
+                                 f"corpus dimension {manifest['dimension']}")
+            elif store.embedding_model != manifest.get("embedding_model", store.embedding_model):
+                raise ValueError(f"Embedding model {store.embedding_model} does not match "
+                                 f"corpus model {manifest['embedding_model']}")
+
+            # New vectors go to the unsorted tail until the next merge
+            files = self._files(manifest)
+            document_number = manifest["documents"]
+            lists = self._assign(vectors, manifest)
+            with open(self._path(files["vectors"]), "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._path(files["lists"]), "ab") as f:
+                f.write(lists.astype(np.int32).tobytes())
+            with open(self._path(files["owners"]), "ab") as f:
+                f.write(np.full(len(vectors), document_number, dtype=np.int32).tobytes())
+            with open(self._path(files["positions"]), "ab") as f:
+                f.write(np.arange(len(vectors), dtype=np.int32).tobytes())
+            with open(self._path("documents.txt"), "a") as f:
+                f.write(index_id + "\n")
+
+            manifest["count"] += len(vectors)
+            manifest["documents"] += 1
+            self._write_manifest(manifest)
+
+            count, sealed = manifest["count"], manifest.get("sealed", 0)
+            # Indexes trained before trained_count was recorded count as trained at their size
+            trained = manifest.get("trained_count") or (count if manifest["nlist"] > 1 else 0)
+            if not trained:
+                if count >= self.train_min_vectors:
+                    self._merge(manifest, retrain=True)
+            elif count >= self.retrain_growth * trained:
+                self._merge(manifest, retrain=True)
+            elif count - sealed > self.tail_fraction * sealed:
+                self._merge(manifest)
+
+        logger.debug(f"Added {len(vectors)} vectors from {index_id} to the corpus index")
+        return len(vectors)
+
+    def remove_index(self, index_id):
+        """Hide a document from search; its rows are dropped by the next merge."""
+        with self._exclusive():
+            manifest = self._read_manifest()
+            documents = self._document_ids()[:manifest["documents"]]
+            numbers = [number for number, value in enumerate(documents) if value == index_id]
+            if not numbers:
+                return False
+            manifest["removed"] = sorted(set(manifest["removed"]) | set(numbers))
+            self._write_manifest(manifest)
+        return True
+
+    def _assign(self, vectors, manifest):
+        if manifest["nlist"] == 1:
+            return np.zeros(len(vectors), dtype=np.int32)
+        centroids = np.load(self._path(self._files(manifest)["centroids"]))
+        return np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+    def _merge(self, manifest, retrain=False):
+        """
+        Write a new generation with every live vector sorted by list; caller holds the lock.
+
+        The tail is folded into the list-ordered segment and rows of removed
+        documents are dropped. With retrain, centroids are fitted again for
+        the current size first and every vector is reassigned.
+        """
+        count, dimension = manifest["count"], manifest["dimension"]
+        sealed = manifest.get("sealed", 0)
+        old, new_generation = self._files(manifest), manifest.get("generation", -1) + 1
+        new = self._files(manifest, new_generation)
+
+        if sealed:
+            offsets = np.fromfile(self._path(old["offsets"]), dtype=np.int64)
+            sealed_vectors = self._map(old["ivf_vectors"], np.float32, (sealed, dimension))
+            sealed_owners = np.fromfile(self._path(old["ivf_owners"]), dtype=np.int32)
+            sealed_positions = np.fromfile(self._path(old["ivf_positions"]), dtype=np.int32)
+            sealed_lists = np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))
+        else:
+            sealed_vectors = np.empty((0, dimension), dtype=np.float32)
+            sealed_owners = sealed_positions = sealed_lists = np.empty(0, dtype=np.int32)
+        tail = count - sealed
+        tail_vectors = self._map(old["vectors"], np.float32, (tail, dimension))
+        tail_owners = self._map(old["owners"], np.int32, (tail,))
+        tail_positions = self._map(old["positions"], np.int32, (tail,))
+        tail_lists = self._map(old["lists"], np.int32, (tail,))
+
+        def rows(ids):
+            """Vectors of combined row ids: sealed rows first, then the tail."""
+            out = np.empty((len(ids), dimension), dtype=np.float32)
+            in_sealed = ids < sealed
+            out[in_sealed] = sealed_vectors[ids[in_sealed]]
+            out[~in_sealed] = tail_vectors[ids[~in_sealed] - sealed]
+            return out
+
+        owners = np.concatenate([sealed_owners, tail_owners])
+        removed_mask = np.zeros(manifest["documents"], dtype=bool)
+        removed_mask[manifest["removed"]] = True
+        live = np.flatnonzero(~removed_mask[owners])
+
+        nlist = manifest["nlist"]
+        if retrain and len(live):
+            nlist = int(min(4096, max(1, np.sqrt(len(live)))))
+            sample = np.sort(np.random.default_rng(0).choice(live, min(len(live), nlist * 64), replace=False))
+            centroids = kmeans(rows(sample), nlist)
+            lists = np.empty(len(live), dtype=np.int32)
+            for start in range(0, len(live), 65536):
+                chunk = live[start:start + 65536]
+                lists[start:start + 65536] = np.argmax(rows(chunk) @ centroids.T, axis=1)
+            manifest["trained_count"] = len(live)
+        else:
+            centroids = np.load(self._path(old["centroids"])) if nlist > 1 else None
+            lists = np.concatenate([sealed_lists, tail_lists])[live]
+
+        # A stable sort keeps each list in insertion order
+        order = live[np.argsort(lists, kind="stable")]
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=nlist), out=offsets[1:])
+        positions = np.concatenate([sealed_positions, tail_positions])
+        with open(self._path(new["ivf_vectors"]), "wb") as f:
+            for start in range(0, len(order), 65536):
+                f.write(rows(order[start:start + 65536]).tobytes())
+        owners[order].astype(np.int32).tofile(self._path(new["ivf_owners"]))
+        positions[order].astype(np.int32).tofile(self._path(new["ivf_positions"]))
+        offsets.tofile(self._path(new["offsets"]))
+        if centroids is not None:
+            np.save(self._path(new["centroids"]), centroids)
+        for key in ("vectors", "lists", "owners", "positions"):
+            open(self._path(new[key]), "wb").close()
+
+        manifest.setdefault("trained_count", len(order))
+        manifest.update({"generation": new_generation, "sealed": len(order), "count": len(order), "nlist": nlist})
+        self._write_manifest(manifest)
+        # Readers that mapped the old generation keep their (unlinked) files
+        for name in set(old.values()) - set(new.values()):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        logger.debug(f"Merged corpus index generation {new_generation}: {len(order)} vectors in {nlist} lists"
+                     f"{' (retrained)' if retrain else ''}")
+
+    def _load(self):
+        """Memory-map the published part of the index, reusing maps until it changes."""
+        manifest_path = self._path("manifest.json")
+        for _ in range(3):
+            if not os.path.exists(manifest_path):
+                return None
+            mtime = os.stat(manifest_path).st_mtime_ns
+            reader = self._reader
+            if reader is not None and reader[0] == mtime:
+                return reader[1]
+            try:
+                state = self._open(self._read_manifest())
+            except FileNotFoundError:
+                # A merge replaced the generation between reading the manifest and the files
+                continue
+            self._reader = (mtime, state)
+            return state
+        raise Exception("Corpus index files kept changing while loading")
+
+    def _open(self, manifest):
+        count, dimension = manifest["count"], manifest["dimension"]
+        if not count:
+            return None
+        files = self._files(manifest)
+        sealed = manifest.get("sealed", 0)
+        tail = count - sealed
+        removed_mask = np.zeros(manifest["documents"], dtype=bool)
+        removed_mask[manifest["removed"]] = True
+        return {
+            "manifest": manifest,
+            "offsets": np.fromfile(self._path(files["offsets"]), dtype=np.int64) if sealed else None,
+            "ivf_vectors": self._map(files.get("ivf_vectors"), np.float32, (sealed, dimension)),
+            "ivf_owners": self._map(files.get("ivf_owners"), np.int32, (sealed,)),
+            "ivf_positions": self._map(files.get("ivf_positions"), np.int32, (sealed,)),
+            "vectors": self._map(files["vectors"], np.float32, (tail, dimension)),
+            "lists": self._map(files["lists"], np.int32, (tail,)),
+            "owners": self._map(files["owners"], np.int32, (tail,)),
+            "positions": self._map(files["positions"], np.int32, (tail,)),
+            "centroids": np.load(self._path(files["centroids"])) if manifest["nlist"] > 1 else None,
+            "documents": self._document_ids()[:manifest["documents"]],
+            "removed": removed_mask,
+        }
+
+    def search(self, query_embedding, top_k=10, nprobe=None):
+        """
+        Find the chunks closest to a query across the whole library.
+
+        Only the probed lists of the list-ordered segment are read, each as
+        one contiguous slice, plus the matching rows of the small unsorted
+        tail of vectors added since the last merge.
+
+        Returns:
+            list: (index_id, position, score) tuples, best first; position
+            indexes into that document's own vector store
+        """
+        state = self._load()
+        if state is None:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+
+        if state["centroids"] is not None:
+            nlist = len(state["centroids"])
+            probe = np.argsort(-(state["centroids"] @ query))[:nprobe or self.nprobe]
+            probed = np.zeros(nlist, dtype=bool)
+            probed[probe] = True
+            tail_rows = np.flatnonzero(probed[state["lists"]])
+        else:
+            probe = np.arange(1)
+            tail_rows = np.arange(len(state["lists"]))
+
+        vectors, owners, positions = [], [], []
+        if state["offsets"] is not None:
+            for list_number in np.sort(probe):
+                start, end = state["offsets"][list_number], state["offsets"][list_number + 1]
+                if end > start:
+                    vectors.append(state["ivf_vectors"][start:end])
+                    owners.append(state["ivf_owners"][start:end])
+                    positions.append(state["ivf_positions"][start:end])
+        if len(tail_rows):
+            vectors.append(state["vectors"][tail_rows])
+            owners.append(state["owners"][tail_rows])
+            positions.append(state["positions"][tail_rows])
+        if not vectors:
+            return []
+
+        owners, positions = np.concatenate(owners), np.concatenate(positions)
+        scores = np.concatenate([block @ query for block in vectors])
+        live = ~state["removed"][owners]
+        if not live.all():
+            owners, positions, scores = owners[live], positions[live], scores[live]
+        if not len(scores):
+            return []
+
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+        return [(state["documents"][owners[i]], int(positions[i]), float(scores[i])) for i in best]
+
+    def stats(self):
+        manifest = self._read_manifest()
+        return {
+            "vectors": manifest["count"],
+            "documents": manifest["documents"] - len(manifest["removed"]),
+            "lists": manifest["nlist"],
+            "unsorted": manifest["count"] - manifest.get("sealed", 0),
+            "embedding_model": manifest.get("embedding_model"),
+        }
+
+    def rebuild(self, storage_dir=STORAGE_DIR, index_ids=None, embedding_model=None):
+        """
+        Recreate the index from the vector stores under storage_dir.
+
+        Args:
+            storage_dir (str): Directory holding one subdirectory per index_id
+            index_ids (iterable): Only add these indexes, e.g. those still
+                referenced by a Document; defaults to every store on disk
+            embedding_model (str): Only add stores embedded with this model;
+                defaults to the model of the first store added
+        """
+        index_ids = set(index_ids) if index_ids is not None else None
+        with self._exclusive():
+            for name in os.listdir(self.corpus_dir):
+                if name != "lock":
+                    os.remove(self._path(name))
+            self._reader = None
+
+        # Train once at the end rather than as the threshold is crossed
+        train_min_vectors, self.train_min_vectors = self.train_min_vectors, float("inf")
+        try:
+            for index_id in sorted(os.listdir(storage_dir)):
+                persist_dir = os.path.join(storage_dir, index_id)
+                if index_ids is not None and index_id not in index_ids:
+                    continue
+                if not index_id.startswith(".") and has_vector_store(persist_dir):
+                    if embedding_model and MemmapVectorStore(persist_dir).embedding_model != embedding_model:
+                        logger.warning(f"Skipping {index_id}: not embedded with {embedding_model}")
+                        continue
+                    try:
+                        self.add_index(index_id, persist_dir)
+                    except ValueError as e:
+                        logger.warning(f"Skipping {index_id}: {e}")
+        finally:
+            self.train_min_vectors = train_min_vectors
+
+        with self._exclusive():
+            manifest = self._read_manifest()
+            if manifest["count"] >= self.train_min_vectors:
+                self._merge(manifest, retrain=True)
+        return self.stats()
+
+def resolve_hits(hits, storage_dir=STORAGE_DIR):
+    """
+    Attach node records to search hits, opening each document's store once.
+
+    Returns:
+        list: dicts with index_id, score and the record fields (id, text, ...)
+    """
+    stores = {}
+    results = []
+    for index_id, position, score in hits:
+        if index_id not in stores:
+            stores[index_id] = MemmapVectorStore(os.path.join(storage_dir, index_id))
+        record = stores[index_id].get_records([position])[0]
+        results.append(dict(record, index_id=index_id, score=score))
+    return results
+
+def build_library_prompt(question, passages):
+    """
+    Build a prompt that answers a question from passages of several documents.
+
+    Args:
+        passages (list): dicts with "filename" and "text", best first
+
+    Returns:
+        str: Prompt asking for an answer that cites passages by number
+    """
+    sources = "\n\n".join(
+        f"[{number}] {passage['filename']}\n{passage['text']}"
+        for number, passage in enumerate(passages, start=1))
+    return f"""You are an AI assistant answering questions across a library of documents. Answer the following question based ONLY on the numbered excerpts below.
+
+Excerpts:
+{sources}
+
+Question: {question}
+
+Instructions:
+- Answer concisely and directly
+- Cite the excerpts you used by number, e.g. [1] or [2][3]
+- If the excerpts do not contain the answer, state "Not found in the library"
+- Do not include unrelated details
+
+Answer:"""
+
+# Shared instance used by the web app and ingestion workers
+corpus_index = CorpusIndex()
+
+def main():
+    parser = argparse.ArgumentParser(description="Library-wide corpus index tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subparsers.add_parser("rebuild", help="Retrain and rebuild from all document stores")
+    rebuild_parser.add_argument("--embedding-model",
+                                help="Only index documents embedded with this model, e.g. local/hashing-384")
+    subparsers.add_parser("stats", help="Show index size")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        print(corpus_index.rebuild(embedding_model=args.embedding_model))
+    else:
+        print(corpus_index.stats())
+
+if __name__ == "__main__":
+    main()
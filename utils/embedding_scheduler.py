@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 100))
+EMBED_CONCURRENCY = int(os.environ.get("EMBED_CONCURRENCY", 4))
+EMBED_REQUESTS_PER_SECOND = float(os.environ.get("EMBED_REQUESTS_PER_SECOND", 5))
+EMBED_MAX_RETRIES = int(os.environ.get("EMBED_MAX_RETRIES", 6))
+
+def is_rate_limit_error(error):
+    """Whether an API error means the request should be retried later."""
+    error_msg = str(error).lower()
+    return ("429" in error_msg or "quota" in error_msg or "rate limit" in error_msg or
+            "resource exhausted" in error_msg or "resource_exhausted" in error_msg)
+
+def chunk_key(text):
+    """Stable key for a chunk's text, used to match checkpointed embeddings."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class TokenBucket:
+    """Thread-safe token bucket that paces requests to a steady rate."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then take it."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self):
+        """Empty the bucket, e.g. after the server reported a rate limit."""
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+class EmbeddingScheduler:
+    """
+    Embed many chunks with batched, concurrent requests.
+
+    Batches are sent from a thread pool, paced by a token bucket. Rate-limit
+    errors are retried with exponential backoff and full jitter. With a
+    checkpoint path, every finished batch is appended to a JSONL file keyed by
+    chunk hash, so a failed run can be resumed without re-embedding.
+    """
+
+    def __init__(self, embed_batch, batch_size=EMBED_BATCH_SIZE, max_concurrency=EMBED_CONCURRENCY,
+                 requests_per_second=EMBED_REQUESTS_PER_SECOND, max_retries=EMBED_MAX_RETRIES,
+                 base_delay=1.0, max_delay=60.0):
+        """
+        Args:
+            embed_batch (callable): Maps a list of texts to a list of embeddings
+                with a single request
+        """
+        self.embed_batch = embed_batch
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(requests_per_second)
+
+    def embed(self, texts, checkpoint_path=None, known=None):
+        """
+        Embed texts, resuming from a checkpoint when one exists.
+
+        Args:
+            texts (list): Chunk texts to embed
+            checkpoint_path (str): Optional JSONL file of already-embedded chunks;
+                removed once every chunk is embedded
+            known (dict): Optional embeddings by chunk_key, e.g. from a previous
+                version of the document; matching chunks are not sent again
+
+        Returns:
+            list: One embedding per text, in order
+        """
+        keys = [chunk_key(text) for text in texts]
+        done = dict(known) if known else {}
+        if checkpoint_path:
+            done.update(self._load_checkpoint(checkpoint_path))
+
+        pending = [i for i, key in enumerate(keys) if key not in done]
+        if done:
+            logger.debug(f"Reusing embeddings for {len(texts) - len(pending)} of {len(texts)} chunks")
+
+        batches = [pending[start:start + self.batch_size] for start in range(0, len(pending), self.batch_size)]
+        checkpoint_lock = threading.Lock()
+
+        def run_batch(positions):
+            embeddings = self._embed_with_retry([texts[i] for i in positions])
+            records = {keys[i]: embedding for i, embedding in zip(positions, embeddings)}
+            with checkpoint_lock:
+                done.update(records)
+                if checkpoint_path:
+                    self._append_checkpoint(checkpoint_path, records)
+
+        if batches:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+                # list() re-raises the first batch failure after the others finish
+                list(executor.map(run_batch, batches))
+
+        if checkpoint_path and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        return [done[key] for key in keys]
+
+    def _embed_with_retry(self, texts):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                embeddings = self.embed_batch(texts)
+                if len(embeddings) != len(texts):
+                    raise ValueError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+                return embeddings
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                # Everyone shares the quota, so slow the whole pool down
+                self.bucket.drain()
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                logger.warning(f"Embedding rate limited (attempt {attempt + 1}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_path):
+        done = {}
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash can leave the last line half written
+                        continue
+                    done[record["key"]] = record["embedding"]
+        return done
+
+    @staticmethod
+    def _append_checkpoint(checkpoint_path, records):
+        with open(checkpoint_path, "a") as f:
+            for key, embedding in records.items():
+                f.write(json.dumps({"key": key, "embedding": list(embedding)}, separators=(",", ":")) + "\n")
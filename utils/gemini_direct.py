@@ -1,9 +1,28 @@
 import os
 import uuid
+import asyncio
 import logging
 import json
 import google.generativeai as genai
 from dotenv import load_dotenv
+from utils.bm25 import BM25Index, chunk_text, chunk_spans, estimate_tokens
+from utils.hybrid_retrieval import select_within_budget, merge_passages
+from utils.index_cache import IndexCache
+from utils.answer_cache import answer_cache
+from utils.vector_store import write_vector_store, known_embeddings
+from utils.text_store import write_text, read_text
+from utils.summary_tree import SummaryTree, wants_summary_tree
+from utils.embedding_scheduler import EmbeddingScheduler, chunk_key
+from utils.local_embedding import (LOCAL_EMBEDDINGS, embed_chunks, embed_texts, local_model_id,
+                                   embed_documents as embed_documents_locally)
+from utils.pdf_processor import page_spans
+from utils.versioning import page_hashes, page_of_offsets, save_page_hashes, changed_pages
+from utils.metrics import span, timed, record_tokens
+from utils.corpus_index import CORPUS_INDEX_ENABLED, build_library_prompt
+from utils.batch_qa import BatchContext, answer_batch
+from utils.backends import per_process
+from utils.model_clients import (configure_gemini, model_slot, amodel_slot, native_async, iterate_in_thread,
+                                  Overloaded)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -11,19 +30,147 @@ load_dotenv()
 # Configure logging
 logger = logging.getLogger(__name__)
 
-# Get Google API Key from environment variable
-GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
+# Index storage; each document's directory is created when it is processed
+STORAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'storage')
 
-# Configure Gemini
-genai.configure(api_key=GOOGLE_API_KEY)
+# How much of the document goes into the prompt: "full" always sends the whole
+# text, "retrieval" sends the best-matching passages, and "auto" sends the
+# whole text only for documents under FULL_CONTEXT_MAX_TOKENS
+CONTEXT_MODE = os.environ.get("GEMINI_DIRECT_CONTEXT_MODE", "auto")
+FULL_CONTEXT_MAX_TOKENS = int(os.environ.get("GEMINI_DIRECT_FULL_CONTEXT_MAX_TOKENS", 8000))
+RETRIEVAL_TOP_K = int(os.environ.get("GEMINI_DIRECT_TOP_K", 8))
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get("GEMINI_DIRECT_CONTEXT_TOKENS", 4000))
+CHUNK_TOKENS = int(os.environ.get("GEMINI_DIRECT_CHUNK_TOKENS", 300))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("GEMINI_DIRECT_CHUNK_OVERLAP_TOKENS", 50))
 
-# Create storage directory if it doesn't exist
-STORAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'storage')
-os.makedirs(STORAGE_DIR, exist_ok=True)
+# Embedding model for library search passages and for matching near-duplicate
+# questions in the answer cache, unless EMBEDDING_BACKEND=local
+EMBEDDING_MODEL = "models/text-embedding-004"
+GENERATION_MODEL = "gemini-2.5-flash"
+
+# Loaded document text and lexical index per index_id
+document_cache = IndexCache(
+    max_bytes=int(os.environ.get("INDEX_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+    max_entries=int(os.environ.get("INDEX_CACHE_MAX_ENTRIES", 32))
+)
+
+@per_process
+def get_model():
+    """Generation model shared by all requests in this process."""
+    configure_gemini()
+    return genai.GenerativeModel(GENERATION_MODEL)
+
+def build_lexical_index(text, persist_dir, spans=None):
+    """
+    Chunk document text and persist a BM25 index over the chunks
+    
+    Chunks are saved as character offsets into the document text, so the
+    passage text is not stored twice. With page spans, chunks never
+    cross a page boundary.
+    
+    Returns:
+        tuple: (BM25Index, list of (start, end) chunk offsets)
+    """
+    with span("chunking", backend="gemini_direct"):
+        if spans:
+            chunks = chunk_spans(text, spans, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+        else:
+            chunks = chunk_text(text, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+        lexical_index = BM25Index.build([text[start:end] for start, end in chunks])
+    lexical_index.save(os.path.join(persist_dir, "lexical_index.json"), chunks=chunks)
+    return lexical_index, chunks
+
+@timed("index_load", backend="gemini_direct")
+def load_document_direct(persist_dir):
+    """
+    Load document data and its lexical index from a persist directory
+    
+    Documents processed before the lexical index existed get one built here.
+    The text comes from text.zst, or from document_data.json itself for
+    documents stored before text was compressed.
+    
+    Returns:
+        dict: document_data.json contents plus "text", "lexical_index",
+        "chunks" and "summary_tree" (None for documents without one)
+    """
+    document_file = os.path.join(persist_dir, "document_data.json")
+    with open(document_file, "r") as f:
+        document_data = json.load(f)
+    if "text" not in document_data:
+        document_data["text"] = read_text(persist_dir)
+    
+    lexical_index_file = os.path.join(persist_dir, "lexical_index.json")
+    if os.path.exists(lexical_index_file):
+        lexical_index, extra = BM25Index.load(lexical_index_file)
+        chunks = extra["chunks"]
+    else:
+        lexical_index, chunks = build_lexical_index(document_data["text"], persist_dir)
+    
+    document_data["lexical_index"] = lexical_index
+    document_data["chunks"] = chunks
+    document_data["summary_tree"] = SummaryTree.load(persist_dir)
+    return document_data
+
+def select_passages(document_data, question, top_k=None, token_budget=None):
+    """
+    Pick the passages that best match a question within a token budget
+    
+    Overlapping or adjacent chunks are merged into one passage.
+    
+    Returns:
+        list: Passage strings in document order
+    """
+    text = document_data["text"]
+    chunks = document_data["chunks"]
+    selected = [{"text": "", "start": chunks[chunk_id][0], "end": chunks[chunk_id][1], "score": 0.0}
+                for chunk_id in select_chunks(document_data, question, top_k, token_budget)]
+    return [passage["text"] for passage in merge_passages(selected, text)]
 
-def process_document_direct(text, filename):
+@timed("retrieval", backend="gemini_direct")
+def select_chunks(document_data, question, top_k=None, token_budget=None):
+    """
+    Pick the chunks that best match a question within a token budget
+    
+    The overlap with chunks already picked is not counted against the
+    budget, since merged passages send it only once.
+    
+    Returns:
+        list: Chunk ids in document order
+    """
+    top_k = RETRIEVAL_TOP_K if top_k is None else top_k
+    token_budget = RETRIEVAL_TOKEN_BUDGET if token_budget is None else token_budget
+    text = document_data["text"]
+    chunks = document_data["chunks"]
+    
+    ranked = document_data["lexical_index"].search(question, top_k)
+    if not ranked:
+        # Nothing matched lexically; fall back to the start of the document
+        ranked = [(chunk_id, 0.0) for chunk_id in range(min(top_k, len(chunks)))]
+    
+    candidates = [{"text": text[chunks[chunk_id][0]:chunks[chunk_id][1]], "start": chunks[chunk_id][0],
+                   "end": chunks[chunk_id][1]} for chunk_id, _ in ranked]
+    return sorted(ranked[position][0] for position in select_within_budget(candidates, token_budget))
+
+def use_full_context(document_data):
+    """Whether a question should be sent with the whole document text."""
+    if CONTEXT_MODE == "full":
+        return True
+    if CONTEXT_MODE == "retrieval":
+        return False
+    return estimate_tokens(document_data["text"]) <= FULL_CONTEXT_MAX_TOKENS
+
+def process_document_direct(text, filename, pages=None, previous_index_id=None, outline=None):
     """
     Process document using direct Gemini API approach
+    
+    Args:
+        text (str): Extracted text from the document
+        filename (str): Original filename
+        pages (list): Optional page texts that text was joined from; enables
+            page-aligned chunking and, for long documents, the summary tree
+        previous_index_id (str): Index of the previous version of this
+            document; embeddings of unchanged chunks are carried forward
+        outline (list): Optional PDF outline, from pdf_processor.extract_outline
     """
     try:
         logger.debug(f"Processing document directly: {filename}")
@@ -32,57 +179,115 @@ def process_document_direct(text, filename):
         index_id = str(uuid.uuid4())
         persist_dir = os.path.join(STORAGE_DIR, index_id)
         os.makedirs(persist_dir, exist_ok=True)
+        previous_dir = os.path.join(STORAGE_DIR, previous_index_id) if previous_index_id else None
         
-        # Store document content directly
+        # Store the text compressed, and document_data.json, which marks the
+        # document as present, after it
+        write_text(persist_dir, text)
         document_data = {
             "index_id": index_id,
             "filename": filename,
-            "text": text,
             "word_count": len(text.split()),
             "char_count": len(text),
             "processed_at": "2025-11-07T16:26:00Z"
         }
         
         with open(os.path.join(persist_dir, "document_data.json"), "w") as f:
-            json.dump(document_data, f, indent=2)
+            json.dump(document_data, f, separators=(",", ":"))
+        
+        # Record page hashes so the next version can be diffed against this one
+        if pages:
+            hashes = page_hashes(pages)
+            save_page_hashes(persist_dir, hashes, changed_pages(previous_dir, hashes) if previous_dir else None)
+        
+        # Chunk once at ingest so questions can be answered from passages
+        spans = page_spans(pages) if pages else None
+        _, chunks = build_lexical_index(text, persist_dir, spans)
+        
+        # Summaries of long documents, for questions about whole sections
+        if pages and wants_summary_tree(text):
+            try:
+                with span("summaries", backend="gemini_direct"):
+                    SummaryTree.build(pages, generate_text, outline, filename,
+                                      previous=SummaryTree.load(previous_dir)).save(persist_dir)
+            except Exception as e:
+                logger.warning(f"Document will be answered without a summary tree: {str(e)}")
         
-        logger.debug(f"Successfully processed document. Word count: {document_data['word_count']}")
+        # Embed the passages so the document takes part in library search
+        if CORPUS_INDEX_ENABLED:
+            try:
+                passages = [text[start:end] for start, end in chunks]
+                model = embedding_model_id()
+                known = known_embeddings(previous_dir, model) if previous_dir else None
+                embed = embed_documents_locally if LOCAL_EMBEDDINGS else EmbeddingScheduler(embed_documents).embed
+                with span("embedding", backend="gemini_direct"):
+                    embeddings = embed_chunks(passages, model, embed, known=known)
+                chunk_pages = page_of_offsets(spans, [start for start, _ in chunks]) if spans else None
+                records = []
+                for i, (passage, (start, end)) in enumerate(zip(passages, chunks)):
+                    record = {"id": f"{index_id}:{i}", "text": passage, "hash": chunk_key(passage),
+                              "start": start, "end": end}
+                    if chunk_pages:
+                        record["page"] = chunk_pages[i]
+                    records.append(record)
+                write_vector_store(persist_dir, embeddings, records, {"filename": filename}, text=text,
+                                   embedding_model=model)
+            except Exception as e:
+                logger.warning(f"Document will not be searchable across the library: {str(e)}")
+        
+        logger.debug(f"Successfully processed document. Word count: {document_data['word_count']}, chunks: {len(chunks)}")
         return index_id
         
     except Exception as e:
         logger.error(f"Error processing document: {str(e)}")
         raise Exception(f"Failed to process document: {str(e)}")
 
-def query_document_direct(index_id, question):
+def get_document_data(index_id):
+    """Load a document's data through the document cache."""
+    persist_dir = os.path.join(STORAGE_DIR, index_id)
+    document_file = os.path.join(persist_dir, "document_data.json")
+    
+    if not os.path.exists(document_file):
+        raise Exception("Document not found. Please re-upload the document.")
+    
+    return document_cache.get(index_id, persist_dir, load_document_direct)
+
+def build_prompt(index_id, question):
     """
-    Query document using direct Gemini API with full document context
+    Load a document and build the prompt that answers a question about it
+    
+    Returns:
+        str: Prompt with full or retrieved document context
     """
-    try:
-        logger.debug(f"Querying document with index_id: {index_id}")
-        logger.debug(f"Question: {question}")
-        
-        # Load document data
-        persist_dir = os.path.join(STORAGE_DIR, index_id)
-        document_file = os.path.join(persist_dir, "document_data.json")
-        
-        if not os.path.exists(document_file):
-            raise Exception("Document not found. Please re-upload the document.")
-        
-        with open(document_file, "r") as f:
-            document_data = json.load(f)
-        
+    document_data = get_document_data(index_id)
+    filename = document_data["filename"]
+    
+    logger.debug(f"Loaded document: {filename} with {len(document_data['text'])} characters")
+    
+    full_context = use_full_context(document_data)
+    summary_tree = document_data["summary_tree"]
+    # Routing is only needed when the prompt will not carry the whole text
+    summaries = summary_tree.context(question, document_data["text"]) if summary_tree and not full_context else None
+    if full_context:
+        context_label = "Document Content"
         document_text = document_data["text"]
-        filename = document_data["filename"]
-        
-        logger.debug(f"Loaded document: {filename} with {len(document_text)} characters")
-        
-        # Create a concise prompt with the document context
-        prompt = f"""You are an AI assistant analyzing a document. Answer the following question based ONLY on the information in this document.
+    elif summaries:
+        context_label = "Document Summaries"
+        document_text = "\n\n".join(summaries)
+        logger.debug(f"Using {len(summaries)} summaries from the summary tree (~{estimate_tokens(document_text)} tokens)")
+    else:
+        context_label = "Relevant Excerpts"
+        passages = select_passages(document_data, question)
+        document_text = "\n\n[...]\n\n".join(passages)
+        logger.debug(f"Using {len(passages)} retrieved passages (~{estimate_tokens(document_text)} tokens)")
+    
+    # Create a concise prompt with the document context
+    return f"""You are an AI assistant analyzing a document. Answer the following question based ONLY on the information in this document.
 
 Document: {filename}
 Word Count: {document_data['word_count']}
 
-Document Content:
+{context_label}:
 {document_text}
 
 Question: {question}
@@ -96,30 +301,316 @@ Instructions:
 
 Answer:"""
 
+def token_usage(prompt, answer, response=None):
+    """
+    Tokens of one LLM call, from the response's usage metadata when it has any
+    
+    Returns:
+        tuple: (prompt tokens, response tokens)
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None and getattr(usage, "prompt_token_count", None):
+        return usage.prompt_token_count, usage.candidates_token_count or 0
+    return estimate_tokens(prompt), estimate_tokens(answer)
+
+def record_usage(prompt, answer, response=None):
+    """Count LLM tokens, from the response's usage metadata when it has any."""
+    record_tokens("gemini_direct", *token_usage(prompt, answer, response))
+
+def api_error(error_msg):
+    """Turn a raw Gemini API error message into a user-friendly exception."""
+    if "429" in error_msg or "quota" in error_msg.lower() or "rate limit" in error_msg.lower():
+        return Exception("API quota exceeded. Please try again later or check your API usage limits.")
+    elif "401" in error_msg or "unauthorized" in error_msg.lower():
+        return Exception("API authentication failed. Please check your Google API key.")
+    elif "403" in error_msg or "forbidden" in error_msg.lower():
+        return Exception("API access forbidden. Please verify your API key permissions.")
+    else:
+        return Exception(f"Failed to process question: {error_msg}")
+
+def query_document_direct(index_id, question):
+    """
+    Query document using direct Gemini API with full or retrieved document context
+    """
+    try:
+        logger.debug(f"Querying document with index_id: {index_id}")
+        logger.debug(f"Question: {question}")
+        
+        prompt = build_prompt(index_id, question)
+
         # Use Gemini to generate the response
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content(prompt)
-        answer = response.text
+        model = get_model()
+        with model_slot(), span("generation", backend="gemini_direct"):
+            response = model.generate_content(prompt)
+            answer = response.text
+        record_usage(prompt, answer, response)
         
         logger.debug(f"Successfully generated response. Answer length: {len(answer)}")
         logger.debug(f"Answer preview: {answer[:200]}...")
         
         return answer
         
+    except Overloaded:
+        raise
     except Exception as e:
         error_msg = str(e)
         logger.error(f"Error querying document: {error_msg}")
         
         # Provide more user-friendly error messages
-        if "429" in error_msg or "quota" in error_msg.lower() or "rate limit" in error_msg.lower():
-            raise Exception("API quota exceeded. Please try again later or check your API usage limits.")
-        elif "401" in error_msg or "unauthorized" in error_msg.lower():
-            raise Exception("API authentication failed. Please check your Google API key.")
-        elif "403" in error_msg or "forbidden" in error_msg.lower():
-            raise Exception("API access forbidden. Please verify your API key permissions.")
-        else:
-            raise Exception(f"Failed to process question: {error_msg}")
+        raise api_error(error_msg)
+
+def stream_query_document_direct(index_id, question):
+    """
+    Query document like query_document_direct, yielding the answer as it is generated
+    
+    Yields:
+        str: Successive pieces of the answer text
+    """
+    try:
+        logger.debug(f"Streaming query for index_id: {index_id}")
+        logger.debug(f"Question: {question}")
+        
+        prompt = build_prompt(index_id, question)
+        
+        model = get_model()
+        pieces = []
+        with model_slot(), span("generation", backend="gemini_direct"):
+            for chunk in model.generate_content(prompt, stream=True):
+                if chunk.text:
+                    pieces.append(chunk.text)
+                    yield chunk.text
+        record_usage(prompt, "".join(pieces))
+        
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error streaming answer: {error_msg}")
+        raise api_error(error_msg)
+
+def generate_text(prompt):
+    """Generate text for an ingest-time prompt, such as a summary."""
+    # Ingestion waits for a slot rather than being shed
+    with model_slot(shed=False):
+        response = get_model().generate_content(prompt)
+    record_usage(prompt, response.text, response)
+    return response.text
+
+def embedding_model_id():
+    """Model the passages and questions are embedded with."""
+    return local_model_id() if LOCAL_EMBEDDINGS else EMBEDDING_MODEL
+
+def embed_documents(texts):
+    """Embed passages with a single batchEmbedContents request."""
+    configure_gemini()
+    # Ingestion waits for a slot rather than being shed
+    with model_slot(shed=False):
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=texts, task_type="retrieval_document")
+    return result["embedding"]
+
+def answer_from_passages(question, passages):
+    """
+    Answer a question from passages drawn from several documents
+    
+    Args:
+        question (str): User's question
+        passages (list): dicts with "filename" and "text", best first
+        
+    Returns:
+        str: Answer citing the passages by number
+    """
+    try:
+        model = get_model()
+        prompt = build_library_prompt(question, passages)
+        with model_slot(), span("generation", backend="gemini_direct"):
+            response = model.generate_content(prompt)
+        record_usage(prompt, response.text, response)
+        return response.text
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error answering from library: {error_msg}")
+        raise api_error(error_msg)
+
+def embed_question(question):
+    """Embed a question for near-duplicate matching in the answer cache."""
+    if LOCAL_EMBEDDINGS:
+        with span("question_embedding", backend="gemini_direct"):
+            return embed_texts([question])[0]
+    configure_gemini()
+    with model_slot(), span("question_embedding", backend="gemini_direct"):
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=question, task_type="retrieval_query")
+    return result["embedding"]
+
+def query_document_cached(index_id, question):
+    """
+    Answer a question, reusing a cached answer for the same or a near-identical question
+    
+    Returns:
+        tuple: (answer, served_from_cache)
+    """
+    return answer_cache.get_or_compute(index_id, question, query_document_direct, embed=embed_question)
+
+def stream_query_document_cached(index_id, question):
+    """
+    Stream an answer, or replay a cached one as a single piece
+    
+    Returns:
+        tuple: (iterator of answer text pieces, served_from_cache)
+    """
+    return answer_cache.stream_or_compute(index_id, question, stream_query_document_direct, embed=embed_question)
+
+def embed_questions(questions):
+    """Embed several questions with a single batchEmbedContents request."""
+    if LOCAL_EMBEDDINGS:
+        with span("question_embedding", backend="gemini_direct"):
+            return embed_texts(questions)
+    configure_gemini()
+    with model_slot(), span("question_embedding", backend="gemini_direct"):
+        result = genai.embed_content(model=EMBEDDING_MODEL, content=list(questions), task_type="retrieval_query")
+    return result["embedding"]
+
+def batch_context(index_id, questions):
+    """
+    Context for a batch of questions, retrieved as for single questions
+    
+    Returns:
+        BatchContext: The whole document shared by every question, or each
+        question's best-matching chunks
+    """
+    document_data = get_document_data(index_id)
+    filename = document_data["filename"]
+    if use_full_context(document_data):
+        return BatchContext(filename, "Document Content", {0: document_data["text"]}, [[0]] * len(questions))
+    
+    text = document_data["text"]
+    chunks = document_data["chunks"]
+    selections = [select_chunks(document_data, question) for question in questions]
+    passages = {chunk_id: text[chunks[chunk_id][0]:chunks[chunk_id][1]]
+                for selection in selections for chunk_id in selection}
+    return BatchContext(filename, "Relevant Excerpts", passages, selections)
+
+def generate_batch_answer(prompt):
+    """
+    Generate the JSON answers to a batch prompt
+    
+    Returns:
+        tuple: (response text, prompt tokens, response tokens)
+    """
+    try:
+        model = get_model()
+        with model_slot(), span("generation", backend="gemini_direct"):
+            response = model.generate_content(prompt, generation_config={"response_mime_type": "application/json"})
+            answer = response.text
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error answering batch: {error_msg}")
+        raise api_error(error_msg)
+    prompt_tokens, response_tokens = token_usage(prompt, answer, response)
+    record_tokens("gemini_direct", prompt_tokens, response_tokens)
+    return answer, prompt_tokens, response_tokens
+
+def answer_questions(index_id, questions):
+    """
+    Answer several questions about one document in as few calls as possible
+    
+    The document is loaded once and sent once per call for every question
+    packed into it, rather than once per question.
+    
+    Returns:
+        tuple: (per-question result dicts, usage dict); see batch_qa.answer_batch
+    """
+    return answer_batch(index_id, questions, lambda pending, _: batch_context(index_id, pending),
+                        generate_batch_answer, embed=embed_questions)
+
+async def aembed_question(question):
+    """Coroutine form of embed_question."""
+    if LOCAL_EMBEDDINGS:
+        return await asyncio.to_thread(embed_question, question)
+    configure_gemini()
+    async with amodel_slot():
+        with span("question_embedding", backend="gemini_direct"):
+            result = await genai.embed_content_async(model=EMBEDDING_MODEL, content=question,
+                                                     task_type="retrieval_query")
+    return result["embedding"]
+
+async def load_document_async(index_id):
+    """Load a document into the document cache on a worker thread, if it exists."""
+    persist_dir = os.path.join(STORAGE_DIR, index_id)
+    if os.path.exists(os.path.join(persist_dir, "document_data.json")):
+        await asyncio.to_thread(document_cache.get, index_id, persist_dir, load_document_direct)
+
+async def aquery_document_direct(index_id, question):
+    """Coroutine form of query_document_direct."""
+    try:
+        prompt = await asyncio.to_thread(build_prompt, index_id, question)
+        model = get_model()
+        async with amodel_slot():
+            with span("generation", backend="gemini_direct"):
+                response = await model.generate_content_async(prompt)
+                answer = response.text
+        record_usage(prompt, answer, response)
+        return answer
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error querying document: {error_msg}")
+        raise api_error(error_msg)
+
+async def astream_query_document_direct(index_id, question):
+    """Coroutine form of stream_query_document_direct; an async generator of answer pieces."""
+    try:
+        prompt = await asyncio.to_thread(build_prompt, index_id, question)
+        model = get_model()
+        pieces = []
+        async with amodel_slot():
+            with span("generation", backend="gemini_direct"):
+                async for chunk in await model.generate_content_async(prompt, stream=True):
+                    if chunk.text:
+                        pieces.append(chunk.text)
+                        yield chunk.text
+        record_usage(prompt, "".join(pieces))
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error streaming answer: {error_msg}")
+        raise api_error(error_msg)
+
+async def aquery_document_cached(index_id, question):
+    """
+    Coroutine form of query_document_cached, for the asyncio serving mode
+    
+    The document is loaded while the question is embedded for the cache
+    lookup. With the REST transport, which has no asyncio client, the
+    blocking path runs on a worker thread instead.
+    
+    Returns:
+        tuple: (answer, served_from_cache)
+    """
+    if not native_async():
+        return await asyncio.to_thread(query_document_cached, index_id, question)
+    return await answer_cache.aget_or_compute(index_id, question, aquery_document_direct, embed=aembed_question,
+                                              prepare=lambda: load_document_async(index_id))
+
+async def astream_query_document_cached(index_id, question):
+    """
+    Coroutine form of stream_query_document_cached
+    
+    Returns:
+        tuple: (async iterator of answer text pieces, served_from_cache)
+    """
+    if not native_async():
+        pieces, cached = await asyncio.to_thread(stream_query_document_cached, index_id, question)
+        return iterate_in_thread(pieces), cached
+    return await answer_cache.astream_or_compute(index_id, question, astream_query_document_direct,
+                                                 embed=aembed_question, prepare=lambda: load_document_async(index_id))
 
 # Create aliases to match the expected function names
 process_document = process_document_direct
-query_document = query_document_direct
\ No newline at end of file
+query_document = query_document_direct
+stream_query_document = stream_query_document_direct
\ No newline at end of file
@@ -0,0 +1,166 @@
+"""
+Rank fusion and context packing shared by the retrieval paths.
+
+Vector search finds passages that paraphrase a question, while BM25 finds
+exact terms such as clause numbers or names that embeddings blur.
+reciprocal_rank_fusion() combines their rankings without having to
+calibrate one score against the other. pack_context() then turns the
+fused candidates into prompt context:
+
+- It takes passages best first until the token budget is spent.
+- Text already covered by an earlier passage is not paid for twice, and
+  exact duplicates are dropped.
+- Overlapping or adjacent passages are merged into one, so the overlap
+  between neighbouring chunks reaches the model once.
+"""
+import os
+import hashlib
+from utils.bm25 import estimate_tokens
+
+# Larger values flatten the fused ranking; 60 is the usual choice
+RRF_K = int(os.environ.get("HYBRID_RRF_K", 60))
+
+# Passages separated by at most this many characters, such as the blank
+# line between two pages, are merged as adjacent
+MERGE_GAP_CHARS = 2
+
+def reciprocal_rank_fusion(rankings, k=None):
+    """
+    Fuse several rankings of the same items
+
+    Each item scores the sum of 1 / (k + rank) over the rankings that
+    include it, with ranks counted from 1.
+
+    Args:
+        rankings (list): Lists of item ids, best first
+        k (int): Rank offset; defaults to RRF_K
+
+    Returns:
+        list: (item id, fused score) pairs, best first
+    """
+    k = RRF_K if k is None else k
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda entry: (-entry[1], str(entry[0])))
+
+def _uncovered(start, end, covered):
+    """Characters of [start, end) not inside any of the covered spans."""
+    pieces = [(start, end)]
+    for covered_start, covered_end in covered:
+        remaining = []
+        for piece_start, piece_end in pieces:
+            if covered_end <= piece_start or covered_start >= piece_end:
+                remaining.append((piece_start, piece_end))
+                continue
+            if piece_start < covered_start:
+                remaining.append((piece_start, covered_start))
+            if covered_end < piece_end:
+                remaining.append((covered_end, piece_end))
+        pieces = remaining
+    return sum(piece_end - piece_start for piece_start, piece_end in pieces)
+
+def select_within_budget(candidates, token_budget):
+    """
+    Choose candidates best first while their new text fits the budget
+
+    A candidate overlapping ones already chosen only costs its uncovered
+    characters; one that adds nothing, or repeats another's text exactly,
+    is skipped. The best candidate is always chosen, even if it alone
+    exceeds the budget.
+
+    Args:
+        candidates (list): dicts with "text", and "start"/"end" character
+            offsets into the document (None when unknown), best first
+        token_budget (int): Estimated tokens of context allowed
+
+    Returns:
+        list: Positions in candidates of the chosen ones, best first
+    """
+    chosen, covered, seen = [], [], set()
+    used_tokens = 0
+    for position, candidate in enumerate(candidates):
+        digest = hashlib.sha1(candidate["text"].encode("utf-8")).digest()
+        if digest in seen:
+            continue
+        start, end = candidate.get("start"), candidate.get("end")
+        if start is not None and end is not None:
+            new_chars = _uncovered(start, end, covered)
+            if new_chars == 0:
+                continue
+            # estimate_tokens() of the uncovered text
+            cost = new_chars // 4 + 1
+        else:
+            cost = estimate_tokens(candidate["text"])
+        if chosen and used_tokens + cost > token_budget:
+            continue
+        chosen.append(position)
+        seen.add(digest)
+        used_tokens += cost
+        if start is not None and end is not None:
+            covered.append((start, end))
+    return chosen
+
+def merge_passages(passages, text=None):
+    """
+    Merge overlapping or adjacent passages
+
+    Args:
+        passages (list): dicts with "text", "start", "end" and "score"
+        text (str): Optional full document text; when given, merged text is
+            sliced from it, otherwise overlapping passages are stitched
+
+    Returns:
+        list: dicts with "text", "start", "end", "score" (the best of the
+        merged passages) and "members" (positions in passages), in
+        document order; passages without offsets come last
+    """
+    located = sorted((position for position, passage in enumerate(passages)
+                      if passage.get("start") is not None and passage.get("end") is not None),
+                     key=lambda position: (passages[position]["start"], passages[position]["end"]))
+    merged = []
+    for position in located:
+        passage = passages[position]
+        current = merged[-1] if merged else None
+        if current is not None and passage["start"] <= current["end"] + MERGE_GAP_CHARS:
+            if passage["end"] > current["end"]:
+                if text is not None:
+                    current["text"] = text[current["start"]:passage["end"]]
+                elif passage["start"] <= current["end"] and len(passage["text"]) == passage["end"] - passage["start"]:
+                    current["text"] += passage["text"][current["end"] - passage["start"]:]
+                else:
+                    current["text"] += " " + passage["text"]
+                current["end"] = passage["end"]
+            current["score"] = max(current["score"], passage["score"])
+            current["members"].append(position)
+            continue
+        merged.append({"text": text[passage["start"]:passage["end"]] if text is not None else passage["text"],
+                       "start": passage["start"], "end": passage["end"], "score": passage["score"],
+                       "members": [position]})
+
+    merged.extend({"text": passage["text"], "start": None, "end": None, "score": passage["score"],
+                   "members": [position]}
+                  for position, passage in enumerate(passages)
+                  if passage.get("start") is None or passage.get("end") is None)
+    return merged
+
+def pack_context(candidates, token_budget, text=None):
+    """
+    Select candidates within a token budget and merge them into passages
+
+    Args:
+        candidates (list): dicts with "text", "start", "end" and "score",
+            best first
+        token_budget (int): Estimated tokens of context allowed
+        text (str): Optional full document text, see merge_passages
+
+    Returns:
+        list: Merged passages in document order, see merge_passages;
+        "members" are positions in candidates
+    """
+    chosen = select_within_budget(candidates, token_budget)
+    packed = merge_passages([candidates[position] for position in chosen], text)
+    for passage in packed:
+        passage["members"] = [chosen[member] for member in passage["members"]]
+    return packed
@@ -0,0 +1,129 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+def persist_dir_fingerprint(persist_dir):
+    """
+    Describe the files in a persist directory cheaply, using stat only.
+
+    Returns:
+        tuple: (fingerprint, total_bytes); the fingerprint changes whenever a
+        file is added, removed or rewritten
+    """
+    entries = []
+    total_bytes = 0
+    with os.scandir(persist_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+                total_bytes += stat.st_size
+    return tuple(sorted(entries)), total_bytes
+
+class IndexCache:
+    """
+    Size-bounded LRU cache of loaded indexes, keyed by index_id.
+
+    Entries are weighted by the size of their persist directory, which tracks
+    the memory a deserialized index holds closely enough to bound the total.
+    An entry is reloaded when its persist directory changes on disk.
+    """
+
+    def __init__(self, max_bytes, max_entries=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # index_id -> (fingerprint, weight, value)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def get(self, index_id, persist_dir, loader):
+        """
+        Return the cached value for index_id, loading it on a miss.
+
+        Args:
+            index_id (str): Cache key
+            persist_dir (str): Directory the value is loaded from
+            loader (callable): Called with persist_dir to build the value
+
+        Returns:
+            object: Whatever loader returned for this persist directory
+        """
+        fingerprint, weight = persist_dir_fingerprint(persist_dir)
+
+        with self._lock:
+            cached = self._entries.get(index_id)
+            if cached is not None and cached[0] == fingerprint:
+                self._entries.move_to_end(index_id)
+                self.hits += 1
+                return cached[2]
+            self.misses += 1
+            load_lock = self._load_locks.setdefault(index_id, threading.Lock())
+
+        # Concurrent misses for one index wait for a single load
+        with load_lock:
+            with self._lock:
+                cached = self._entries.get(index_id)
+                if cached is not None and cached[0] == fingerprint:
+                    self._entries.move_to_end(index_id)
+                    return cached[2]
+
+            logger.debug(f"Index cache miss for {index_id}, loading from {persist_dir}")
+            try:
+                value = loader(persist_dir)
+            finally:
+                with self._lock:
+                    self._load_locks.pop(index_id, None)
+
+            with self._lock:
+                self._remove(index_id)
+                self._entries[index_id] = (fingerprint, weight, value)
+                self._total_bytes += weight
+                self._evict()
+        return value
+
+    def invalidate(self, index_id):
+        """Drop a cached entry, e.g. after its index was rebuilt or deleted."""
+        with self._lock:
+            self._remove(index_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        """Return hit/miss counters and current occupancy."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _remove(self, index_id):
+        cached = self._entries.pop(index_id, None)
+        if cached is not None:
+            self._total_bytes -= cached[1]
+
+    def _evict(self):
+        # Always keep the newest entry, even if it alone exceeds the budget
+        while len(self._entries) > 1 and (
+                self._total_bytes > self.max_bytes or
+                (self.max_entries is not None and len(self._entries) > self.max_entries)):
+            index_id, (_, weight, _) = self._entries.popitem(last=False)
+            self._total_bytes -= weight
+            self.evictions += 1
+            logger.debug(f"Evicted index {index_id} from cache ({weight} bytes)")
@@ -0,0 +1,212 @@
+import os
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import func, exists
+from sqlalchemy.orm.exc import StaleDataError
+from models import db, Document, IngestionJob
+from utils.metrics import metrics, span
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+class IngestionQueue:
+    """
+    Local worker pool that runs document ingestion outside the request thread.
+
+    Jobs are rows in the IngestionJob table, so every gunicorn worker can
+    enqueue work and any worker's pool can pick it up. A job is claimed with
+    a conditional UPDATE, which keeps two pools from running the same job.
+    While a worker thread runs a job, a heartbeat thread refreshes the job's
+    heartbeat_at; a running job whose heartbeat stops (crashed process, dead
+    thread) is put back in the queue by the next claim.
+    """
+
+    def __init__(self, handler, app=None):
+        """
+        Args:
+            handler (callable): Called with a Document inside an app context;
+                returns the index_id produced for it
+            app (Flask): Optional app to bind immediately
+        """
+        self.handler = handler
+        self.app = None
+        self.num_workers = 2
+        self.poll_interval = 2.0
+        self.stale_after = timedelta(minutes=2)
+        self.heartbeat_interval = 15.0
+        self._threads = []
+        self._running = {}  # job_id -> worker thread running it
+        self._owner_pid = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.num_workers = app.config.get('INGEST_WORKERS', self.num_workers)
+        self.poll_interval = app.config.get('INGEST_POLL_INTERVAL', self.poll_interval)
+        self.stale_after = timedelta(seconds=app.config.get('INGEST_JOB_TIMEOUT', self.stale_after.total_seconds()))
+        self.heartbeat_interval = app.config.get('INGEST_HEARTBEAT_INTERVAL', self.heartbeat_interval)
+
+    def enqueue(self, document):
+        """
+        Create a queued job for a document and wake the worker pool.
+
+        Args:
+            document (Document): Document row that has already been committed
+
+        Returns:
+            IngestionJob: The newly created job
+        """
+        job = IngestionJob(id=uuid.uuid4().hex, document_id=document.id, status='queued')
+        document.status = 'queued'
+        db.session.add(job)
+        db.session.commit()
+        logger.debug(f"Enqueued ingestion job {job.id} for document {document.id}")
+
+        self.ensure_started()
+        self._wakeup.set()
+        return job
+
+    def ensure_started(self):
+        """Start the worker threads for this process if they are not running yet."""
+        # Threads do not survive a fork, so a preloaded app has to start its
+        # pool again in every gunicorn worker.
+        if self._owner_pid == os.getpid() or self.num_workers <= 0:
+            return
+        with self._lock:
+            if self._owner_pid == os.getpid():
+                return
+            self._owner_pid = os.getpid()
+            self._threads = []
+            self._running = {}
+            threading.Thread(target=self._heartbeat, name="ingest-heartbeat", daemon=True).start()
+            for worker_num in range(self.num_workers):
+                thread = threading.Thread(target=self._run,
+                                          name=f"ingest-worker-{worker_num}",
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            logger.debug(f"Started {self.num_workers} ingestion workers in process {self._owner_pid}")
+
+    def _requeue_stale_jobs(self):
+        """Put running jobs whose heartbeat stopped back in the queue; caller holds an app context."""
+        cutoff = datetime.utcnow() - self.stale_after
+        requeued = IngestionJob.query.filter(
+            IngestionJob.status == 'running',
+            func.coalesce(IngestionJob.heartbeat_at, IngestionJob.started_at) < cutoff).update(
+                {'status': 'queued', 'started_at': None, 'heartbeat_at': None},
+                synchronize_session=False)
+        db.session.commit()
+        if requeued:
+            logger.warning(f"Requeued {requeued} stale ingestion jobs")
+
+    def _heartbeat(self):
+        """Refresh heartbeat_at of the jobs this process's live worker threads are running."""
+        while True:
+            time.sleep(self.heartbeat_interval)
+            job_ids = [job_id for job_id, thread in list(self._running.items()) if thread.is_alive()]
+            if not job_ids:
+                continue
+            try:
+                with self.app.app_context():
+                    IngestionJob.query.filter(
+                        IngestionJob.id.in_(job_ids),
+                        IngestionJob.status == 'running').update(
+                            {'heartbeat_at': datetime.utcnow()},
+                            synchronize_session=False)
+                    db.session.commit()
+            except Exception as e:
+                logger.error(f"Error recording ingestion heartbeats: {str(e)}")
+
+    def _run(self):
+        while True:
+            try:
+                job_id = self._claim_next()
+            except Exception as e:
+                logger.error(f"Error claiming ingestion job: {str(e)}")
+                job_id = None
+
+            if job_id is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            self._running[job_id] = threading.current_thread()
+            try:
+                self._execute(job_id)
+            except Exception as e:
+                # Leaving the app context removes the session, so the next
+                # job starts from a clean one
+                logger.error(f"Error running ingestion job {job_id}: {str(e)}")
+            finally:
+                self._running.pop(job_id, None)
+
+    def _claim_next(self):
+        with self.app.app_context():
+            self._requeue_stale_jobs()
+            while True:
+                job = IngestionJob.query.filter_by(status='queued').order_by(
+                    IngestionJob.created_at).first()
+                if job is None:
+                    return None
+
+                now = datetime.utcnow()
+                claimed = IngestionJob.query.filter_by(
+                    id=job.id, status='queued').update(
+                        {'status': 'running', 'started_at': now, 'heartbeat_at': now},
+                        synchronize_session=False)
+                db.session.commit()
+                if claimed:
+                    return job.id
+
+    @staticmethod
+    def _update_joined(document):
+        """Give uploads of the same content that joined this job its outcome."""
+        if not document.content_hash:
+            return
+        has_job = exists().where(IngestionJob.document_id == Document.id)
+        Document.query.filter(
+            Document.content_hash == document.content_hash,
+            Document.id != document.id,
+            Document.status.in_(('queued', 'processing')),
+            ~has_job).update(
+                {'index_id': document.index_id or '', 'backend': document.backend, 'status': document.status},
+                synchronize_session=False)
+
+    def _execute(self, job_id):
+        with self.app.app_context():
+            job = db.session.get(IngestionJob, job_id)
+            document = db.session.get(Document, job.document_id) if job else None
+            if document is None:
+                logger.warning(f"Ingestion job {job_id} or its document was deleted; skipping it")
+                return
+            document.status = 'processing'
+            db.session.commit()
+
+            try:
+                logger.debug(f"Running ingestion job {job_id} for {document.filepath}")
+                with span("ingest"):
+                    document.index_id = self.handler(document)
+                document.status = 'ready'
+                job.status = 'done'
+            except Exception as e:
+                logger.error(f"Ingestion job {job_id} failed: {str(e)}")
+                db.session.rollback()
+                document.status = 'failed'
+                job.status = 'failed'
+                job.error = str(e)
+            self._update_joined(document)
+
+            job.finished_at = datetime.utcnow()
+            try:
+                db.session.commit()
+            except StaleDataError:
+                db.session.rollback()
+                logger.warning(f"Ingestion job {job_id} or its document was deleted while running")
+                return
+            metrics.inc("ingest_jobs_total", 1, "Finished ingestion jobs", status=job.status)
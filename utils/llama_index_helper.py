@@ -1,12 +1,35 @@
 import os
 import uuid
+import asyncio
+import hashlib
 import logging
+import google.generativeai as genai
 from dotenv import load_dotenv
 from llama_index.core import Document as LlamaDocument
-from llama_index.core import VectorStoreIndex, StorageContext, load_index_from_storage
+from llama_index.core import StorageContext, load_index_from_storage
 from llama_index.core.node_parser import SimpleNodeParser
-from llama_index.llms.gemini import Gemini
-from llama_index.embeddings.gemini import GeminiEmbedding
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.embeddings import BaseEmbedding
+from llama_index.core.retrievers import BaseRetriever
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle, TextNode
+from utils.index_cache import IndexCache
+from utils.answer_cache import answer_cache
+from utils.vector_store import MemmapVectorStore, has_vector_store, write_vector_store, known_embeddings
+from utils.text_store import write_text
+from utils.summary_tree import SummaryTree, wants_summary_tree
+from utils.embedding_scheduler import EmbeddingScheduler, chunk_key
+from utils.local_embedding import (LOCAL_EMBEDDINGS, LOCAL_EMBEDDING_BATCH_SIZE, embed_chunks, embed_texts,
+                                   local_model_id, embed_documents as embed_documents_locally)
+from utils.pdf_processor import page_spans
+from utils.versioning import page_hashes, save_page_hashes, changed_pages
+from utils.metrics import span, timed, record_tokens
+from utils.bm25 import BM25Index, estimate_tokens
+from utils.hybrid_retrieval import reciprocal_rank_fusion, select_within_budget, pack_context
+from utils.corpus_index import build_library_prompt
+from utils.batch_qa import BatchContext, answer_batch
+from utils.backends import per_process
+from utils.model_clients import (GEMINI_API_ENDPOINT, GEMINI_TRANSPORT, model_slot, amodel_slot, native_async,
+                                  iterate_in_thread, Overloaded)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -17,29 +40,110 @@ logger = logging.getLogger(__name__)
 # Get Google API Key from environment variable
 GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
 
-# Create storage directory if it doesn't exist
+# Index storage; each document's directory is created when it is processed
 STORAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'storage')
-os.makedirs(STORAGE_DIR, exist_ok=True)
 
+# Embeddings of partially indexed documents, keyed by text hash, so a failed
+# ingest can resume where it stopped
+CHECKPOINT_DIR = os.path.join(STORAGE_DIR, ".checkpoints")
+
+# Metadata that differs between versions of the same document; kept out of
+# the embedded text so unchanged chunks keep the same embedding
+VERSION_SPECIFIC_METADATA = ["filename", "content_preview", "word_count", "char_count"]
+
+# Node size and overlap at ingest, in tokens
+CHUNK_TOKENS = int(os.environ.get("LLAMA_INDEX_CHUNK_TOKENS", 1024))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("LLAMA_INDEX_CHUNK_OVERLAP_TOKENS", 200))
+
+# Nodes retrieved as context for a question in "vector" retrieval mode
+SIMILARITY_TOP_K = 5
+
+# "hybrid" fuses the BM25 and vector rankings of LLAMA_INDEX_CANDIDATES nodes
+# each and packs the best into LLAMA_INDEX_CONTEXT_TOKENS, merging
+# overlapping nodes; "vector" sends the SIMILARITY_TOP_K nearest nodes
+RETRIEVAL_MODE = os.environ.get("LLAMA_INDEX_RETRIEVAL", "hybrid")
+HYBRID_CANDIDATES = int(os.environ.get("LLAMA_INDEX_CANDIDATES", 20))
+CONTEXT_TOKENS = int(os.environ.get("LLAMA_INDEX_CONTEXT_TOKENS", 2500))
+
+# Document metadata that would otherwise be repeated in the prompt with every passage
+PROMPT_EXCLUDED_METADATA = ["content_preview", "word_count", "char_count"]
+
+LEXICAL_INDEX_FILE = "lexical_index.json"
+
+# Loaded indexes and query engines, bounded by the on-disk size of their storage
+index_cache = IndexCache(
+    max_bytes=int(os.environ.get("INDEX_CACHE_MAX_BYTES", 512 * 1024 * 1024)),
+    max_entries=int(os.environ.get("INDEX_CACHE_MAX_ENTRIES", 32))
+)
+
+@per_process
 def get_llm():
-    """Get configured Gemini LLM instance."""
-    return Gemini(api_key=GOOGLE_API_KEY)
+    """Get the Gemini LLM instance shared by this process."""
+    from llama_index.llms.gemini import Gemini
+    return Gemini(api_key=GOOGLE_API_KEY, api_base=GEMINI_API_ENDPOINT, transport=GEMINI_TRANSPORT)
+
+class LocalEmbedding(BaseEmbedding):
+    """LlamaIndex embedding model running utils.local_embedding in-process."""
+
+    def _get_query_embedding(self, query):
+        return embed_texts([query])[0].tolist()
+
+    async def _aget_query_embedding(self, query):
+        return await asyncio.to_thread(self._get_query_embedding, query)
+
+    def _get_text_embedding(self, text):
+        return embed_texts([text])[0].tolist()
 
+    def _get_text_embeddings(self, texts):
+        return embed_texts(texts).tolist()
+
+@per_process
 def get_embedding_model():
-    """Get configured Gemini embedding model."""
+    """Get the embedding model shared by this process: Gemini, or local with EMBEDDING_BACKEND=local."""
+    if LOCAL_EMBEDDINGS:
+        return LocalEmbedding(model_name=local_model_id(), embed_batch_size=LOCAL_EMBEDDING_BATCH_SIZE)
+    from llama_index.embeddings.gemini import GeminiEmbedding
+    options = dict(api_key=GOOGLE_API_KEY, api_base=GEMINI_API_ENDPOINT, transport=GEMINI_TRANSPORT, dimension=768)
     try:
-        return GeminiEmbedding(api_key=GOOGLE_API_KEY, model_name="models/text-embedding-004", dimension=768)
+        return GeminiEmbedding(model_name="models/text-embedding-004", **options)
     except Exception as e:
         logger.warning(f"Failed to use text-embedding-004, falling back to embedding-001: {e}")
-        return GeminiEmbedding(api_key=GOOGLE_API_KEY, model_name="models/embedding-001", dimension=768)
+        return GeminiEmbedding(model_name="models/embedding-001", **options)
+
+def embed_batch_with(embed_model):
+    """
+    Return a function that embeds a list of texts in one request
+    
+    Gemini models use batchEmbedContents directly, since the LlamaIndex
+    wrapper sends one request per text. Ingestion waits for a model call
+    slot rather than being shed.
+    """
+    from llama_index.embeddings.gemini import GeminiEmbedding
+    if isinstance(embed_model, GeminiEmbedding):
+        def embed_batch(texts):
+            with model_slot(shed=False):
+                result = genai.embed_content(model=embed_model.model_name, content=texts,
+                                             task_type="retrieval_document")
+            return result["embedding"]
+        return embed_batch
+
+    def embed_batch(texts):
+        with model_slot(shed=False):
+            return embed_model.get_text_embedding_batch(texts)
+    return embed_batch
 
-def process_document(text, filename):
+def process_document(text, filename, pages=None, previous_index_id=None, outline=None):
     """
     Process a document with enhanced analysis and LlamaIndex storage
     
     Args:
         text (str): Extracted text from the document
         filename (str): Original filename
+        pages (list): Optional page texts that text was joined from; enables
+            page-aligned chunking and, for long documents, the summary tree
+        previous_index_id (str): Index of the previous version of this
+            document; embeddings of unchanged chunks are carried forward
+        outline (list): Optional PDF outline, from pdf_processor.extract_outline
         
     Returns:
         str: Index ID for future reference
@@ -51,6 +155,7 @@ def process_document(text, filename):
         index_id = str(uuid.uuid4())
         persist_dir = os.path.join(STORAGE_DIR, index_id)
         os.makedirs(persist_dir, exist_ok=True)
+        previous_dir = os.path.join(STORAGE_DIR, previous_index_id) if previous_index_id else None
         
         # Initialize LLM and embedding model
         llm = get_llm()
@@ -70,33 +175,86 @@ def process_document(text, filename):
             "document_type": detect_document_type_simple(text, filename)
         }
         
-        document = LlamaDocument(text=text, metadata=enhanced_metadata)
+        # One LlamaIndex document per page, so chunks never cross a page
+        # boundary and an unchanged page yields the same chunks
+        spans = page_spans(pages) if pages else [(0, len(text))]
+        documents = [
+            LlamaDocument(text=text[start:end], metadata=enhanced_metadata,
+                          excluded_embed_metadata_keys=VERSION_SPECIFIC_METADATA)
+            for start, end in spans
+        ]
+        page_of_document = {document.doc_id: number for number, document in enumerate(documents)}
         
         # Parse document into nodes with better chunking
         parser = SimpleNodeParser.from_defaults(
-            chunk_size=1024,
-            chunk_overlap=200
+            chunk_size=CHUNK_TOKENS,
+            chunk_overlap=CHUNK_OVERLAP_TOKENS
         )
-        nodes = parser.get_nodes_from_documents([document])
+        with span("chunking", backend="llama_index"):
+            nodes = parser.get_nodes_from_documents(documents)
         
-        # Create and save index
-        index = VectorStoreIndex(nodes)
+        records = []
+        for node in nodes:
+            page = page_of_document[node.ref_doc_id]
+            record = node_record(node, offset=spans[page][0])
+            if pages:
+                record["page"] = page + 1
+            records.append(record)
         
-        # Save index to disk with additional metadata
-        index.storage_context.persist(persist_dir)
+        # Record page hashes so the next version can be diffed against this one
+        if pages:
+            hashes = page_hashes(pages)
+            save_page_hashes(persist_dir, hashes, changed_pages(previous_dir, hashes) if previous_dir else None)
         
-        # Also save enhanced document analysis for backup
+        # Embed nodes the way VectorStoreIndex would, in concurrent batches
+        # that back off on rate limits, then save them to the memory-mapped
+        # store instead of JSON. Chunks already embedded for the previous
+        # version or found in the embedding cache are reused as they are;
+        # local models embed in-process without pacing.
+        node_texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        model = embed_model.model_name
+        if LOCAL_EMBEDDINGS:
+            embed = embed_documents_locally
+        else:
+            os.makedirs(CHECKPOINT_DIR, exist_ok=True)
+            checkpoint_path = os.path.join(CHECKPOINT_DIR,
+                                           hashlib.sha256(text.encode("utf-8")).hexdigest() + ".jsonl")
+            scheduler = EmbeddingScheduler(embed_batch_with(embed_model))
+
+            def embed(texts, known):
+                return scheduler.embed(texts, checkpoint_path=checkpoint_path, known=known)
+        with span("embedding", backend="llama_index"):
+            embeddings = embed_chunks(node_texts, model, embed,
+                                      known=known_embeddings(previous_dir, model) if previous_dir else None)
+        for record, embed_text in zip(records, node_texts):
+            record["hash"] = chunk_key(embed_text)
+        with span("chunking", backend="llama_index"):
+            BM25Index.build([record["text"] for record in records]).save(
+                os.path.join(persist_dir, LEXICAL_INDEX_FILE))
+        # The text is kept once, compressed; node records point into it
+        write_text(persist_dir, text)
+        write_vector_store(persist_dir, embeddings, records, enhanced_metadata, text=text, embedding_model=model)
+        
+        # Summaries of long documents, for questions about whole sections
+        if pages and wants_summary_tree(text):
+            try:
+                with span("summaries", backend="llama_index"):
+                    SummaryTree.build(pages, generate_text, outline, filename,
+                                      previous=SummaryTree.load(previous_dir)).save(persist_dir)
+            except Exception as e:
+                logger.warning(f"Document will be answered without a summary tree: {str(e)}")
+        
+        # Also save enhanced document analysis; the text is in text.zst
         enhanced_analysis = {
             "index_id": index_id,
             "filename": filename,
             "metadata": enhanced_metadata,
-            "text": text,
             "nodes": len(nodes)
         }
         
         import json
         with open(os.path.join(persist_dir, "enhanced_analysis.json"), "w") as f:
-            json.dump(enhanced_analysis, f, indent=2)
+            json.dump(enhanced_analysis, f, separators=(",", ":"))
         
         logger.debug(f"Successfully processed document and saved index to {persist_dir}")
         logger.debug(f"Document has {len(nodes)} nodes and {enhanced_metadata['word_count']} words")
@@ -106,6 +264,161 @@ def process_document(text, filename):
         logger.error(f"Error processing document: {str(e)}")
         raise Exception(f"Failed to process document: {str(e)}")
 
+def node_record(node, offset=0):
+    """
+    Compact vector store record for a parsed node
+    
+    Args:
+        offset (int): Position of the node's source page in the document text
+    """
+    return {
+        "id": node.node_id,
+        "text": node.text,
+        "start": node.start_char_idx + offset if node.start_char_idx is not None else None,
+        "end": node.end_char_idx + offset if node.end_char_idx is not None else None
+    }
+
+class MemmapRetriever(BaseRetriever):
+    """Retrieve nodes from a MemmapVectorStore by embedding similarity"""
+    
+    def __init__(self, store, embed_model, similarity_top_k=5):
+        super().__init__()
+        self._store = store
+        self._embed_model = embed_model
+        self._similarity_top_k = similarity_top_k
+    
+    def _embed(self, query_bundle):
+        if query_bundle.embedding is None:
+            with span("question_embedding", backend="llama_index"):
+                query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(query_bundle.embedding_strs)
+    
+    def _retrieve(self, query_bundle):
+        self._embed(query_bundle)
+        with span("retrieval", backend="llama_index"):
+            ranked = self._store.search(query_bundle.embedding, self._similarity_top_k)
+            records = self._store.get_records([position for position, _ in ranked])
+        return [
+            NodeWithScore(
+                node=TextNode(id_=record["id"], text=record["text"], metadata=dict(self._store.metadata),
+                              start_char_idx=record.get("start"), end_char_idx=record.get("end")),
+                score=score
+            )
+            for record, (_, score) in zip(records, ranked)
+        ]
+    
+    async def _aretrieve(self, query_bundle):
+        if query_bundle.embedding is None:
+            with span("question_embedding", backend="llama_index"):
+                query_bundle.embedding = await self._embed_model.aget_agg_embedding_from_queries(
+                    query_bundle.embedding_strs)
+        # Searching the memory-mapped store is local and quick
+        return self._retrieve(query_bundle)
+
+def load_lexical_index(persist_dir, store):
+    """
+    Load a store's BM25 index, building it for stores written before it existed
+    
+    Returns:
+        BM25Index: Over the store's records, by position
+    """
+    path = os.path.join(persist_dir, LEXICAL_INDEX_FILE)
+    if os.path.exists(path):
+        return BM25Index.load(path)[0]
+    lexical_index = BM25Index.build([record["text"] for record in store.iter_records()])
+    try:
+        lexical_index.save(path)
+    except OSError as e:
+        logger.warning(f"Could not save lexical index to {persist_dir}: {e}")
+    return lexical_index
+
+def fused_candidates(store, lexical_index, question, vector_hits, candidates=None):
+    """
+    Rank a store's records for a question by reciprocal rank fusion
+    
+    Args:
+        vector_hits (list): (position, score) pairs from store.search
+        candidates (int): Records taken from each ranking and returned
+    
+    Returns:
+        list: dicts with the record's "id", "text", "start" and "end", its
+        "position" in the store and fused "score", best first
+    """
+    candidates = HYBRID_CANDIDATES if candidates is None else candidates
+    fused = reciprocal_rank_fusion([[position for position, _ in vector_hits],
+                                    [position for position, _ in lexical_index.search(question, candidates)]])
+    fused = fused[:candidates]
+    records = store.get_records([position for position, _ in fused])
+    return [{"id": record["id"], "text": record["text"], "start": record.get("start"), "end": record.get("end"),
+             "position": position, "score": score}
+            for record, (position, score) in zip(records, fused)]
+
+class HybridRetriever(MemmapRetriever):
+    """
+    Retrieve context from a MemmapVectorStore by fusing vector and BM25 rankings
+    
+    The fused candidates are packed into a token budget, and each run of
+    overlapping or adjacent nodes is returned as a single node.
+    """
+    
+    def __init__(self, store, lexical_index, embed_model, candidates=None, token_budget=None):
+        super().__init__(store, embed_model, similarity_top_k=HYBRID_CANDIDATES if candidates is None else candidates)
+        self._lexical_index = lexical_index
+        self._token_budget = CONTEXT_TOKENS if token_budget is None else token_budget
+    
+    def _retrieve(self, query_bundle):
+        self._embed(query_bundle)
+        with span("retrieval", backend="llama_index"):
+            vector_hits = self._store.search(query_bundle.embedding, self._similarity_top_k)
+            candidates = fused_candidates(self._store, self._lexical_index, query_bundle.query_str, vector_hits,
+                                          self._similarity_top_k)
+            packed = pack_context(candidates, self._token_budget)
+        return [
+            NodeWithScore(
+                # Named after its best-ranked node
+                node=TextNode(id_=candidates[min(passage["members"])]["id"], text=passage["text"],
+                              metadata=dict(self._store.metadata),
+                              excluded_llm_metadata_keys=PROMPT_EXCLUDED_METADATA,
+                              start_char_idx=passage["start"], end_char_idx=passage["end"]),
+                score=passage["score"]
+            )
+            for passage in packed
+        ]
+
+class SummaryTreeRetriever(BaseRetriever):
+    """
+    Answer questions asking for a summary from the document's summary tree
+    
+    Other questions are passed on to the wrapped retriever.
+    """
+    
+    def __init__(self, retriever, tree, store):
+        super().__init__()
+        self._retriever = retriever
+        self._tree = tree
+        self._store = store
+    
+    def _summary_nodes(self, question):
+        with span("retrieval", backend="llama_index"):
+            passages = self._tree.context(question, self._store.text)
+        if passages is None:
+            return None
+        return [
+            NodeWithScore(
+                node=TextNode(text=passage, metadata=dict(self._store.metadata),
+                              excluded_llm_metadata_keys=PROMPT_EXCLUDED_METADATA),
+                score=1.0
+            )
+            for passage in passages
+        ]
+    
+    def _retrieve(self, query_bundle):
+        nodes = self._summary_nodes(query_bundle.query_str)
+        return nodes if nodes is not None else self._retriever._retrieve(query_bundle)
+    
+    async def _aretrieve(self, query_bundle):
+        nodes = self._summary_nodes(query_bundle.query_str)
+        return nodes if nodes is not None else await self._retriever._aretrieve(query_bundle)
+
 def detect_document_type_simple(text, filename):
     """Simple document type detection"""
     text_lower = text.lower()
@@ -121,13 +434,129 @@ def detect_document_type_simple(text, filename):
     
     return "General Document"
 
-def query_document(index_id, question):
+class LoadedIndex:
+    """A loaded index together with its ready-to-use query engines"""
+    
+    def __init__(self, index, query_engine, streaming_query_engine, lexical_index=None):
+        self.index = index
+        self.query_engine = query_engine
+        self.streaming_query_engine = streaming_query_engine
+        self.lexical_index = lexical_index
+
+@timed("index_load", backend="llama_index")
+def load_query_engine(persist_dir):
+    """
+    Load a persisted index and build its query engines
+    
+    Args:
+        persist_dir (str): Storage directory written by process_document
+        
+    Returns:
+        LoadedIndex: Index with regular and streaming query engines
+    """
+    # Initialize LLM and embedding model
+    llm = get_llm()
+    embed_model = get_embedding_model()
+    
+    # Update settings for Gemini
+    from llama_index.core.settings import Settings
+    Settings.llm = llm
+    Settings.embed_model = embed_model
+    
+    if has_vector_store(persist_dir):
+        # Embeddings are memory-mapped, so this does not parse any vectors
+        index = MemmapVectorStore(persist_dir)
+        if index.embedding_model != embed_model.model_name:
+            raise Exception(f"Document was indexed with {index.embedding_model} embeddings, but "
+                            f"{embed_model.model_name} is configured; re-upload it to query it")
+    else:
+        # Indexes persisted as JSON before the memory-mapped store existed;
+        # convert them with `python -m utils.vector_store migrate`
+        logger.warning(f"Loading legacy JSON index from {persist_dir}")
+        storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
+        index = load_index_from_storage(storage_context)
+    
+    # First, try to get enhanced analysis if available
+    enhanced_analysis_file = os.path.join(persist_dir, "enhanced_analysis.json")
+    if os.path.exists(enhanced_analysis_file):
+        import json
+        with open(enhanced_analysis_file, "r") as f:
+            enhanced_data = json.load(f)
+            logger.debug(f"Using enhanced analysis: {enhanced_data['metadata']['word_count']} words, {enhanced_data['nodes']} nodes")
+    
+    # Create query engine with enhanced configuration
+    from llama_index.core.prompts import PromptTemplate
+    
+    # Enhanced prompt template for better context understanding
+    prompt_template = PromptTemplate(
+        "You are an AI assistant analyzing a specific document. You have access to the exact content of this document. "
+        "Please provide a detailed, accurate answer based ONLY on the information present in the document content provided below. "
+        "If the information asked for is not in the document, clearly state 'I cannot find this information in the document.' "
+        "Be specific and use exact details from the document when available.\n\n"
+        "=== DOCUMENT CONTENT ===\n{context_str}\n"
+        "=== END DOCUMENT CONTENT ===\n\n"
+        "Question: {query_str}\n\n"
+        "Instructions: Answer based solely on the document content above. If the information is not present, say so clearly."
+    )
+    
+    # Create query engine with better configuration
+    query_engine_kwargs = dict(
+        text_qa_template=prompt_template,
+        response_mode="compact"  # More detailed responses
+    )
+    if isinstance(index, MemmapVectorStore):
+        lexical_index = None
+        if RETRIEVAL_MODE == "hybrid":
+            lexical_index = load_lexical_index(persist_dir, index)
+            retriever = HybridRetriever(index, lexical_index, embed_model)
+        else:
+            retriever = MemmapRetriever(index, embed_model, similarity_top_k=SIMILARITY_TOP_K)
+        summary_tree = SummaryTree.load(persist_dir)
+        if summary_tree is not None:
+            retriever = SummaryTreeRetriever(retriever, summary_tree, index)
+        return LoadedIndex(
+            index,
+            RetrieverQueryEngine.from_args(retriever, llm=llm, **query_engine_kwargs),
+            RetrieverQueryEngine.from_args(retriever, llm=llm, streaming=True, **query_engine_kwargs),
+            lexical_index
+        )
+    return LoadedIndex(
+        index,
+        index.as_query_engine(similarity_top_k=SIMILARITY_TOP_K, **query_engine_kwargs),
+        index.as_query_engine(similarity_top_k=SIMILARITY_TOP_K, streaming=True, **query_engine_kwargs)
+    )
+
+def record_usage(question, response, answer):
+    """Count LLM tokens, estimated from the question, retrieved context and answer."""
+    context = sum(estimate_tokens(node.node.get_content()) for node in getattr(response, "source_nodes", []) or [])
+    record_tokens("llama_index", estimate_tokens(question) + context, estimate_tokens(answer))
+
+def api_error(error_msg):
+    """Turn a raw Gemini API error message into a user-friendly exception."""
+    if "429" in error_msg or "quota" in error_msg.lower() or "rate limit" in error_msg.lower():
+        return Exception("API quota exceeded. Please try again later or check your API usage limits.")
+    elif "401" in error_msg or "unauthorized" in error_msg.lower():
+        return Exception("API authentication failed. Please check your Google API key.")
+    elif "403" in error_msg or "forbidden" in error_msg.lower():
+        return Exception("API access forbidden. Please verify your API key permissions.")
+    else:
+        return Exception(f"Failed to process question: {error_msg}")
+
+def query_bundle(question, embedding=None):
+    """The question for a query engine, carrying its embedding when one is already known."""
+    if embedding is None:
+        return question
+    return QueryBundle(question, embedding=[float(value) for value in embedding])
+
+def query_document(index_id, question, embedding=None):
     """
     Query a document using LlamaIndex with enhanced error handling
     
     Args:
         index_id (str): Index ID from process_document
         question (str): User's question
+        embedding (list): Optional question embedding, e.g. from the answer
+            cache lookup; retrieval embeds the question when it is None
         
     Returns:
         str: Answer to the question
@@ -143,54 +572,14 @@ def query_document(index_id, question):
         if not os.path.exists(persist_dir):
             raise Exception("Document index not found. Please re-upload the document.")
         
-        # Initialize LLM and embedding model
-        llm = get_llm()
-        embed_model = get_embedding_model()
+        # Reuse the loaded index and query engine while the storage is unchanged
+        query_engine = index_cache.get(index_id, persist_dir, load_query_engine).query_engine
         
-        # Update settings for Gemini
-        from llama_index.core.settings import Settings
-        Settings.llm = llm
-        Settings.embed_model = embed_model
-        
-        # Load storage context
-        storage_context = StorageContext.from_defaults(persist_dir=persist_dir)
-        
-        # Load index
-        index = load_index_from_storage(storage_context)
-        
-        # First, try to get enhanced analysis if available
-        enhanced_analysis_file = os.path.join(persist_dir, "enhanced_analysis.json")
-        if os.path.exists(enhanced_analysis_file):
-            import json
-            with open(enhanced_analysis_file, "r") as f:
-                enhanced_data = json.load(f)
-                logger.debug(f"Using enhanced analysis: {enhanced_data['metadata']['word_count']} words, {enhanced_data['nodes']} nodes")
-        
-        # Create query engine with enhanced configuration
-        from llama_index.core.prompts import PromptTemplate
-        
-        # Enhanced prompt template for better context understanding
-        prompt_template = PromptTemplate(
-            "You are an AI assistant analyzing a specific document. You have access to the exact content of this document. "
-            "Please provide a detailed, accurate answer based ONLY on the information present in the document content provided below. "
-            "If the information asked for is not in the document, clearly state 'I cannot find this information in the document.' "
-            "Be specific and use exact details from the document when available.\n\n"
-            "=== DOCUMENT CONTENT ===\n{context}\n"
-            "=== END DOCUMENT CONTENT ===\n\n"
-            "Question: {query}\n\n"
-            "Instructions: Answer based solely on the document content above. If the information is not present, say so clearly."
-        )
-        
-        # Create query engine with better configuration
-        query_engine = index.as_query_engine(
-            text_qa_template=prompt_template,
-            similarity_top_k=5,  # Retrieve more relevant chunks
-            response_mode="compact"  # More detailed responses
-        )
-        
-        # Query the index
-        response = query_engine.query(question)
-        answer = str(response)
+        # Query the index; retrieval is also timed on its own
+        with model_slot(), span("query", backend="llama_index"):
+            response = query_engine.query(query_bundle(question, embedding))
+            answer = str(response)
+        record_usage(question, response, answer)
         
         # Log the actual response for debugging
         logger.debug(f"Raw response from query engine: {answer[:200]}...")
@@ -198,16 +587,284 @@ def query_document(index_id, question):
         logger.debug(f"Successfully queried document. Answer length: {len(answer)}")
         return answer
         
+    except Overloaded:
+        raise
     except Exception as e:
         error_msg = str(e)
         logger.error(f"Error querying document: {error_msg}")
         
         # Provide more user-friendly error messages
-        if "429" in error_msg or "quota" in error_msg.lower() or "rate limit" in error_msg.lower():
-            raise Exception("API quota exceeded. Please try again later or check your API usage limits.")
-        elif "401" in error_msg or "unauthorized" in error_msg.lower():
-            raise Exception("API authentication failed. Please check your Google API key.")
-        elif "403" in error_msg or "forbidden" in error_msg.lower():
-            raise Exception("API access forbidden. Please verify your API key permissions.")
-        else:
-            raise Exception(f"Failed to process question: {error_msg}")
+        raise api_error(error_msg)
+
+def stream_query_document(index_id, question, embedding=None):
+    """
+    Query a document like query_document, yielding the answer as it is generated
+    
+    Args:
+        index_id (str): Index ID from process_document
+        question (str): User's question
+        embedding (list): Optional question embedding
+        
+    Yields:
+        str: Successive pieces of the answer text
+    """
+    try:
+        logger.debug(f"Streaming query for index_id: {index_id}")
+        logger.debug(f"Question: {question}")
+        
+        persist_dir = os.path.join(STORAGE_DIR, index_id)
+        if not os.path.exists(persist_dir):
+            raise Exception("Document index not found. Please re-upload the document.")
+        
+        query_engine = index_cache.get(index_id, persist_dir, load_query_engine).streaming_query_engine
+        pieces = []
+        with model_slot(), span("query", backend="llama_index"):
+            response = query_engine.query(query_bundle(question, embedding))
+            for text in response.response_gen:
+                pieces.append(text)
+                yield text
+        record_usage(question, response, "".join(pieces))
+        
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error streaming answer: {error_msg}")
+        raise api_error(error_msg)
+
+def answer_from_passages(question, passages):
+    """
+    Answer a question from passages drawn from several documents
+    
+    Args:
+        question (str): User's question
+        passages (list): dicts with "filename" and "text", best first
+        
+    Returns:
+        str: Answer citing the passages by number
+    """
+    try:
+        prompt = build_library_prompt(question, passages)
+        with model_slot(), span("generation", backend="llama_index"):
+            answer = get_llm().complete(prompt).text
+        record_tokens("llama_index", estimate_tokens(prompt), estimate_tokens(answer))
+        return answer
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error answering from library: {error_msg}")
+        raise api_error(error_msg)
+
+def embed_question(question):
+    """Embed a question for near-duplicate matching in the answer cache."""
+    if LOCAL_EMBEDDINGS:
+        with span("question_embedding", backend="llama_index"):
+            return embed_texts([question])[0]
+    with model_slot(), span("question_embedding", backend="llama_index"):
+        return get_embedding_model().get_query_embedding(question)
+
+def query_document_cached(index_id, question):
+    """
+    Answer a question, reusing a cached answer for the same or a near-identical question
+    
+    Returns:
+        tuple: (answer, served_from_cache)
+    """
+    return answer_cache.get_or_compute(
+        index_id, question, query_document, embed=embed_question, embed_for_retrieval=True)
+
+def stream_query_document_cached(index_id, question):
+    """
+    Stream an answer, or replay a cached one as a single piece
+    
+    Returns:
+        tuple: (iterator of answer text pieces, served_from_cache)
+    """
+    return answer_cache.stream_or_compute(
+        index_id, question, stream_query_document, embed=embed_question, embed_for_retrieval=True)
+
+def embed_questions(questions):
+    """Embed several questions in one request."""
+    if LOCAL_EMBEDDINGS:
+        with span("question_embedding", backend="llama_index"):
+            return embed_texts(questions)
+    from llama_index.embeddings.gemini import GeminiEmbedding
+    embed_model = get_embedding_model()
+    with model_slot(), span("question_embedding", backend="llama_index"):
+        if isinstance(embed_model, GeminiEmbedding):
+            # The wrapper would send one request per question; use its task type
+            # so vectors match those of single-question retrieval
+            result = genai.embed_content(model=embed_model.model_name, content=list(questions),
+                                         task_type=embed_model.task_type)
+            return result["embedding"]
+        return embed_model.get_text_embedding_batch(list(questions))
+
+def batch_context(index_id, questions, embeddings):
+    """
+    Retrieve the nodes for a batch of questions from their embeddings
+    
+    Memory-mapped stores are searched for every question with one matrix
+    product, and in hybrid mode each question gets the fused candidates
+    that fit its share of the token budget; legacy JSON indexes are
+    searched one question at a time.
+    
+    Returns:
+        BatchContext: Node texts keyed by node id, and each question's nodes
+    """
+    persist_dir = os.path.join(STORAGE_DIR, index_id)
+    if not os.path.exists(persist_dir):
+        raise Exception("Document index not found. Please re-upload the document.")
+    loaded = index_cache.get(index_id, persist_dir, load_query_engine)
+    index = loaded.index
+    
+    passages, selections = {}, []
+    if isinstance(index, MemmapVectorStore) and loaded.lexical_index is not None:
+        filename = index.metadata.get("filename", "")
+        with span("retrieval", backend="llama_index"):
+            for question, vector_hits in zip(questions, index.search_many(embeddings, HYBRID_CANDIDATES)):
+                candidates = fused_candidates(index, loaded.lexical_index, question, vector_hits)
+                chosen = [candidates[i] for i in select_within_budget(candidates, CONTEXT_TOKENS)]
+                for candidate in chosen:
+                    passages[candidate["position"]] = candidate["text"]
+                selections.append([candidate["position"] for candidate in chosen])
+    elif isinstance(index, MemmapVectorStore):
+        filename = index.metadata.get("filename", "")
+        with span("retrieval", backend="llama_index"):
+            ranked = index.search_many(embeddings, SIMILARITY_TOP_K)
+            positions = sorted({position for hits in ranked for position, _ in hits})
+            for position, record in zip(positions, index.get_records(positions)):
+                passages[position] = record["text"]
+        selections = [[position for position, _ in hits] for hits in ranked]
+    else:
+        filename = ""
+        retriever = index.as_retriever(similarity_top_k=SIMILARITY_TOP_K)
+        for question, embedding in zip(questions, embeddings):
+            nodes = retriever.retrieve(QueryBundle(question, embedding=list(embedding)))
+            for node in nodes:
+                passages.setdefault(node.node.node_id, node.node.get_content())
+                filename = filename or node.node.metadata.get("filename", "")
+            selections.append([node.node.node_id for node in nodes])
+    return BatchContext(filename, "Relevant Excerpts", passages, selections)
+
+def generate_text(prompt):
+    """Generate text for an ingest-time prompt, such as a summary."""
+    # Ingestion waits for a slot rather than being shed
+    with model_slot(shed=False):
+        text = get_llm().complete(prompt).text
+    record_tokens("llama_index", estimate_tokens(prompt), estimate_tokens(text))
+    return text
+
+def generate_batch_answer(prompt):
+    """
+    Generate the JSON answers to a batch prompt
+    
+    Returns:
+        tuple: (response text, prompt tokens, response tokens)
+    """
+    try:
+        with model_slot(), span("generation", backend="llama_index"):
+            answer = get_llm().complete(prompt).text
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error answering batch: {error_msg}")
+        raise api_error(error_msg)
+    prompt_tokens, response_tokens = estimate_tokens(prompt), estimate_tokens(answer)
+    record_tokens("llama_index", prompt_tokens, response_tokens)
+    return answer, prompt_tokens, response_tokens
+
+def answer_questions(index_id, questions):
+    """
+    Answer several questions about one document in as few calls as possible
+    
+    The questions are embedded in one request, which serves both the answer
+    cache and retrieval, and questions sharing nodes are answered together.
+    
+    Returns:
+        tuple: (per-question result dicts, usage dict); see batch_qa.answer_batch
+    """
+    return answer_batch(index_id, questions, lambda pending, embeddings: batch_context(index_id, pending, embeddings),
+                        generate_batch_answer, embed=embed_questions, embed_for_retrieval=True)
+
+async def aembed_question(question):
+    """Coroutine form of embed_question."""
+    if LOCAL_EMBEDDINGS:
+        return await asyncio.to_thread(embed_question, question)
+    async with amodel_slot():
+        with span("question_embedding", backend="llama_index"):
+            return await get_embedding_model().aget_query_embedding(question)
+
+async def load_index_async(index_id):
+    """Load an index into the index cache on a worker thread."""
+    persist_dir = os.path.join(STORAGE_DIR, index_id)
+    if not os.path.exists(persist_dir):
+        raise Exception("Document index not found. Please re-upload the document.")
+    return await asyncio.to_thread(index_cache.get, index_id, persist_dir, load_query_engine)
+
+async def aquery_document(index_id, question, embedding=None):
+    """Coroutine form of query_document, using the query engine's async API."""
+    try:
+        loaded = await load_index_async(index_id)
+        async with amodel_slot():
+            with span("query", backend="llama_index"):
+                response = await loaded.query_engine.aquery(query_bundle(question, embedding))
+                answer = str(response)
+        record_usage(question, response, answer)
+        return answer
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error querying document: {error_msg}")
+        raise api_error(error_msg)
+
+async def astream_query_document(index_id, question, embedding=None):
+    """Coroutine form of stream_query_document; an async generator of answer pieces."""
+    try:
+        loaded = await load_index_async(index_id)
+        pieces = []
+        async with amodel_slot():
+            with span("query", backend="llama_index"):
+                response = await loaded.streaming_query_engine.aquery(query_bundle(question, embedding))
+                async for text in response.async_response_gen():
+                    pieces.append(text)
+                    yield text
+        record_usage(question, response, "".join(pieces))
+    except Overloaded:
+        raise
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"Error streaming answer: {error_msg}")
+        raise api_error(error_msg)
+
+async def aquery_document_cached(index_id, question):
+    """
+    Coroutine form of query_document_cached, for the asyncio serving mode
+    
+    The index is loaded while the question is embedded for the cache lookup.
+    With the REST transport, which has no asyncio client, the blocking path
+    runs on a worker thread instead.
+    
+    Returns:
+        tuple: (answer, served_from_cache)
+    """
+    if not native_async():
+        return await asyncio.to_thread(query_document_cached, index_id, question)
+    return await answer_cache.aget_or_compute(index_id, question, aquery_document, embed=aembed_question,
+                                              prepare=lambda: load_index_async(index_id), embed_for_retrieval=True)
+
+async def astream_query_document_cached(index_id, question):
+    """
+    Coroutine form of stream_query_document_cached
+    
+    Returns:
+        tuple: (async iterator of answer text pieces, served_from_cache)
+    """
+    if not native_async():
+        pieces, cached = await asyncio.to_thread(stream_query_document_cached, index_id, question)
+        return iterate_in_thread(pieces), cached
+    return await answer_cache.astream_or_compute(index_id, question, astream_query_document,
+                                                 embed=aembed_question, prepare=lambda: load_index_async(index_id),
+                                                 embed_for_retrieval=True)
@@ -0,0 +1,307 @@
+"""
+Local CPU embeddings, and an on-disk cache of chunk embeddings.
+
+With EMBEDDING_BACKEND=local, both QA backends embed passages at ingest and
+questions at query time in-process instead of calling the Gemini embedding
+API, so ingest throughput no longer depends on its quota or latency.
+
+LOCAL_EMBEDDING_MODEL names a sentence-transformers model, run on CPU with
+LOCAL_EMBEDDING_THREADS threads. Without the sentence-transformers package,
+or with LOCAL_EMBEDDING_MODEL=hashing, a pure-NumPy model is used instead:
+signed feature hashing of words, word pairs and character trigrams. It
+needs no download and no network, which is what tests and benchmarks use.
+
+Every store records the model that embedded it (see utils.vector_store),
+since vectors of different models cannot be compared: documents ingested
+with one model must be re-ingested after switching to another.
+
+Chunk embeddings of either backend are cached in SQLite keyed by model and
+chunk hash, so re-ingesting unchanged text costs no model call.
+"""
+import os
+import re
+import math
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils.embedding_scheduler import chunk_key
+from utils.backends import per_process
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+# "gemini" embeds with the Gemini API, "local" with LOCAL_EMBEDDING_MODEL on CPU
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "gemini")
+LOCAL_EMBEDDINGS = EMBEDDING_BACKEND == "local"
+
+LOCAL_EMBEDDING_MODEL = os.environ.get("LOCAL_EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+LOCAL_EMBEDDING_THREADS = int(os.environ.get("LOCAL_EMBEDDING_THREADS", os.cpu_count() or 1))
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.environ.get("LOCAL_EMBEDDING_BATCH_SIZE", 64))
+LOCAL_EMBEDDING_DIMENSION = int(os.environ.get("LOCAL_EMBEDDING_DIMENSION", 384))  # hashing model only
+
+EMBEDDING_CACHE_ENABLED = os.environ.get("EMBEDDING_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'embedding_cache.db'))
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", 500000))
+
+WORD = re.compile(r"\w+")
+
+# Hashed features remembered per process; beyond this, features are rehashed
+FEATURE_CACHE_SIZE = 1000000
+
+class HashingEmbedder:
+    """
+    Pure-NumPy embedding model based on signed feature hashing.
+
+    Each text becomes a sparse bag of words, adjacent word pairs and character
+    trigrams with sublinear term frequencies; every feature is hashed to one
+    of dimension columns with a random sign, and the rows are L2-normalized.
+    Texts sharing words and phrases get similar vectors. A whole batch is
+    scattered into one matrix, so the NumPy work is vectorized across it.
+    """
+
+    # Weight of each feature family in the vector
+    WORD_WEIGHT = 1.0
+    PAIR_WEIGHT = 0.5
+    TRIGRAM_WEIGHT = 0.25
+
+    def __init__(self, dimension=LOCAL_EMBEDDING_DIMENSION):
+        self.dimension = dimension
+        self.model_id = f"local/hashing-{dimension}"
+        self._features = {}
+
+    def _feature(self, feature):
+        """(column, sign) of a feature, from a hash that is stable across processes."""
+        entry = self._features.get(feature)
+        if entry is None:
+            digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            entry = (digest % self.dimension, 1.0 if digest >> 63 else -1.0)
+            if len(self._features) < FEATURE_CACHE_SIZE:
+                self._features[feature] = entry
+        return entry
+
+    def _features_of(self, text):
+        words = WORD.findall(text.lower())
+        word_counts = Counter(words)
+        features = Counter(word_counts)
+        weights = dict.fromkeys(features, self.WORD_WEIGHT)
+        for pair, count in Counter(zip(words, words[1:])).items():
+            key = f"{pair[0]} {pair[1]}"
+            features[key] += count
+            weights[key] = self.PAIR_WEIGHT
+        for word, count in word_counts.items():
+            padded = f"<{word}>"
+            for i in range(len(padded) - 2):
+                key = "#" + padded[i:i + 3]
+                features[key] += count
+                weights[key] = self.TRIGRAM_WEIGHT
+        return features, weights
+
+    def embed(self, texts):
+        """
+        Embed a batch of texts
+
+        Returns:
+            np.ndarray: float32 (len(texts), dimension), rows L2-normalized
+        """
+        rows, columns, values = [], [], []
+        for row, text in enumerate(texts):
+            features, weights = self._features_of(text)
+            for feature, count in features.items():
+                column, sign = self._feature(feature)
+                rows.append(row)
+                columns.append(column)
+                values.append(sign * weights[feature] * (1.0 + math.log(count)))
+        matrix = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        np.add.at(matrix, (np.asarray(rows, dtype=np.intp), np.asarray(columns, dtype=np.intp)),
+                  np.asarray(values, dtype=np.float32))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1.0, norms)
+
+class SentenceTransformerEmbedder:
+    """A sentence-transformers model run on CPU."""
+
+    def __init__(self, name, threads=LOCAL_EMBEDDING_THREADS):
+        import torch
+        from sentence_transformers import SentenceTransformer
+        torch.set_num_threads(threads)
+        self.model = SentenceTransformer(name, device="cpu")
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        self.model_id = f"local/{name}"
+
+    def embed(self, texts):
+        return self.model.encode(list(texts), batch_size=LOCAL_EMBEDDING_BATCH_SIZE, convert_to_numpy=True,
+                                 normalize_embeddings=True, show_progress_bar=False).astype(np.float32)
+
+@per_process
+def get_local_model():
+    """Get the local embedding model shared by this process."""
+    if LOCAL_EMBEDDING_MODEL != "hashing":
+        try:
+            model = SentenceTransformerEmbedder(LOCAL_EMBEDDING_MODEL)
+            logger.info(f"Embedding locally with {LOCAL_EMBEDDING_MODEL} on {LOCAL_EMBEDDING_THREADS} threads")
+            return model
+        except ImportError:
+            logger.warning("sentence-transformers is not installed; embedding with the NumPy hashing model")
+    return HashingEmbedder()
+
+@per_process
+def _embedding_pool():
+    return ThreadPoolExecutor(max_workers=LOCAL_EMBEDDING_THREADS, thread_name_prefix="local-embedding")
+
+def local_model_id():
+    """Identifier of the local model, as recorded in the stores it embeds."""
+    return get_local_model().model_id
+
+def embed_texts(texts):
+    """
+    Embed texts with the local model in batches of LOCAL_EMBEDDING_BATCH_SIZE
+
+    sentence-transformers models run each batch on LOCAL_EMBEDDING_THREADS
+    torch threads; the hashing model spreads batches over as many Python
+    threads.
+
+    Returns:
+        np.ndarray: float32 (len(texts), dimension)
+    """
+    model = get_local_model()
+    texts = list(texts)
+    batches = [texts[start:start + LOCAL_EMBEDDING_BATCH_SIZE]
+               for start in range(0, len(texts), LOCAL_EMBEDDING_BATCH_SIZE)]
+    if not batches:
+        return np.zeros((0, model.dimension), dtype=np.float32)
+    if isinstance(model, HashingEmbedder) and LOCAL_EMBEDDING_THREADS > 1 and len(batches) > 1:
+        return np.concatenate(list(_embedding_pool().map(model.embed, batches)))
+    return np.concatenate([model.embed(batch) for batch in batches])
+
+def embed_documents(texts, known=None):
+    """
+    Embed passages locally, reusing the embeddings of known chunks
+
+    Has the signature of EmbeddingScheduler.embed, which paces remote
+    requests; local embedding needs no pacing or retries.
+
+    Args:
+        texts (list): Passages to embed
+        known (dict): chunk_key -> embedding of already embedded passages
+
+    Returns:
+        list: One embedding per text, in order
+    """
+    known = known or {}
+    keys = [chunk_key(text) for text in texts]
+    missing = [i for i, key in enumerate(keys) if key not in known]
+    computed = embed_texts([texts[i] for i in missing])
+    embeddings = [known.get(key) for key in keys]
+    for i, embedding in zip(missing, computed):
+        embeddings[i] = embedding
+    return embeddings
+
+class EmbeddingCache:
+    """
+    Persistent cache of chunk embeddings keyed on (model, chunk_key).
+
+    The oldest entries are evicted beyond max_entries.
+    """
+
+    def __init__(self, path, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, key TEXT NOT NULL, embedding BLOB NOT NULL, created_at REAL NOT NULL, "
+                "PRIMARY KEY (model, key))")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_embeddings_created_at ON embeddings (created_at)")
+            self._conn.commit()
+        return self._conn
+
+    def get_many(self, model, keys):
+        """
+        Cached embeddings of the given chunk keys
+
+        Returns:
+            dict: chunk_key -> float32 embedding, for the keys that are cached
+        """
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            # Stay under SQLite's limit on bound parameters
+            for start in range(0, len(keys), 500):
+                part = keys[start:start + 500]
+                found.update((key, np.frombuffer(blob, dtype=np.float32)) for key, blob in conn.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(part))})",
+                    [model] + part))
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, model, items):
+        """Store (chunk_key, embedding) pairs, evicting the oldest entries beyond max_entries."""
+        now = time.time()
+        rows = [(model, key, np.asarray(embedding, dtype=np.float32).tobytes(), now) for key, embedding in items]
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("INSERT OR REPLACE INTO embeddings (model, key, embedding, created_at) "
+                             "VALUES (?, ?, ?, ?)", rows)
+            excess = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM embeddings WHERE rowid IN "
+                             "(SELECT rowid FROM embeddings ORDER BY created_at LIMIT ?)", (excess,))
+            conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH)
+
+def embed_chunks(texts, model, embed, known=None):
+    """
+    Embed passages at ingest, skipping those already in the embedding cache
+
+    Args:
+        texts (list): Passages to embed
+        model (str): Model id the embeddings are cached under
+        embed (callable): Called with (texts, known=...) like EmbeddingScheduler.embed
+            or embed_documents; embeds the passages that are not known
+        known (dict): chunk_key -> embedding already available, e.g. from
+            the previous version of the document
+
+    Returns:
+        list: One embedding per text, in order
+    """
+    if not EMBEDDING_CACHE_ENABLED:
+        return embed(texts, known=known)
+    known = dict(known or {})
+    keys = [chunk_key(text) for text in texts]
+    try:
+        known.update(embedding_cache.get_many(model, [key for key in keys if key not in known]))
+    except Exception as e:
+        logger.warning(f"Embedding cache lookup failed: {str(e)}")
+    embeddings = embed(texts, known=known)
+    try:
+        embedding_cache.put_many(model, [(key, embedding) for key, embedding in zip(keys, embeddings)
+                                         if key not in known])
+    except Exception as e:
+        logger.warning(f"Embedding cache update failed: {str(e)}")
+    return embeddings
@@ -0,0 +1,216 @@
+"""
+Lightweight in-process metrics with Prometheus text exposition.
+
+Stages are timed with the span() context manager or the @timed decorator.
+Durations go into one histogram per (stage, labels) and, while a request is
+being handled, into a per-request list that app.py turns into a
+Server-Timing header. Counters track token counts and similar totals, and
+collectors report values owned by other objects (such as cache hit counts)
+at scrape time.
+
+Metrics are per process; with several workers, each one is scraped
+separately.
+"""
+import time
+import bisect
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+METRICS_PREFIX = "pdfqa"
+
+# Upper bounds in seconds, from fast cache lookups to slow model calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Stage durations of the request being handled, or None outside a request
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{str(value)}"'.replace("\n", " ") for key, value in labels)
+    return "{" + pairs + "}"
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Thread-safe store of histograms, counters and scrape-time collectors."""
+
+    def __init__(self, prefix=METRICS_PREFIX, buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, help_text="", **labels):
+        """Record one observation in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(self.buckets)
+                self._help.setdefault(name, help_text)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, help_text="", **labels):
+        """Add to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._help.setdefault(name, help_text)
+
+    def add_collector(self, collector):
+        """
+        Register a callable polled on every scrape.
+
+        It returns a list of (name, type, help, [(labels dict, value), ...]),
+        where type is "counter" or "gauge".
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            help_texts = dict(self._help)
+
+        seen = set()
+        for (name, labels), histogram in histograms:
+            full_name = f"{self.prefix}_{name}"
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {full_name} {help_texts.get(name) or name}")
+                lines.append(f"# TYPE {full_name} histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{full_name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+
+        for (name, labels), value in counters:
+            full_name = f"{self.prefix}_{name}"
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {full_name} {help_texts.get(name) or name}")
+                lines.append(f"# TYPE {full_name} counter")
+            lines.append(f"{full_name}{_format_labels(labels)} {value}")
+
+        # Several collectors may report the same family, e.g. one per cache;
+        # the exposition format needs each family's samples together
+        collected = {}
+        for collector in self._collectors:
+            try:
+                families = collector()
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {str(e)}")
+                continue
+            for name, metric_type, help_text, samples in families:
+                collected.setdefault(name, (metric_type, help_text, []))[2].extend(samples)
+
+        for name, (metric_type, help_text, samples) in collected.items():
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{full_name}{_format_labels(tuple(sorted(labels.items())))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+metrics = MetricsRegistry()
+
+@contextmanager
+def span(stage, **labels):
+    """Time a block as one pipeline stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("stage_duration_seconds", elapsed, "Time spent per pipeline stage",
+                        stage=stage, **labels)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((stage, elapsed))
+
+def timed(stage, **labels):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_tokens(backend, prompt_tokens, response_tokens):
+    """Count tokens sent to and received from the LLM."""
+    metrics.inc("llm_prompt_tokens_total", prompt_tokens, "Prompt tokens sent to the LLM", backend=backend)
+    metrics.inc("llm_response_tokens_total", response_tokens, "Response tokens received from the LLM",
+                backend=backend)
+    metrics.inc("llm_requests_total", 1, "Requests sent to the LLM", backend=backend)
+
+def cache_collector(name, cache):
+    """Collector reporting the hit, miss and size counters of an object with stats()."""
+    def collect():
+        stats = cache.stats()
+        families = [
+            ("cache_hits_total", "counter", "Cache lookups served from the cache",
+             [({"cache": name}, stats["hits"])]),
+            ("cache_misses_total", "counter", "Cache lookups that missed",
+             [({"cache": name}, stats["misses"])]),
+        ]
+        if "entries" in stats:
+            families.append(("cache_entries", "gauge", "Entries currently held in the cache",
+                             [({"cache": name}, stats["entries"])]))
+        return families
+    return collect
+
+def begin_request_timing():
+    """Start collecting stage durations for the current request."""
+    _request_spans.set([])
+
+def request_timings():
+    """
+    Stage durations of the current request, summed per stage
+
+    Returns:
+        list: (stage, seconds) in the order stages first ran
+    """
+    totals = {}
+    for stage, elapsed in _request_spans.get() or []:
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    return list(totals.items())
+
+def server_timing_header(timings, total=None):
+    """Format stage durations as a Server-Timing header value."""
+    entries = [f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in timings]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
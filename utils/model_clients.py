@@ -0,0 +1,289 @@
+"""
+Process-wide Gemini client configuration and admission control.
+
+Both backends configure the Gemini SDK through configure_gemini(), once per
+process, so the SDK's clients (and the HTTP sessions or gRPC channels they
+hold) stay warm across requests instead of being rebuilt per question.
+
+Every call to the model API goes through model_slot(). At most
+MODEL_MAX_CONCURRENCY calls are in flight per worker; further callers wait
+in a queue served round-robin across clients (FIFO for each client), so one
+busy client cannot starve the others. Once MODEL_QUEUE_SIZE callers are
+waiting, or a caller has waited MODEL_QUEUE_TIMEOUT seconds, the request is
+shed with Overloaded, which app.py turns into a 503 with Retry-After rather
+than adding to upstream rate limiting. Background ingestion waits for a
+slot without being shed. Coroutines use amodel_slot(), which shares the same
+slots and queue but waits without holding a thread.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+from dotenv import load_dotenv
+from utils.backends import per_process
+from utils.metrics import metrics
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
+
+# Alternative API host, e.g. a local stand-in server, and the SDK transport
+# ("rest" or "grpc"; the SDK picks one when unset)
+GEMINI_API_ENDPOINT = os.environ.get("GEMINI_API_ENDPOINT") or None
+GEMINI_TRANSPORT = os.environ.get("GEMINI_TRANSPORT") or None
+
+MODEL_MAX_CONCURRENCY = int(os.environ.get("MODEL_MAX_CONCURRENCY", 8))  # 0 disables the limit
+MODEL_QUEUE_SIZE = int(os.environ.get("MODEL_QUEUE_SIZE", 32))
+MODEL_QUEUE_TIMEOUT = float(os.environ.get("MODEL_QUEUE_TIMEOUT", 10.0))  # seconds
+
+# Fairness key of the current request; app.py sets it per client
+_client_key = contextvars.ContextVar("model_client_key", default="background")
+
+class Overloaded(Exception):
+    """Raised when a model call is shed because this worker is at capacity."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class _Waiter:
+    __slots__ = ("wake", "sheddable", "granted")
+
+    def __init__(self, wake, sheddable):
+        self.wake = wake
+        self.sheddable = sheddable
+        self.granted = False
+
+class FairLimiter:
+    """
+    Counting semaphore with a bounded queue served round-robin across keys.
+
+    Args:
+        limit (int): Calls allowed in flight at once; 0 or less disables the limit
+        max_queue (int): Sheddable callers allowed to wait before new ones are shed
+        timeout (float): Seconds a sheddable caller waits before it is shed
+    """
+
+    def __init__(self, limit, max_queue, timeout):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed = 0
+        self._queues = OrderedDict()  # key -> deque of waiters, in round-robin order
+        self._lock = threading.Lock()
+
+    def _overloaded(self, reason):
+        self.shed += 1
+        metrics.inc("model_requests_shed_total", 1, "Model calls rejected because the worker was at capacity",
+                    reason=reason)
+        return Overloaded("The server is busy answering other questions. Please try again shortly.",
+                          retry_after=max(1, int(self.timeout)))
+
+    def _enqueue(self, key, shed, wake):
+        """Take a free slot, or queue a waiter; returns None if a slot was taken."""
+        with self._lock:
+            if self.in_flight < self.limit and not self._queues:
+                self.in_flight += 1
+                self.admitted += 1
+                return None
+            if shed and self.queued >= self.max_queue:
+                raise self._overloaded("queue_full")
+            waiter = _Waiter(wake, shed)
+            self._queues.setdefault(key, deque()).append(waiter)
+            if shed:
+                self.queued += 1
+            return waiter
+
+    def _settle(self, key, waiter, start):
+        """After a wait: count the admission, or give up the place in the queue and shed."""
+        with self._lock:
+            if not waiter.granted:
+                queue = self._queues[key]
+                queue.remove(waiter)
+                if not queue:
+                    del self._queues[key]
+                self.queued -= 1
+                raise self._overloaded("timeout")
+            self.admitted += 1
+        metrics.observe("model_queue_wait_seconds", time.perf_counter() - start,
+                        "Time model calls waited for a free slot")
+
+    def acquire(self, key="background", shed=True):
+        """
+        Wait for a slot
+
+        Args:
+            key (str): Client the call is made for; waiting clients take turns
+            shed (bool): Whether the call may be rejected instead of waiting
+
+        Raises:
+            Overloaded: When the queue is full or the wait timed out
+        """
+        if self.limit <= 0:
+            return
+        event = threading.Event()
+        waiter = self._enqueue(key, shed, event.set)
+        if waiter is None:
+            return
+        start = time.perf_counter()
+        event.wait(self.timeout if shed else None)
+        self._settle(key, waiter, start)
+
+    async def acquire_async(self, key="background", shed=True):
+        """acquire() for coroutines: waits without blocking the event loop."""
+        if self.limit <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(key, shed, wake)
+        if waiter is None:
+            return
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeout if shed else None)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # The client went away: hand back a slot granted meanwhile, or leave the queue
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    queue = self._queues[key]
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[key]
+                    if waiter.sheddable:
+                        self.queued -= 1
+            if granted:
+                self.release()
+            raise
+        self._settle(key, waiter, start)
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        with self._lock:
+            self.in_flight -= 1
+            # Hand free slots to the next key in turn, rotating it to the back
+            while self.in_flight < self.limit and self._queues:
+                key, queue = self._queues.popitem(last=False)
+                waiter = queue.popleft()
+                if queue:
+                    self._queues[key] = queue
+                if waiter.sheddable:
+                    self.queued -= 1
+                self.in_flight += 1
+                waiter.granted = True
+                waiter.wake()
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": self.in_flight, "queued": self.queued,
+                    "admitted": self.admitted, "shed": self.shed}
+
+model_limiter = FairLimiter(MODEL_MAX_CONCURRENCY, MODEL_QUEUE_SIZE, MODEL_QUEUE_TIMEOUT)
+
+def set_client_key(key):
+    """Set the fairness key for model calls made while handling this request."""
+    _client_key.set(key or "background")
+
+@contextmanager
+def model_slot(shed=True):
+    """Hold one of this worker's model call slots for the duration of the block."""
+    model_limiter.acquire(_client_key.get(), shed=shed)
+    try:
+        yield
+    finally:
+        model_limiter.release()
+
+@asynccontextmanager
+async def amodel_slot(shed=True):
+    """model_slot() for coroutines."""
+    await model_limiter.acquire_async(_client_key.get(), shed=shed)
+    try:
+        yield
+    finally:
+        model_limiter.release()
+
+def native_async():
+    """Whether the SDK can make asyncio calls; its REST transport only has blocking ones."""
+    return GEMINI_TRANSPORT != "rest"
+
+async def iterate_in_thread(iterable):
+    """
+    Consume a blocking iterator on a worker thread, yielding its items to the event loop
+
+    Used for the REST transport, whose streams cannot be awaited. If the
+    consumer stops early, e.g. because its client disconnected, the worker
+    stops after the item it is waiting on and closes the iterator, so a
+    generator holding a model call slot releases it.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    end = object()
+    stopped = threading.Event()
+
+    def pump():
+        try:
+            for item in iterable:
+                if stopped.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+        except Exception as e:
+            if not stopped.is_set():
+                loop.call_soon_threadsafe(queue.put_nowait, (end, e))
+        else:
+            if not stopped.is_set():
+                loop.call_soon_threadsafe(queue.put_nowait, (end, None))
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    pumping = loop.run_in_executor(None, pump)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is end:
+                await pumping
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
+
+@per_process
+def configure_gemini():
+    """Configure the Gemini SDK once per process, before its first call."""
+    import google.generativeai as genai
+    options = {"api_key": GOOGLE_API_KEY}
+    if GEMINI_TRANSPORT:
+        options["transport"] = GEMINI_TRANSPORT
+    if GEMINI_API_ENDPOINT:
+        options["client_options"] = {"api_endpoint": GEMINI_API_ENDPOINT}
+    genai.configure(**options)
+
+def limiter_collector():
+    """Slots in use and callers waiting, read at scrape time."""
+    stats = model_limiter.stats()
+    return [
+        ("model_requests_in_flight", "gauge", "Model calls currently in flight in this worker",
+         [({}, stats["in_flight"])]),
+        ("model_requests_queued", "gauge", "Model calls waiting for a slot in this worker",
+         [({}, stats["queued"])]),
+    ]
@@ -1,34 +1,172 @@
-import fitz  # PyMuPDF
+import os
 import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from utils.metrics import metrics, span
 
 logger = logging.getLogger(__name__)
 
-def extract_text_from_pdf(pdf_path):
+# Number of extraction processes; 1 disables the pool entirely
+EXTRACT_WORKERS = int(os.environ.get("PDF_EXTRACT_WORKERS", os.cpu_count() or 1))
+
+# Documents shorter than this are extracted in-process, where the pool's
+# task overhead would cost more than it saves
+PARALLEL_MIN_PAGES = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", 32))
+
+# Appended to every page when pages are joined into a document's text
+PAGE_SEPARATOR = "\n\n"
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+def _get_pool(workers):
+    """Return the process-wide extraction pool of a given size, creating it on first use."""
+    global _pools_pid
+    # Ingestion workers extract concurrently; only one of them may create a pool
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # Pools inherited through a fork belong to the parent process
+            _pools.clear()
+            _pools_pid = os.getpid()
+        if workers not in _pools:
+            # Spawned workers are safe to start from the threaded web server
+            _pools[workers] = ProcessPoolExecutor(max_workers=workers,
+                                                  mp_context=multiprocessing.get_context("spawn"))
+        return _pools[workers]
+
+def _extract_page_range(pdf_path, start, stop):
+    """Extract pages [start, stop) in a worker with its own fitz document."""
+    import fitz  # PyMuPDF
+    with fitz.open(pdf_path) as pdf_document:
+        return [pdf_document.load_page(page_num).get_text() for page_num in range(start, stop)]
+
+def iter_pdf_pages(pdf_path, workers=None):
+    """
+    Extract text page by page, yielding results in page order as they finish
+
+    Page ranges are spread across a process pool for large documents, so
+    later stages can start consuming text before the whole PDF is done.
+
+    Args:
+        pdf_path (str): Path to the PDF file
+        workers (int): Number of processes to use; defaults to PDF_EXTRACT_WORKERS
+
+    Yields:
+        tuple: (page_no, text) with zero-based page numbers
+    """
+    # PyMuPDF is imported on first use so app workers start without it
+    import fitz  # PyMuPDF
+    workers = EXTRACT_WORKERS if workers is None else workers
+
+    with fitz.open(pdf_path) as pdf_document:
+        num_pages = len(pdf_document)
+        logger.debug(f"PDF has {num_pages} pages")
+
+        if workers <= 1 or num_pages < PARALLEL_MIN_PAGES:
+            for page_num in range(num_pages):
+                yield page_num, pdf_document.load_page(page_num).get_text()
+            return
+
+    # Several ranges per worker keeps the pool busy when page cost is uneven
+    pages_per_task = max(1, min(64, num_pages // (workers * 4)))
+    ranges = deque((start, min(start + pages_per_task, num_pages))
+                   for start in range(0, num_pages, pages_per_task))
+
+    pool = _get_pool(workers)
+    # Bound the ranges in flight so finished text does not pile up in memory
+    pending = deque()
+    try:
+        while ranges or pending:
+            while ranges and len(pending) < workers * 2:
+                start, stop = ranges.popleft()
+                pending.append((start, pool.submit(_extract_page_range, pdf_path, start, stop)))
+
+            start, future = pending.popleft()
+            for offset, page_text in enumerate(future.result()):
+                yield start + offset, page_text
+    finally:
+        # A consumer that stops early should not leave work queued in the pool
+        for _, future in pending:
+            future.cancel()
+
+def extract_pages_from_pdf(pdf_path, workers=None):
+    """
+    Extract the text of every page of a PDF file
+
+    Args:
+        pdf_path (str): Path to the PDF file
+        workers (int): Number of extraction processes; defaults to PDF_EXTRACT_WORKERS
+
+    Returns:
+        list: Text of each page, in page order
+    """
+    try:
+        logger.debug(f"Extracting pages from PDF: {pdf_path}")
+        with span("extract"):
+            pages = [page_text for _, page_text in iter_pdf_pages(pdf_path, workers)]
+        metrics.inc("pages_extracted_total", len(pages), "PDF pages extracted")
+        logger.debug(f"Successfully extracted {len(pages)} pages from PDF")
+        return pages
+    except Exception as e:
+        logger.error(f"Error extracting text from PDF: {str(e)}")
+        raise Exception(f"Failed to extract text from PDF: {str(e)}")
+
+def extract_outline(pdf_path):
+    """
+    Read a PDF's outline (bookmarks)
+
+    Returns:
+        list: [level, title, page] entries in document order, with pages
+        numbered from 1; empty if the PDF has no outline
+    """
+    import fitz  # PyMuPDF
+    try:
+        with fitz.open(pdf_path) as pdf_document:
+            return [[level, title, page] for level, title, page in pdf_document.get_toc(simple=True)]
+    except Exception as e:
+        # The outline only improves summaries, so a broken one is not fatal
+        logger.warning(f"Could not read the outline of {pdf_path}: {str(e)}")
+        return []
+
+def join_pages(pages):
+    """Join page texts the way extract_text_from_pdf does."""
+    return "".join(page_text + PAGE_SEPARATOR for page_text in pages)
+
+def page_spans(pages):
+    """
+    Character offsets of each page within join_pages(pages)
+
+    Returns:
+        list: (start, end) offsets, one per page
+    """
+    spans = []
+    position = 0
+    for page_text in pages:
+        spans.append((position, position + len(page_text)))
+        position += len(page_text) + len(PAGE_SEPARATOR)
+    return spans
+
+def extract_text_from_pdf(pdf_path, workers=None):
     """
     Extract text from a PDF file using PyMuPDF (fitz)
-    
+
     Args:
         pdf_path (str): Path to the PDF file
-        
+        workers (int): Number of extraction processes; defaults to PDF_EXTRACT_WORKERS
+
     Returns:
         str: Extracted text from the PDF
     """
     try:
         logger.debug(f"Extracting text from PDF: {pdf_path}")
-        text = ""
-        
-        # Open the PDF file
-        with fitz.open(pdf_path) as pdf_document:
-            # Get the number of pages
-            num_pages = len(pdf_document)
-            logger.debug(f"PDF has {num_pages} pages")
-            
-            # Extract text from each page
-            for page_num in range(num_pages):
-                page = pdf_document.load_page(page_num)
-                page_text = page.get_text()
-                text += page_text + "\n\n"  # Add double newline between pages
-        
+
+        # Add double newline between pages
+        with span("extract"):
+            text = join_pages(page_text for _, page_text in iter_pdf_pages(pdf_path, workers))
+
         logger.debug(f"Successfully extracted {len(text)} characters from PDF")
         return text
     except Exception as e:
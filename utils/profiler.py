@@ -0,0 +1,364 @@
+"""
+On-demand sampling profiler for individual requests.
+
+A profiled request gets a sampler thread that reads the request thread's
+stack every PROFILE_INTERVAL seconds through sys._current_frames(), so the
+request itself runs unmodified and requests that are not profiled pay
+nothing. Identical stacks are counted, and the result is written under
+PROFILE_DIR as a speedscope file (https://www.speedscope.app) or as
+collapsed stacks for flamegraph.pl, with a small metadata file next to it.
+
+A request is profiled when it carries an X-Profile header with the
+PROFILER_TOKEN, or while profiling is armed from the admin endpoint for
+requests under a path. Arming is stored in a file in PROFILE_DIR, so it
+applies to every worker process.
+"""
+import os
+import sys
+import re
+import json
+import time
+import uuid
+import hmac
+import random
+import logging
+import threading
+import sysconfig
+import contextvars
+from datetime import datetime
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'profiles')
+ARM_FILE = ".armed.json"
+FORMATS = {"speedscope": ".speedscope.json", "collapsed": ".collapsed.txt"}
+PROFILE_ID = re.compile(r"^\d{8}T\d{12}-[0-9a-f]{8}$")
+
+# Seconds between re-reading the arm file; requests in between use the cached state
+ARM_CHECK_INTERVAL = 1.0
+
+# Profile id of the request being handled, for response headers
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+
+_STDLIB_DIR = sysconfig.get_paths()["stdlib"]
+
+_frame_names = {}
+
+def _frame_name(code):
+    """Display name of a code object: function, and file relative to the repo, site-packages or stdlib."""
+    name = _frame_names.get(code)
+    if name is None:
+        filename = code.co_filename
+        marker = filename.rfind("site-packages" + os.sep)
+        if marker >= 0:
+            filename = filename[marker + len("site-packages") + 1:]
+        elif filename.startswith(os.path.dirname(PROFILE_DIR) + os.sep):
+            filename = os.path.relpath(filename, os.path.dirname(PROFILE_DIR))
+        elif filename.startswith(_STDLIB_DIR + os.sep):
+            filename = os.path.relpath(filename, _STDLIB_DIR)
+        qualname = getattr(code, "co_qualname", code.co_name)
+        # Semicolons separate frames in the collapsed format
+        name = f"{qualname} ({filename}:{code.co_firstlineno})".replace(";", ":")
+        _frame_names[code] = name
+    return name
+
+class Profile:
+    """
+    Samples the stacks of one thread, or of every thread, until stopped.
+
+    Stacks are kept as tuples of code objects, root first, each with the
+    number of samples and the seconds they account for.
+    """
+
+    def __init__(self, thread_id=None, interval=0.005, max_seconds=300.0):
+        self.id = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+        self.thread_id = thread_id
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.stacks = {}
+        self.samples = 0
+        self.started_at = None
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{self.id}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+            if now - self.started_at > self.max_seconds:
+                logger.warning(f"Profile {self.id} stopped after {self.max_seconds:.0f} seconds")
+                break
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frames = {self.thread_id: frames[self.thread_id]} if self.thread_id in frames else {}
+            else:
+                frames.pop(own_id, None)
+                if len(names) != len(frames):
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                stack.reverse()
+                if self.thread_id is None:
+                    # Threads are told apart by a name frame at the root
+                    stack.insert(0, f"thread {names.get(thread_id, thread_id)}")
+                key = tuple(stack)
+                entry = self.stacks.get(key)
+                if entry is None:
+                    entry = self.stacks[key] = [0, 0.0]
+                entry[0] += 1
+                entry[1] += elapsed
+            self.samples += 1
+            del frames
+
+    def _names(self, stack):
+        return [frame if isinstance(frame, str) else _frame_name(frame) for frame in stack]
+
+    def collapsed(self):
+        """Stacks in the collapsed format: "root;...;leaf count" per line."""
+        lines = [f"{';'.join(self._names(stack))} {count}"
+                 for stack, (count, _) in sorted(self.stacks.items(), key=lambda item: -item[1][0])]
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, name):
+        """The profile as a speedscope "sampled" profile, weighted in seconds."""
+        frames, index, samples, weights = [], {}, [], []
+        for stack, (_, seconds) in self.stacks.items():
+            sample = []
+            for frame in self._names(stack):
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({"name": frame})
+                sample.append(index[frame])
+            samples.append(sample)
+            weights.append(seconds)
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": name,
+            "exporter": "pdfqa",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": samples,
+                "weights": weights,
+            }],
+        }
+
+def current_profile_id():
+    """Id of the profile recording the current request, or None."""
+    return _current_profile.get()
+
+class RequestProfiler:
+    """
+    Starts, stops and stores profiles of individual requests.
+
+    Profiling is off unless PROFILER_TOKEN is set. At most PROFILE_MAX_ACTIVE
+    requests per process are profiled at a time; others run unprofiled.
+    """
+
+    def __init__(self, app=None):
+        self.token = ""
+        self.profile_dir = PROFILE_DIR
+        self.interval = 0.005
+        self.format = "speedscope"
+        self.keep = 200
+        self.max_seconds = 300.0
+        self.max_active = 4
+        self._slots = threading.BoundedSemaphore(self.max_active)
+        self._armed = None
+        self._armed_checked = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.token = app.config.get('PROFILER_TOKEN', self.token)
+        self.profile_dir = app.config.get('PROFILE_DIR', self.profile_dir)
+        self.interval = app.config.get('PROFILE_INTERVAL', self.interval)
+        self.format = app.config.get('PROFILE_FORMAT', self.format)
+        self.keep = app.config.get('PROFILE_KEEP', self.keep)
+        self.max_seconds = app.config.get('PROFILE_MAX_SECONDS', self.max_seconds)
+        self.max_active = app.config.get('PROFILE_MAX_ACTIVE', self.max_active)
+        self._slots = threading.BoundedSemaphore(self.max_active)
+        if self.format not in FORMATS:
+            raise Exception(f"Unknown PROFILE_FORMAT '{self.format}'; expected one of: {', '.join(FORMATS)}")
+
+    @property
+    def enabled(self):
+        return bool(self.token)
+
+    def authorized(self, token):
+        """Whether a token given with a request is the profiler token."""
+        return self.enabled and bool(token) and hmac.compare_digest(token.encode("utf-8"), self.token.encode("utf-8"))
+
+    def arm(self, duration, path="/", sample_rate=1.0):
+        """
+        Profile requests under path, in every worker, for the next duration seconds
+
+        Returns:
+            dict: The armed state
+        """
+        state = {"until": time.time() + duration, "path": path or "/", "sample_rate": sample_rate}
+        os.makedirs(self.profile_dir, exist_ok=True)
+        arm_path = os.path.join(self.profile_dir, ARM_FILE)
+        with open(arm_path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(arm_path + ".tmp", arm_path)
+        self._armed_checked = 0.0
+        return state
+
+    def disarm(self):
+        try:
+            os.remove(os.path.join(self.profile_dir, ARM_FILE))
+        except FileNotFoundError:
+            pass
+        self._armed_checked = 0.0
+
+    def armed(self):
+        """The armed state if it has not expired, re-read at most every ARM_CHECK_INTERVAL seconds."""
+        now = time.monotonic()
+        if now - self._armed_checked > ARM_CHECK_INTERVAL:
+            try:
+                with open(os.path.join(self.profile_dir, ARM_FILE), "r") as f:
+                    self._armed = json.load(f)
+            except (OSError, ValueError):
+                self._armed = None
+            self._armed_checked = now
+        armed = self._armed
+        return armed if armed and armed["until"] > time.time() else None
+
+    def start(self, path, header=None, thread_id=None):
+        """
+        Start profiling a request if its header or the armed state asks for it
+
+        Args:
+            path (str): Request path
+            header (str): Value of the request's X-Profile header
+            thread_id (int): Thread to sample; None samples every thread
+
+        Returns:
+            Profile: The running profile, or None if the request is not profiled
+        """
+        if not self.enabled:
+            return None
+        if header:
+            if not self.authorized(header):
+                return None
+        else:
+            armed = self.armed()
+            if armed is None or not path.startswith(armed["path"]) or random.random() >= armed["sample_rate"]:
+                return None
+        if not self._slots.acquire(blocking=False):
+            logger.warning(f"Not profiling {path}: {self.max_active} profiles already running")
+            return None
+        profile = Profile(thread_id, self.interval, self.max_seconds).start()
+        _current_profile.set(profile.id)
+        return profile
+
+    def finish(self, profile, **info):
+        """
+        Stop a profile and write it with its metadata
+
+        Args:
+            profile (Profile): A profile returned by start()
+            **info: Request details stored with it, such as method, path and status
+
+        Returns:
+            str: The profile id
+        """
+        try:
+            profile.stop()
+        finally:
+            self._slots.release()
+        if _current_profile.get() == profile.id:
+            _current_profile.set(None)
+        try:
+            self._write(profile, info)
+        except Exception as e:
+            logger.error(f"Error writing profile {profile.id}: {str(e)}")
+        return profile.id
+
+    def _write(self, profile, info):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f"{info.get('method', '')} {info.get('path', '')}".strip() or profile.id
+        filename = profile.id + FORMATS[self.format]
+        if self.format == "speedscope":
+            content = json.dumps(profile.speedscope(name), separators=(",", ":"))
+        else:
+            content = profile.collapsed()
+        with open(os.path.join(self.profile_dir, filename), "w") as f:
+            f.write(content)
+
+        meta = dict(info, id=profile.id, file=filename, format=self.format,
+                    created_at=datetime.utcnow().isoformat() + "Z",
+                    duration_ms=round(profile.duration * 1000, 1), samples=profile.samples,
+                    interval_ms=profile.interval * 1000, size=len(content))
+        with open(os.path.join(self.profile_dir, profile.id + ".meta.json"), "w") as f:
+            json.dump(meta, f)
+        logger.info(f"Profiled {name} in {filename} ({profile.samples} samples)")
+        self._prune()
+
+    def _prune(self):
+        """Remove the oldest profiles beyond PROFILE_KEEP."""
+        ids = sorted(name[:-len(".meta.json")] for name in os.listdir(self.profile_dir)
+                     if name.endswith(".meta.json"))
+        for profile_id in ids[:max(0, len(ids) - self.keep)]:
+            for name in [profile_id + ".meta.json"] + [profile_id + suffix for suffix in FORMATS.values()]:
+                try:
+                    os.remove(os.path.join(self.profile_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def list_profiles(self, limit=50):
+        """
+        Metadata of the most recent profiles
+
+        Returns:
+            list: Dicts as written by finish(), newest first
+        """
+        if not os.path.isdir(self.profile_dir):
+            return []
+        names = sorted((name for name in os.listdir(self.profile_dir) if name.endswith(".meta.json")),
+                       reverse=True)
+        profiles = []
+        for name in names[:limit]:
+            try:
+                with open(os.path.join(self.profile_dir, name), "r") as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                # Pruned or still being written by another process
+                continue
+        return profiles
+
+    def profile_path(self, profile_id):
+        """Path of a stored profile file, or None if there is no such profile."""
+        if not PROFILE_ID.match(profile_id or ""):
+            return None
+        for suffix in FORMATS.values():
+            path = os.path.join(self.profile_dir, profile_id + suffix)
+            if os.path.exists(path):
+                return path
+        return None
@@ -0,0 +1,337 @@
+"""
+Disk management for uploads/ and storage/: compaction, garbage collection and deletion.
+
+- Compaction rewrites index directories written by earlier versions into the
+  current layout: text once, compressed, in text.zst (see utils.text_store),
+  passage records without copies of it, and LlamaIndex JSON stores converted
+  to the memory-mapped store and removed.
+- Garbage collection removes what no Document row refers to: index
+  directories and upload files left by failed or deleted uploads, part files
+  of abandoned upload sessions, and stale embedding checkpoints.
+
+Anything changed within the grace period is left alone, so files of an
+upload or ingest still in progress are never touched. StorageCompactor runs
+both periodically in the background; run them once with:
+    flask storage-gc [--dry-run]
+"""
+import os
+import json
+import shutil
+import logging
+import threading
+from datetime import datetime, timedelta
+from models import db, Document, UploadSession
+from utils.text_store import has_text, write_text
+from utils.vector_store import LEGACY_FILES, has_vector_store, compact_records, migrate_llama_index_storage
+from utils.backends import BACKENDS, loaded_cache
+from utils.answer_cache import answer_cache
+from utils.corpus_index import corpus_index
+from utils.uploads import forget_upload
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+STORAGE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'storage')
+CHECKPOINT_DIR = os.path.join(STORAGE_DIR, ".checkpoints")
+LOCK_FILE = os.path.join(STORAGE_DIR, ".storage-gc.lock")
+
+# Rows looked up per database query while matching files against the Document table
+LOOKUP_BATCH_SIZE = 500
+
+def path_bytes(path):
+    """Size of a file, or of every file under a directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def _changed_within(path, grace):
+    """Whether a path, or anything directly inside a directory, was modified within grace seconds."""
+    cutoff = datetime.utcnow().timestamp() - grace
+    try:
+        if os.path.getmtime(path) > cutoff:
+            return True
+        if os.path.isdir(path):
+            with os.scandir(path) as it:
+                return any(entry.stat().st_mtime > cutoff for entry in it)
+    except OSError:
+        # Files appearing or disappearing mean something is working on it
+        return True
+    return False
+
+def _write_json(path, data):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+def compact_index_dir(persist_dir):
+    """
+    Rewrite one index directory into the current, compact layout
+
+    Returns:
+        bool: Whether anything was rewritten
+    """
+    changed = False
+
+    # gemini_direct documents stored their text in pretty-printed JSON
+    document_file = os.path.join(persist_dir, "document_data.json")
+    if os.path.exists(document_file):
+        with open(document_file, "r") as f:
+            document_data = json.load(f)
+        if "text" in document_data:
+            if not has_text(persist_dir):
+                write_text(persist_dir, document_data["text"])
+            _write_json(document_file, {key: value for key, value in document_data.items() if key != "text"})
+            changed = True
+
+    # LlamaIndex documents kept it in enhanced_analysis.json, and again in a JSON docstore
+    analysis_file = os.path.join(persist_dir, "enhanced_analysis.json")
+    if os.path.exists(os.path.join(persist_dir, "default__vector_store.json")) and not has_vector_store(persist_dir):
+        migrate_llama_index_storage(persist_dir)
+        changed = True
+    if os.path.exists(analysis_file):
+        with open(analysis_file, "r") as f:
+            analysis = json.load(f)
+        if "text" in analysis:
+            if not has_text(persist_dir):
+                write_text(persist_dir, analysis["text"])
+            _write_json(analysis_file, {key: value for key, value in analysis.items() if key != "text"})
+            changed = True
+
+    if has_vector_store(persist_dir):
+        # Only records whose text matches text.zst at their offsets are stripped
+        changed = compact_records(persist_dir) > 0 or changed
+        for name in LEGACY_FILES:
+            path = os.path.join(persist_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+                changed = True
+    return changed
+
+def invalidate_index(index_id):
+    """Drop an index from the corpus index, the answer cache and loaded backends' caches."""
+    corpus_index.remove_index(index_id)
+    answer_cache.invalidate(index_id)
+    for name in BACKENDS:
+        cache = loaded_cache(name)
+        if cache is not None:
+            cache.invalidate(index_id)
+
+def remove_index(index_id, storage_dir=STORAGE_DIR):
+    """
+    Delete an index directory and everything cached for it
+
+    Returns:
+        int: Bytes freed
+    """
+    persist_dir = os.path.join(storage_dir, index_id)
+    if not index_id or os.path.dirname(os.path.normpath(persist_dir)) != os.path.normpath(storage_dir):
+        raise Exception(f"Invalid index id '{index_id}'")
+    invalidate_index(index_id)
+    freed = path_bytes(persist_dir)
+    shutil.rmtree(persist_dir, ignore_errors=True)
+    logger.debug(f"Removed index {index_id} ({freed} bytes)")
+    return freed
+
+def remove_upload(filepath):
+    """
+    Delete an uploaded file
+
+    Returns:
+        int: Bytes freed
+    """
+    try:
+        freed = os.path.getsize(filepath)
+        os.remove(filepath)
+    except FileNotFoundError:
+        return 0
+    logger.debug(f"Removed upload {filepath} ({freed} bytes)")
+    return freed
+
+def _unreferenced(values, column):
+    """The values that no Document row has in column, looked up in batches."""
+    values = list(values)
+    unreferenced = []
+    for start in range(0, len(values), LOOKUP_BATCH_SIZE):
+        batch = values[start:start + LOOKUP_BATCH_SIZE]
+        referenced = {value for (value,) in db.session.query(column).filter(column.in_(batch))}
+        unreferenced.extend(value for value in batch if value not in referenced)
+    return unreferenced
+
+def collect_garbage(upload_folder, storage_dir=STORAGE_DIR, grace=86400, dry_run=False):
+    """
+    Remove index directories, uploads and part files that nothing refers to
+
+    Must run inside an app context.
+
+    Args:
+        upload_folder (str): Folder of uploaded PDFs
+        storage_dir (str): Folder of index directories
+        grace (float): Seconds since its last change before anything is removed
+        dry_run (bool): Only report what would be removed
+
+    Returns:
+        dict: Counts of removed "indexes", "uploads", "parts" and
+        "checkpoints", and "bytes_freed"
+    """
+    report = {"indexes": 0, "uploads": 0, "parts": 0, "checkpoints": 0, "bytes_freed": 0}
+
+    # Dot-entries hold shared state: .corpus, .checkpoints and lock files
+    index_ids = [name for name in os.listdir(storage_dir) if not name.startswith(".")
+                 and os.path.isdir(os.path.join(storage_dir, name))] if os.path.isdir(storage_dir) else []
+    for index_id in _unreferenced(index_ids, Document.index_id):
+        persist_dir = os.path.join(storage_dir, index_id)
+        if _changed_within(persist_dir, grace):
+            continue
+        report["indexes"] += 1
+        report["bytes_freed"] += path_bytes(persist_dir) if dry_run else remove_index(index_id, storage_dir)
+
+    names = os.listdir(upload_folder) if os.path.isdir(upload_folder) else []
+    filepaths = [os.path.join(upload_folder, name) for name in names if not name.startswith(".")]
+    for filepath in _unreferenced(filepaths, Document.filepath):
+        if not os.path.isfile(filepath) or _changed_within(filepath, grace):
+            continue
+        report["uploads"] += 1
+        report["bytes_freed"] += path_bytes(filepath) if dry_run else remove_upload(filepath)
+
+    # Part files of sessions that were never committed, or never will be
+    cutoff = datetime.utcnow() - timedelta(seconds=grace)
+    for name in names:
+        if not (name.startswith(".upload-") and name.endswith(".part")):
+            continue
+        filepath = os.path.join(upload_folder, name)
+        upload_id = name[len(".upload-"):-len(".part")]
+        if _changed_within(filepath, grace):
+            continue
+        upload = db.session.get(UploadSession, upload_id)
+        if upload is not None and upload.status == 'open':
+            if upload.updated_at and upload.updated_at > cutoff:
+                continue
+            if not dry_run:
+                # A client resuming it now gets a 409 instead of appending to a missing file
+                expired = UploadSession.query.filter(
+                    UploadSession.id == upload_id, UploadSession.status == 'open',
+                    UploadSession.updated_at <= cutoff).update({'status': 'expired'}, synchronize_session=False)
+                db.session.commit()
+                if not expired:
+                    continue
+                forget_upload(upload_id)
+        report["parts"] += 1
+        report["bytes_freed"] += path_bytes(filepath) if dry_run else remove_upload(filepath)
+
+    checkpoint_dir = os.path.join(storage_dir, os.path.basename(CHECKPOINT_DIR))
+    if os.path.isdir(checkpoint_dir):
+        for name in os.listdir(checkpoint_dir):
+            filepath = os.path.join(checkpoint_dir, name)
+            if not os.path.isfile(filepath) or _changed_within(filepath, grace):
+                continue
+            report["checkpoints"] += 1
+            report["bytes_freed"] += path_bytes(filepath) if dry_run else remove_upload(filepath)
+
+    return report
+
+def compact_storage(storage_dir=STORAGE_DIR, grace=86400, dry_run=False):
+    """
+    Compact every index directory not changed within the grace period
+
+    Returns:
+        dict: "compacted" directory count and "bytes_freed"
+    """
+    report = {"compacted": 0, "bytes_freed": 0}
+    if not os.path.isdir(storage_dir):
+        return report
+    for index_id in sorted(os.listdir(storage_dir)):
+        persist_dir = os.path.join(storage_dir, index_id)
+        if index_id.startswith(".") or not os.path.isdir(persist_dir) or _changed_within(persist_dir, grace):
+            continue
+        if dry_run:
+            continue
+        before = path_bytes(persist_dir)
+        try:
+            if compact_index_dir(persist_dir):
+                report["compacted"] += 1
+                report["bytes_freed"] += before - path_bytes(persist_dir)
+        except Exception as e:
+            logger.error(f"Error compacting {persist_dir}: {str(e)}")
+    return report
+
+class StorageCompactor:
+    """
+    Background job that compacts index directories and collects garbage.
+
+    Every process starts the thread, but each pass takes an exclusive lock
+    file first, so only one process works on the storage at a time.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 3600.0
+        self.grace = 86400.0
+        self.storage_dir = STORAGE_DIR
+        self._thread = None
+        self._owner_pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('STORAGE_COMPACTION_INTERVAL', self.interval)
+        self.grace = app.config.get('STORAGE_GC_GRACE', self.grace)
+
+    def ensure_started(self):
+        """Start the compaction thread for this process if it is not running yet."""
+        if self._owner_pid == os.getpid() or self.interval <= 0:
+            return
+        with self._lock:
+            if self._owner_pid == os.getpid():
+                return
+            self._owner_pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="storage-compactor", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        stop = threading.Event()
+        while not stop.wait(self.interval):
+            try:
+                self.run()
+            except Exception as e:
+                logger.error(f"Error compacting storage: {str(e)}")
+
+    def run(self, dry_run=False, grace=None):
+        """
+        Compact storage and collect garbage once
+
+        Returns:
+            dict: Combined report of compact_storage and collect_garbage,
+            or None if another process is already running
+        """
+        grace = self.grace if grace is None else grace
+        os.makedirs(self.storage_dir, exist_ok=True)
+        with open(os.path.join(self.storage_dir, os.path.basename(LOCK_FILE)), "w") as handle:
+            if fcntl:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+            with self.app.app_context():
+                report = collect_garbage(self.app.config['UPLOAD_FOLDER'], self.storage_dir, grace, dry_run)
+            compacted = compact_storage(self.storage_dir, grace, dry_run)
+            report["compacted"] = compacted["compacted"]
+            report["bytes_freed"] += compacted["bytes_freed"]
+            report["dry_run"] = dry_run
+        if report["bytes_freed"] and not dry_run:
+            logger.info(f"Storage compaction freed {report['bytes_freed']} bytes: {report}")
+        return report
@@ -0,0 +1,385 @@
+"""
+Hierarchical summaries of long documents, built at ingest.
+
+The tree follows the PDF outline (bookmarks) where the document has one;
+otherwise, and within sections too long to route through, consecutive
+pages are grouped SUMMARY_TREE_FANOUT at a time, and those groups again, up
+to the whole document. Leaves are pages. Every node gets a short summary,
+written bottom-up: page summaries several pages per model call, and each
+section's from its children's summaries, so no call sees more than
+SUMMARY_TREE_BATCH_TOKENS of text. Summaries whose input is unchanged are
+carried over from the previous version of the document.
+
+Questions asking for a summary or overview ("summarize section 4") are
+routed down the tree by BM25 over section titles and summaries, without
+model calls: at each level the best-matching children are followed while
+they match clearly better than the rest. The prompt then holds the matched
+nodes' summaries, their children's summaries and, where they fit, the page
+text itself, so it grows with the depth of the tree rather than the length
+of the document. Other questions keep using passage retrieval.
+
+Saved as summary_tree.json next to the index:
+    {"root": 0, "nodes": [{"kind", "title", "pages": [first, last],
+     "start", "end", "hash", "summary", "children": [node ids]}, ...]}
+"""
+import os
+import re
+import json
+import hashlib
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from utils.bm25 import BM25Index, estimate_tokens
+from utils.batch_qa import parse_batch_answers
+from utils.pdf_processor import page_spans
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+SUMMARY_TREE_FILE = "summary_tree.json"
+
+SUMMARY_TREE_ENABLED = os.environ.get("SUMMARY_TREE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Shorter documents fit in a prompt, or in a few passages, without a tree
+SUMMARY_TREE_MIN_TOKENS = int(os.environ.get("SUMMARY_TREE_MIN_TOKENS", 8000))
+SUMMARY_TREE_FANOUT = int(os.environ.get("SUMMARY_TREE_FANOUT", 8))
+SUMMARY_TREE_BATCH_TOKENS = int(os.environ.get("SUMMARY_TREE_BATCH_TOKENS", 12000))  # page text per call
+SUMMARY_TREE_PARALLEL_CALLS = int(os.environ.get("SUMMARY_TREE_PARALLEL_CALLS", 4))
+SUMMARY_TREE_CONTEXT_TOKENS = int(os.environ.get("SUMMARY_TREE_CONTEXT_TOKENS", 4000))
+
+# Children followed per level, and how close to the best one's score they must be
+ROUTE_BEAM = 2
+ROUTE_RATIO = 0.5
+
+# Questions about a document or section as a whole
+BROAD_QUESTION = re.compile(
+    r"\b(summar|overview|outline|gist|synopsis|recap|tl;?dr|main (point|idea|topic|finding|argument)s?|"
+    r"key (point|takeaway|finding|idea)s?|what (is|are) (this|the) (document|paper|report|book|section|chapter)s? "
+    r"(about|covering)|what does (this|the) (document|paper|report|book|section|chapter) (cover|discuss|say))",
+    re.IGNORECASE)
+PAGE_REFERENCE = re.compile(r"\bpages?\s+(\d+)(?:\s*(?:-|–|to|through)\s*(\d+))?", re.IGNORECASE)
+
+def wants_summary_tree(text):
+    return SUMMARY_TREE_ENABLED and estimate_tokens(text) >= SUMMARY_TREE_MIN_TOKENS
+
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+def _node(kind, title, first_page, last_page, spans, children=None):
+    return {"kind": kind, "title": title, "pages": [first_page, last_page],
+            "start": spans[first_page - 1][0], "end": spans[last_page - 1][1],
+            "hash": None, "summary": "", "children": children or []}
+
+def build_structure(pages, outline=None, title="Document", fanout=None):
+    """
+    Lay out the tree of a document, without summaries
+
+    Args:
+        pages (list): Page texts
+        outline (list): [level, title, page] entries, as from
+            pdf_processor.extract_outline; pages are numbered from 1
+        title (str): Title of the root node
+        fanout (int): Most children a node gets before they are grouped
+
+    Returns:
+        list: Nodes, the root first; children are node ids
+    """
+    fanout = max(2, fanout or SUMMARY_TREE_FANOUT)
+    spans = page_spans(pages)
+    count = len(pages)
+    nodes = [_node("document", title, 1, count, spans)]
+    leaves = []
+    for number in range(1, count + 1):
+        leaves.append(len(nodes))
+        nodes.append(_node("page", f"Page {number}", number, number, spans))
+
+    # Outline entries in document order, with the pages up to the next
+    # entry at the same or a higher level; a heading sharing its page with
+    # the next one still gets that page
+    entries = [(level, entry_title.strip(), page) for level, entry_title, page in (outline or [])
+               if 1 <= page <= count and entry_title.strip()]
+    sections, stack = [], []  # stack: (level, node id) of open ancestors
+    for i, (level, entry_title, page) in enumerate(entries):
+        following = next((entries[j][2] for j in range(i + 1, len(entries)) if entries[j][0] <= level), count + 1)
+        node_id = len(nodes)
+        nodes.append(_node("section", entry_title, page, max(page, following - 1), spans))
+        while stack and stack[-1][0] >= level:
+            stack.pop()
+        parent = stack[-1][1] if stack else 0
+        nodes[parent]["children"].append(node_id)
+        sections.append(node_id)
+        stack.append((level, node_id))
+
+    def covered_pages(node_id):
+        return {number for child in nodes[node_id]["children"]
+                for number in range(nodes[child]["pages"][0], nodes[child]["pages"][1] + 1)}
+
+    # Pages go under the deepest nodes that contain them, ordered among the subsections
+    for node_id in [0] + sections:
+        first, last = nodes[node_id]["pages"]
+        covered = covered_pages(node_id)
+        own = [leaves[number - 1] for number in range(first, last + 1) if number not in covered]
+        nodes[node_id]["children"] = sorted(nodes[node_id]["children"] + own,
+                                            key=lambda child: (nodes[child]["pages"][0], nodes[child]["kind"] == "page"))
+
+    # Group long runs of children, so every level can be routed through
+    def group(node_id):
+        children = nodes[node_id]["children"]
+        while len(children) > fanout:
+            grouped = []
+            for start in range(0, len(children), fanout):
+                run = children[start:start + fanout]
+                if len(run) == 1:
+                    grouped.extend(run)
+                    continue
+                first, last = nodes[run[0]]["pages"][0], max(nodes[child]["pages"][1] for child in run)
+                grouped.append(len(nodes))
+                nodes.append(_node("pages", f"Pages {first}-{last}", first, last, spans, run))
+            children = grouped
+        nodes[node_id]["children"] = children
+        for child in list(children):
+            if nodes[child]["kind"] in ("section", "pages"):
+                group(child)
+    group(0)
+    return nodes
+
+def build_page_prompt(title, numbered_pages):
+    text = "\n\n".join(f"[Page {number}]\n{page_text}" for number, page_text in numbered_pages)
+    return f"""Summarize each page of the document below in at most 60 words. Keep names, numbers, defined terms and section headings that a reader might ask about.
+
+Document: {title}
+
+{text}
+
+Respond with only a JSON array holding one object per page, in order: [{{"id": 1, "answer": "..."}}]
+
+JSON:"""
+
+def build_section_prompt(title, section_title, parts):
+    text = "\n\n".join(f"{part_title}: {summary}" for part_title, summary in parts)
+    return f"""Below are summaries of the consecutive parts of "{section_title}" in the document "{title}". Write a summary of the whole of "{section_title}" in at most 120 words, covering each part. Keep names, numbers and headings a reader might ask about.
+
+{text}
+
+Summary:"""
+
+def summarize_tree(nodes, pages, generate, title="Document", known=None):
+    """
+    Fill in the summaries of every node, leaves first
+
+    Args:
+        nodes (list): Nodes from build_structure; updated in place
+        pages (list): Page texts
+        generate (callable): Called with a prompt; returns the response text
+        known (dict): Node hash -> summary from an earlier version
+
+    Returns:
+        int: Model calls made
+    """
+    known = known or {}
+    calls = 0
+
+    def parallel(function, tasks):
+        nonlocal calls
+        calls += len(tasks)
+        with ThreadPoolExecutor(max_workers=max(1, SUMMARY_TREE_PARALLEL_CALLS)) as executor:
+            return list(executor.map(lambda task: contextvars.copy_context().run(function, task), tasks))
+
+    # Pages, several per call up to the batch budget
+    batches, batch, batch_tokens = [], [], 0
+    for node in nodes:
+        if node["kind"] != "page":
+            continue
+        page_text = pages[node["pages"][0] - 1]
+        node["hash"] = _digest(page_text)
+        if node["hash"] in known:
+            node["summary"] = known[node["hash"]]
+            continue
+        if not page_text.strip():
+            continue
+        tokens = estimate_tokens(page_text)
+        if batch and batch_tokens + tokens > SUMMARY_TREE_BATCH_TOKENS:
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(node)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+
+    def summarize_pages(batch):
+        numbered = [(node["pages"][0], pages[node["pages"][0] - 1]) for node in batch]
+        summaries = parse_batch_answers(generate(build_page_prompt(title, numbered)), len(batch))
+        for node, summary in zip(batch, summaries):
+            # A page the model skipped is represented by its opening text
+            node["summary"] = summary or " ".join(pages[node["pages"][0] - 1].split())[:400]
+    parallel(summarize_pages, batches)
+
+    # Then each level of sections once all of its children are done
+    def depth(node_id):
+        children = nodes[node_id]["children"]
+        return 1 + max((depth(child) for child in children), default=-1) if children else 0
+    depths = {node_id: depth(node_id) for node_id, node in enumerate(nodes) if node["kind"] != "page"}
+
+    def summarize_section(node):
+        parts = [(nodes[child]["title"], nodes[child]["summary"]) for child in node["children"]
+                 if nodes[child]["summary"]]
+        if parts:
+            node["summary"] = generate(build_section_prompt(title, node["title"], parts)).strip()
+
+    for level in sorted(set(depths.values())):
+        todo = []
+        for node_id, node_depth in depths.items():
+            if node_depth != level:
+                continue
+            node = nodes[node_id]
+            node["hash"] = _digest(node["title"] + "\n" + "\n".join(nodes[child]["summary"]
+                                                                     for child in node["children"]))
+            if node["hash"] in known:
+                node["summary"] = known[node["hash"]]
+            else:
+                todo.append(node)
+        parallel(summarize_section, todo)
+    return calls
+
+class SummaryTree:
+    """A document's summary tree with BM25 routing over its titles and summaries."""
+
+    def __init__(self, nodes, root=0):
+        self.nodes = nodes
+        self.root = root
+        self._page_nodes = {node["pages"][0]: node_id for node_id, node in enumerate(nodes) if node["kind"] == "page"}
+        # Page and page-group titles are positions, not content
+        self.lexical_index = BM25Index.build([
+            (node["title"] + "\n" if node["kind"] in ("section", "document") else "") + node["summary"]
+            for node in nodes])
+
+    @classmethod
+    def build(cls, pages, generate, outline=None, title="Document", previous=None):
+        """
+        Build and summarize the tree of a document
+
+        Args:
+            previous (SummaryTree): Tree of an earlier version, whose
+                summaries are reused where their input is unchanged
+
+        Returns:
+            SummaryTree
+        """
+        nodes = build_structure(pages, outline, title)
+        known = {node["hash"]: node["summary"] for node in previous.nodes if node["hash"]} if previous else None
+        calls = summarize_tree(nodes, pages, generate, title, known)
+        logger.debug(f"Built summary tree of {len(nodes)} nodes for {title} with {calls} model calls")
+        return cls(nodes)
+
+    def save(self, persist_dir):
+        with open(os.path.join(persist_dir, SUMMARY_TREE_FILE), "w") as f:
+            json.dump({"root": self.root, "nodes": self.nodes}, f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, persist_dir):
+        """
+        Returns:
+            SummaryTree: Or None if the document has no tree
+        """
+        if not persist_dir or not os.path.exists(os.path.join(persist_dir, SUMMARY_TREE_FILE)):
+            return None
+        path = os.path.join(persist_dir, SUMMARY_TREE_FILE)
+        with open(path, "r") as f:
+            data = json.load(f)
+        return cls(data["nodes"], data["root"])
+
+    def _covering(self, first, last):
+        """The deepest node whose pages include first..last."""
+        node_id = self.root
+        while True:
+            child = next((child for child in self.nodes[node_id]["children"]
+                          if self.nodes[child]["pages"][0] <= first and last <= self.nodes[child]["pages"][1]), None)
+            if child is None:
+                return node_id
+            node_id = child
+
+    def route(self, question):
+        """
+        Find the nodes a question is about
+
+        Returns:
+            list: Node ids, best first; the root if nothing narrower matches,
+            or the pages a question names
+        """
+        reference = PAGE_REFERENCE.search(question)
+        if reference:
+            first = int(reference.group(1))
+            last = int(reference.group(2) or first)
+            if 1 <= first <= last <= self.nodes[self.root]["pages"][1]:
+                # A few pages are answered from the pages themselves
+                if last - first < SUMMARY_TREE_FANOUT:
+                    return [self._page_nodes[number] for number in range(first, last + 1)]
+                return [self._covering(first, last)]
+
+        scores = dict(self.lexical_index.search(question, len(self.nodes)))
+        # Best score anywhere in each subtree, so a match deep down is reachable
+        best = {}
+        def subtree_best(node_id):
+            if node_id not in best:
+                best[node_id] = max([scores.get(node_id, 0.0)] +
+                                    [subtree_best(child) for child in self.nodes[node_id]["children"]])
+            return best[node_id]
+        subtree_best(self.root)
+
+        matched, frontier = [], [self.root]
+        while frontier:
+            node_id = frontier.pop(0)
+            children = sorted(self.nodes[node_id]["children"], key=lambda child: -best[child])
+            top = best[children[0]] if children else 0.0
+            # Stop where the node matches better than anything below it
+            if top <= 0.0 or scores.get(node_id, 0.0) >= top:
+                matched.append(node_id)
+                continue
+            frontier.extend(child for child in children[:ROUTE_BEAM] if best[child] >= top * ROUTE_RATIO)
+        matched.sort(key=lambda node_id: -best[node_id])
+        return matched[:ROUTE_BEAM]
+
+    def context(self, question, text, token_budget=None):
+        """
+        Summaries and page text for a question asking for a summary
+
+        Args:
+            text (str): The document text, for page text
+            token_budget (int): Estimated tokens allowed; defaults to
+                SUMMARY_TREE_CONTEXT_TOKENS
+
+        Returns:
+            list: Passage strings, or None if the question should use
+            passage retrieval instead
+        """
+        if not (BROAD_QUESTION.search(question) or PAGE_REFERENCE.search(question)):
+            return None
+        token_budget = SUMMARY_TREE_CONTEXT_TOKENS if token_budget is None else token_budget
+        passages, used = [], 0
+
+        def add(passage):
+            nonlocal used
+            cost = estimate_tokens(passage)
+            if passages and used + cost > token_budget:
+                return False
+            passages.append(passage)
+            used += cost
+            return True
+
+        def heading(node):
+            first, last = node["pages"]
+            where = f"page {first}" if first == last else f"pages {first}-{last}"
+            return f"{node['title']} ({where})"
+
+        matched = self.route(question)
+        for node_id in matched:
+            node = self.nodes[node_id]
+            add(f"Summary of {heading(node)}:\n{node['summary']}")
+        # Detail: the parts of each matched node, then their text where it fits
+        for node_id in matched:
+            for child in self.nodes[node_id]["children"]:
+                add(f"Summary of {heading(self.nodes[child])}:\n{self.nodes[child]['summary']}")
+        for node_id in matched:
+            node = self.nodes[node_id]
+            if text is not None and estimate_tokens(text[node["start"]:node["end"]]) <= token_budget - used:
+                add(f"Text of {heading(node)}:\n{text[node['start']:node['end']].strip()}")
+        return passages
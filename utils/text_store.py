@@ -0,0 +1,43 @@
+"""
+Document text stored once per index, compressed with Zstandard.
+
+Both backends keep a document's full text in <persist_dir>/text.zst, and
+passages are stored as character offsets into it rather than as copies.
+"""
+import os
+import uuid
+import zstandard
+
+TEXT_FILE = "text.zst"
+
+# Higher levels compress better but slower; reads cost the same at any level
+ZSTD_LEVEL = int(os.environ.get("STORAGE_ZSTD_LEVEL", 10))
+
+def has_text(persist_dir):
+    return os.path.exists(os.path.join(persist_dir, TEXT_FILE))
+
+def write_text(persist_dir, text):
+    """
+    Compress and save a document's text, replacing any earlier copy atomically
+
+    Returns:
+        int: Compressed size in bytes
+    """
+    data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(text.encode("utf-8"))
+    temp_path = os.path.join(persist_dir, f".{TEXT_FILE}.{uuid.uuid4().hex}.tmp")
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, os.path.join(persist_dir, TEXT_FILE))
+    return len(data)
+
+def read_text(persist_dir):
+    """
+    Returns:
+        str: The document text, or None if none was saved
+    """
+    path = os.path.join(persist_dir, TEXT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        # Frames written by write_text record their size, so this is one allocation
+        return zstandard.ZstdDecompressor().decompress(f.read()).decode("utf-8")
@@ -0,0 +1,204 @@
+import os
+import shutil
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from models import db
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+class UploadError(Exception):
+    """A chunked upload request that cannot be applied, with its HTTP status."""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+def store_content_addressed(temp_path, upload_folder, content_hash, keep_temp=False):
+    """
+    Move a fully written upload to its content-addressed path.
+
+    Args:
+        keep_temp (bool): Link or copy instead of moving, leaving the
+            temporary file in place
+
+    Returns:
+        str: Final path; if identical content is already stored, the
+        temporary file is discarded and the existing path returned
+    """
+    filepath = os.path.join(upload_folder, f"{content_hash}.pdf")
+    if os.path.exists(filepath):
+        if not keep_temp:
+            os.remove(temp_path)
+        # Garbage collection spares recently touched files, so the copy is
+        # kept until the new document referring to it is committed
+        os.utime(filepath)
+    elif keep_temp:
+        try:
+            os.link(temp_path, filepath)
+        except OSError:
+            shutil.copyfile(temp_path, filepath)
+    else:
+        os.replace(temp_path, filepath)
+    return filepath
+
+def part_path(upload_folder, upload_id):
+    return os.path.join(upload_folder, f".upload-{upload_id}.part")
+
+# Running SHA-256 per upload, so each chunk only hashes its own bytes. A
+# chunk handled by another worker process falls back to re-reading the file.
+_hashers = {}
+_hashers_lock = threading.Lock()
+_upload_locks = {}
+
+def _take_hasher(upload_id, path, offset):
+    with _hashers_lock:
+        cached = _hashers.pop(upload_id, None)
+    if cached is not None and cached[0] == offset:
+        return cached[1]
+
+    logger.debug(f"Rehashing first {offset} bytes of upload {upload_id}")
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        remaining = offset
+        while remaining:
+            piece = f.read(min(READ_SIZE, remaining))
+            if not piece:
+                break
+            hasher.update(piece)
+            remaining -= len(piece)
+    return hasher
+
+def _put_hasher(upload_id, offset, hasher):
+    with _hashers_lock:
+        _hashers[upload_id] = (offset, hasher)
+
+def forget_upload(upload_id):
+    """Drop the in-process hasher and lock kept for an upload that is closed."""
+    with _hashers_lock:
+        _hashers.pop(upload_id, None)
+        _upload_locks.pop(upload_id, None)
+
+class _UploadLock:
+    """Exclusive lock on one upload's part file, across threads and processes."""
+
+    def __init__(self, path, upload_id):
+        self.path = path
+        with _hashers_lock:
+            self.thread_lock = _upload_locks.setdefault(upload_id, threading.Lock())
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.handle = open(self.path, "ab")
+        if fcntl:
+            fcntl.flock(self.handle, fcntl.LOCK_EX)
+        return self.handle
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+        self.thread_lock.release()
+
+def receive_chunk(upload, index, stream, upload_folder, max_chunk_bytes, max_total_bytes):
+    """
+    Append chunk `index` of an upload session to its part file.
+
+    Chunks must arrive in order. Re-sending a chunk that was already stored
+    is a no-op, so a client can safely retry after a dropped connection.
+
+    Args:
+        upload (UploadSession): Session row
+        index (int): Zero-based chunk number
+        stream: File-like request body
+
+    Raises:
+        UploadError: The chunk is out of order, too large or the session is closed
+    """
+    path = part_path(upload_folder, upload.id)
+    with _UploadLock(path, upload.id) as f:
+        db.session.refresh(upload)
+        if upload.status != 'open':
+            raise UploadError(f'Upload is already {upload.status}', 409)
+        if index < upload.next_chunk:
+            return upload
+        if index > upload.next_chunk:
+            raise UploadError(f'Expected chunk {upload.next_chunk}, got {index}', 409)
+
+        # Discard bytes left by a chunk that was interrupted mid-write
+        f.truncate(upload.received_bytes)
+        hasher = _take_hasher(upload.id, path, upload.received_bytes)
+
+        written = 0
+        for piece in iter(lambda: stream.read(READ_SIZE), b''):
+            written += len(piece)
+            if written > max_chunk_bytes:
+                raise UploadError(f'Chunk exceeds {max_chunk_bytes} bytes', 413)
+            if upload.received_bytes + written > max_total_bytes:
+                raise UploadError(f'Upload exceeds {max_total_bytes} bytes', 413)
+            hasher.update(piece)
+            f.write(piece)
+        f.flush()
+
+        upload.received_bytes += written
+        upload.next_chunk += 1
+        upload.updated_at = datetime.utcnow()
+        db.session.commit()
+        _put_hasher(upload.id, upload.received_bytes, hasher)
+    return upload
+
+def commit_upload(upload, upload_folder, register):
+    """
+    Verify a finished upload, store it and register its document.
+
+    The session is only marked committed by `register`, in the same
+    transaction that records the document, and the part file is kept until
+    then: if registering fails the session stays open and the commit can be
+    retried.
+
+    Args:
+        register (callable): Called as register(filepath, content_hash) under
+            the upload's lock; records the document and commits the session
+            with upload.status 'committed' and upload.document_id set
+
+    Returns:
+        The return value of `register`
+
+    Raises:
+        UploadError: The size or hash does not match what the client declared
+    """
+    path = part_path(upload_folder, upload.id)
+    with _UploadLock(path, upload.id):
+        db.session.refresh(upload)
+        if upload.status != 'open':
+            raise UploadError(f'Upload is already {upload.status}', 409)
+        if upload.total_size is not None and upload.received_bytes != upload.total_size:
+            raise UploadError(f'Received {upload.received_bytes} of {upload.total_size} bytes', 409)
+
+        hasher = _take_hasher(upload.id, path, upload.received_bytes)
+        content_hash = hasher.hexdigest()
+        if upload.expected_hash and upload.expected_hash.lower() != content_hash:
+            _put_hasher(upload.id, upload.received_bytes, hasher)
+            raise UploadError('Uploaded content does not match the declared SHA-256', 422)
+
+        filepath = store_content_addressed(path, upload_folder, content_hash, keep_temp=True)
+        try:
+            result = register(filepath, content_hash)
+        except Exception:
+            db.session.rollback()
+            if upload.status == 'open':
+                _put_hasher(upload.id, upload.received_bytes, hasher)
+            raise
+        os.remove(path)
+
+    forget_upload(upload.id)
+    return result
@@ -0,0 +1,292 @@
+"""
+Binary, memory-mapped vector store for per-document indexes.
+
+Layout of a persist directory:
+    embeddings.npy      float32 matrix of L2-normalized embeddings, one row per node
+    nodes.jsonl         compact JSON record per node ({"id", "text", "hash", ...})
+    nodes.offsets.npy   int64 byte offsets of each record in nodes.jsonl
+    store.json          node count, dimension, embedding model and document-level metadata
+    text.zst            optional compressed document text (see utils.text_store)
+
+When text.zst is present, records that carry "start"/"end" character offsets
+omit "text", which is read from the document text instead.
+
+Embeddings are opened with np.load(mmap_mode="r"), so loading a store costs a
+few page faults instead of parsing every float from JSON, and only the
+records of the top-k results are read from the sidecar.
+
+Convert LlamaIndex JSON storage directories with:
+    python -m utils.vector_store migrate [storage_dir] [--remove-json]
+"""
+import os
+import json
+import logging
+import argparse
+import numpy as np
+from utils.embedding_scheduler import chunk_key
+from utils.text_store import read_text
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILE = "embeddings.npy"
+NODES_FILE = "nodes.jsonl"
+OFFSETS_FILE = "nodes.offsets.npy"
+STORE_FILE = "store.json"
+
+# Model of stores written before the embedding model was recorded
+DEFAULT_EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Files written by LlamaIndex's default JSON persistence
+LEGACY_FILES = ("default__vector_store.json", "docstore.json", "index_store.json",
+                "graph_store.json", "image__vector_store.json")
+
+def has_vector_store(persist_dir):
+    return os.path.exists(os.path.join(persist_dir, STORE_FILE))
+
+def _without_text(record, text):
+    """The record without "text" if the document text can restore it from the offsets."""
+    start, end = record.get("start"), record.get("end")
+    if text is None or start is None or end is None or record.get("text") != text[start:end]:
+        return record
+    return {key: value for key, value in record.items() if key != "text"}
+
+def _write_records(persist_dir, records, text=None):
+    offsets = np.zeros(len(records) + 1, dtype=np.int64)
+    nodes_path = os.path.join(persist_dir, NODES_FILE)
+    temp_path = nodes_path + ".tmp"
+    with open(temp_path, "wb") as f:
+        for i, record in enumerate(records):
+            f.write(json.dumps(_without_text(record, text), separators=(",", ":")).encode("utf-8") + b"\n")
+            offsets[i + 1] = f.tell()
+    # np.save() appends .npy to names without it
+    np.save(os.path.join(persist_dir, OFFSETS_FILE + ".tmp.npy"), offsets)
+    # Replaced rather than rewritten in place, so stores that are already open keep their copy
+    os.replace(temp_path, nodes_path)
+    os.replace(os.path.join(persist_dir, OFFSETS_FILE + ".tmp.npy"), os.path.join(persist_dir, OFFSETS_FILE))
+
+def write_vector_store(persist_dir, embeddings, records, metadata=None, text=None, embedding_model=None):
+    """
+    Persist embeddings and their node records.
+
+    Args:
+        persist_dir (str): Directory to write into
+        embeddings (array-like): One embedding per record
+        records (list): JSON-serializable dicts, each with at least "id" and "text"
+        metadata (dict): Document-level metadata shared by every node
+        text (str): Document text already saved with utils.text_store; records
+            whose "text" equals text[start:end] are stored without it
+        embedding_model (str): Model that produced the embeddings; defaults to
+            DEFAULT_EMBEDDING_MODEL
+    """
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    if matrix.ndim != 2 or len(matrix) != len(records):
+        raise ValueError(f"Expected {len(records)} embeddings, got array of shape {matrix.shape}")
+
+    # Normalize once here so a search is a single matrix-vector product
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.where(norms == 0, 1.0, norms)
+
+    os.makedirs(persist_dir, exist_ok=True)
+    np.save(os.path.join(persist_dir, EMBEDDINGS_FILE), matrix)
+    _write_records(persist_dir, records, text)
+
+    # Written last, so a store only counts as present once it is complete
+    with open(os.path.join(persist_dir, STORE_FILE), "w") as f:
+        json.dump({"count": len(records), "dimension": int(matrix.shape[1]) if len(matrix) else 0,
+                   "embedding_model": embedding_model or DEFAULT_EMBEDDING_MODEL,
+                   "metadata": metadata or {}}, f, separators=(",", ":"))
+
+class MemmapVectorStore:
+    """Read-only view of a persisted store with vectorized top-k search."""
+
+    def __init__(self, persist_dir):
+        self.persist_dir = persist_dir
+        with open(os.path.join(persist_dir, STORE_FILE), "r") as f:
+            info = json.load(f)
+        self.metadata = info["metadata"]
+        self.embedding_model = info.get("embedding_model", DEFAULT_EMBEDDING_MODEL)
+        self.embeddings = np.load(os.path.join(persist_dir, EMBEDDINGS_FILE), mmap_mode="r")
+        self.offsets = np.load(os.path.join(persist_dir, OFFSETS_FILE))
+        # Held open so records stay readable if compaction replaces the file
+        self._nodes_fd = os.open(os.path.join(persist_dir, NODES_FILE), os.O_RDONLY)
+        self._text = None
+
+    def __del__(self):
+        if getattr(self, "_nodes_fd", None) is not None:
+            os.close(self._nodes_fd)
+            self._nodes_fd = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def search(self, query_embedding, top_k=5):
+        """
+        Find the records most similar to a query by cosine similarity.
+
+        Returns:
+            list: (position, score) pairs, best first
+        """
+        return self.search_many([query_embedding], top_k)[0]
+
+    def search_many(self, query_embeddings, top_k=5):
+        """
+        search() for several queries with a single matrix product.
+
+        Returns:
+            list: One list of (position, score) pairs per query, best first
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if len(self) == 0:
+            return [[] for _ in queries]
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1.0, norms)
+        scores = queries @ self.embeddings.T
+
+        top_k = min(top_k, scores.shape[1])
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        results = []
+        for row, best in zip(scores, candidates):
+            best = best[np.argsort(-row[best])]
+            results.append([(int(i), float(row[i])) for i in best])
+        return results
+
+    @property
+    def text(self):
+        """The compressed document text, read on first use; None if there is none."""
+        if self._text is None:
+            self._text = read_text(self.persist_dir) or ""
+        return self._text or None
+
+    def _with_text(self, record):
+        if "text" not in record:
+            record["text"] = self.text[record["start"]:record["end"]]
+        return record
+
+    def get_records(self, positions):
+        """Read the sidecar records at the given positions."""
+        records = []
+        for position in positions:
+            start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+            records.append(self._with_text(json.loads(os.pread(self._nodes_fd, end - start, start))))
+        return records
+
+    def iter_records(self, with_text=True):
+        """Yield every record in order."""
+        data = os.pread(self._nodes_fd, int(self.offsets[-1]), 0)
+        for line in data.splitlines():
+            record = json.loads(line)
+            yield self._with_text(record) if with_text else record
+
+def compact_records(persist_dir):
+    """
+    Rewrite a store's records without the text that text.zst already holds
+
+    Returns:
+        int: Bytes saved; 0 if there is no document text or nothing to strip
+    """
+    text = read_text(persist_dir)
+    if text is None or not has_vector_store(persist_dir):
+        return 0
+    nodes_path = os.path.join(persist_dir, NODES_FILE)
+    before = os.path.getsize(nodes_path)
+    records = list(MemmapVectorStore(persist_dir).iter_records(with_text=False))
+    if all(_without_text(record, text) is record for record in records):
+        return 0
+    _write_records(persist_dir, records, text)
+    return before - os.path.getsize(nodes_path)
+
+def known_embeddings(persist_dir, embedding_model=None):
+    """
+    Embeddings of a stored index keyed by the chunk_key of their embedded text.
+
+    Lets a new version of a document reuse the vectors of unchanged chunks.
+    Records without a "hash" (stores written before it was recorded) are
+    keyed by their text.
+
+    Args:
+        persist_dir (str): Directory of the stored index
+        embedding_model (str): Model the new version is embedded with; a store
+            embedded with another model has nothing to reuse
+
+    Returns:
+        dict: chunk_key -> embedding; empty if there is no store
+    """
+    if not has_vector_store(persist_dir):
+        return {}
+    store = MemmapVectorStore(persist_dir)
+    if store.embedding_model != (embedding_model or DEFAULT_EMBEDDING_MODEL):
+        return {}
+    return {record.get("hash") or chunk_key(record["text"]): store.embeddings[position]
+            for position, record in enumerate(store.iter_records())}
+
+def migrate_llama_index_storage(persist_dir, remove_json=False):
+    """
+    Convert a LlamaIndex JSON storage directory to the memory-mapped format.
+
+    Args:
+        persist_dir (str): storage/<index_id> directory written by VectorStoreIndex
+        remove_json (bool): Delete the JSON stores once the conversion succeeded
+
+    Returns:
+        int: Number of nodes converted
+    """
+    with open(os.path.join(persist_dir, "default__vector_store.json"), "r") as f:
+        embedding_dict = json.load(f)["embedding_dict"]
+    with open(os.path.join(persist_dir, "docstore.json"), "r") as f:
+        docstore = json.load(f)["docstore/data"]
+
+    node_ids = [node_id for node_id in embedding_dict if node_id in docstore]
+    records = []
+    metadata = {}
+    for node_id in node_ids:
+        data = docstore[node_id]["__data__"]
+        metadata = metadata or data.get("metadata", {})
+        records.append({"id": node_id, "text": data.get("text", "")})
+
+    write_vector_store(persist_dir, [embedding_dict[node_id] for node_id in node_ids], records, metadata)
+
+    analysis_file = os.path.join(persist_dir, "enhanced_analysis.json")
+    if remove_json:
+        for name in LEGACY_FILES:
+            path = os.path.join(persist_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        # The node records now hold the text, so the analysis keeps metadata only
+        if os.path.exists(analysis_file):
+            with open(analysis_file, "r") as f:
+                analysis = json.load(f)
+            analysis.pop("text", None)
+            with open(analysis_file, "w") as f:
+                json.dump(analysis, f, separators=(",", ":"))
+
+    return len(records)
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory-mapped vector store tools")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("migrate", help="Convert LlamaIndex JSON storage directories")
+    migrate.add_argument("storage_dir", nargs="?",
+                         default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "storage"))
+    migrate.add_argument("--remove-json", action="store_true",
+                         help="Delete the JSON stores after a successful conversion")
+    args = parser.parse_args()
+
+    converted = skipped = failed = 0
+    for index_id in sorted(os.listdir(args.storage_dir)):
+        persist_dir = os.path.join(args.storage_dir, index_id)
+        if not os.path.exists(os.path.join(persist_dir, "default__vector_store.json")) or has_vector_store(persist_dir):
+            skipped += 1
+            continue
+        try:
+            count = migrate_llama_index_storage(persist_dir, remove_json=args.remove_json)
+            converted += 1
+            print(f"{index_id}: {count} nodes")
+        except Exception as e:
+            failed += 1
+            print(f"{index_id}: failed ({e})")
+
+    print(f"converted {converted}, skipped {skipped}, failed {failed}")
+
+if __name__ == "__main__":
+    main()
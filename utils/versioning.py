@@ -0,0 +1,71 @@
+"""
+Helpers for re-indexing a new version of a document incrementally.
+
+Each index records a hash per extracted page in pages.json. Chunks are cut
+per page, so an unchanged page produces byte-identical chunks, and their
+embeddings can be carried forward from the previous version's vector store
+(see utils.vector_store.known_embeddings) instead of being requested again.
+"""
+import os
+import json
+import bisect
+import hashlib
+import logging
+
+# Configure logging
+logger = logging.getLogger(__name__)
+
+PAGES_FILE = "pages.json"
+
+def page_hashes(pages):
+    """SHA-256 of each page's extracted text."""
+    return [hashlib.sha256(page_text.encode("utf-8")).hexdigest() for page_text in pages]
+
+def page_of_offsets(spans, offsets):
+    """
+    1-based page number containing each character offset
+
+    Args:
+        spans (list): (start, end) offsets of each page, in order
+        offsets (list): Character offsets into the joined text
+    """
+    starts = [start for start, _ in spans]
+    return [max(1, bisect.bisect_right(starts, offset)) for offset in offsets]
+
+def save_page_hashes(persist_dir, hashes, changed=None):
+    """
+    Record page hashes, and the pages changed since the previous version
+
+    Args:
+        changed (list): 1-based page numbers from changed_pages(), or None
+            for a first version
+    """
+    with open(os.path.join(persist_dir, PAGES_FILE), "w") as f:
+        json.dump({"page_hashes": hashes, "changed_pages": changed}, f, separators=(",", ":"))
+
+def load_changed_pages(persist_dir):
+    """Pages recorded as changed since the previous version, or None if unknown."""
+    pages_file = os.path.join(persist_dir, PAGES_FILE)
+    if not os.path.exists(pages_file):
+        return None
+    with open(pages_file, "r") as f:
+        return json.load(f).get("changed_pages")
+
+def changed_pages(previous_dir, hashes):
+    """
+    Pages of a new version whose text does not appear in the previous version
+
+    Pages are matched by content rather than position, so inserting or
+    removing a page does not mark every later page as changed.
+
+    Returns:
+        list: 1-based page numbers, or None if the previous version has no page hashes
+    """
+    pages_file = os.path.join(previous_dir, PAGES_FILE)
+    if not os.path.exists(pages_file):
+        return None
+    with open(pages_file, "r") as f:
+        previous = set(json.load(f)["page_hashes"])
+    changed = [number for number, page_hash in enumerate(hashes, start=1) if page_hash not in previous]
+    logger.info(f"{len(changed)} of {len(hashes)} pages changed since the previous version")
+    return changed